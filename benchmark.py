@@ -0,0 +1,622 @@
+import os
+import argparse
+import tempfile
+import shutil
+import sys
+import json
+import time
+import subprocess
+import random
+import base64
+import platform
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from doc_to_markdown import DocumentConverter, MarkdownDocument, ConversionMetrics, LLM_MODEL
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """Minimal OpenAI-compatible /chat/completions endpoint that echoes the user message"""
+
+    # Keep connections open between requests, like a real API endpoint
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            self._reply(server, request)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _reply(self, server, request):
+        time.sleep(server.latency)
+
+        # Inject rate limiting so the client's retry path gets exercised
+        if server.error_rate and random.random() < server.error_rate:
+            body = json.dumps({"error": {"message": "stub rate limit", "type": "rate_limit"}}).encode()
+            self.send_response(429)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Retry-After', '0.05')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        user_content = request.get("messages", [{}])[-1].get("content", "")
+        prompt_tokens = len(user_content) // 4
+        body = json.dumps({
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": user_content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": prompt_tokens,
+                "total_tokens": prompt_tokens * 2,
+            },
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubImageHandler(BaseHTTPRequestHandler):
+    """Serve deterministic fake images: /img/<n>.png returns image n, /dup/<n>.png always image 0
+
+    /flaky/<n>.png answers 503 the first time each path is requested, then serves image n.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if self.path.startswith('/flaky/') and self.path not in self.server.seen:
+            self.server.seen.add(self.path)
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        name = self.path.rsplit('/', 1)[-1].split('.')[0]
+        index = 0 if self.path.startswith('/dup/') else int(name or 0)
+        body = b"\x89PNG\r\n\x1a\n" + index.to_bytes(4, 'big') * (self.server.image_size // 4)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubImageServer:
+    """Run StubImageHandler on a local port for the duration of a with-block"""
+
+    def __init__(self, latency=0.05, image_size=50000):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubImageHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.image_size = image_size
+        self.httpd.seen = set()
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class StubLLMServer:
+    """Run StubLLMHandler on a local port for the duration of a with-block"""
+
+    def __init__(self, latency=0.2, error_rate=0.0):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubLLMHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.error_rate = error_rate
+        self.httpd.requests = 0
+        self.httpd.in_flight = 0
+        self.httpd.max_in_flight = 0
+        self.httpd.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    @property
+    def max_in_flight(self):
+        return self.httpd.max_in_flight
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def synthetic_markdown(size):
+    """Build roughly size characters of Markdown with headings, paragraphs and tables"""
+    parts = []
+    section = 0
+    while sum(len(p) for p in parts) < size:
+        section += 1
+        parts.append(f"## Section {section}\n")
+        parts.append("Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 8 + "\n")
+        parts.append("| Name | Value |\n| --- | --- |\n" + "".join(f"| item {i} | {i * section} |\n" for i in range(10)))
+    return "\n".join(parts)[:size]
+
+
+def bench_llm_dispatch(args):
+    """Time _enhance_with_llm on one document at several concurrency caps"""
+    work_dir = tempfile.mkdtemp()
+    try:
+        content = synthetic_markdown(args.size)
+        with StubLLMServer(latency=args.latency, error_rate=args.error_rate) as server:
+            for concurrency in args.concurrency:
+                converter = DocumentConverter("stub-key", output_dir=work_dir, base_url=server.base_url,
+                                              llm_concurrency=concurrency, use_cache=False)
+                md_path = os.path.join(work_dir, "bench.md")
+                with open(md_path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+
+                before = server.requests
+                start = time.perf_counter()
+                converter._enhance_with_llm(MarkdownDocument(md_path))
+                elapsed = time.perf_counter() - start
+                converter.close()
+
+                print(f"concurrency={concurrency:<3} requests={server.requests - before:<4} "
+                      f"elapsed={elapsed:.2f}s throughput={len(content) / elapsed / 1000:.1f} kchars/s")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def bench_llm_connections(args):
+    """Compare the shared pooled client with building a fresh client for every request"""
+    work_dir = tempfile.mkdtemp()
+    messages = [{"role": "system", "content": "stub"}, {"role": "user", "content": "ping"}]
+    try:
+        with StubLLMServer(latency=0.0) as server:
+            converter = DocumentConverter("stub-key", output_dir=work_dir, base_url=server.base_url,
+                                          use_cache=False, llm_http2=False)
+
+            async def pooled():
+                for _ in range(args.requests):
+                    await converter.client.chat.completions.create(model=LLM_MODEL, messages=messages)
+
+            async def per_call():
+                for _ in range(args.requests):
+                    client = converter._build_llm_client("stub-key", server.base_url, 30.0, 10.0, 1, False)
+                    await client.chat.completions.create(model=LLM_MODEL, messages=messages)
+                    await client.close()
+
+            for name, run in (("per-call client", per_call), ("pooled client", pooled)):
+                start = time.perf_counter()
+                converter._run_async(run())
+                elapsed = time.perf_counter() - start
+                print(f"{name:<16} requests={args.requests:<5} elapsed={elapsed:.2f}s "
+                      f"per-request={elapsed / args.requests * 1000:.2f}ms")
+            converter.close()
+        print("Note: the stub is plain HTTP, so TLS handshakes saved by pooling are not included")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None where resource is unavailable"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if peak > 1 << 32 else peak / 1024
+
+
+def synthetic_workbook(path, rows, cols):
+    """Write a workbook with one sheet of rows x cols mixed values using openpyxl's write-only mode"""
+    import openpyxl
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Data")
+    sheet.append([f"Column {c}" for c in range(cols)])
+    for r in range(rows):
+        sheet.append([r * c if c % 2 else f"row {r} col {c}" for c in range(cols)])
+    workbook.save(path)
+
+
+def bench_excel(args):
+    """Time the streaming Excel converter on a synthetic large workbook"""
+    work_dir = tempfile.mkdtemp()
+    try:
+        xlsx_path = os.path.join(work_dir, "bench.xlsx")
+        print(f"Generating {args.rows} x {args.cols} workbook...")
+        synthetic_workbook(xlsx_path, args.rows, args.cols)
+        rss_before = peak_rss_mb()
+
+        converter = DocumentConverter("stub-key", output_dir=work_dir, use_cache=False,
+                                      excel_max_rows=args.max_rows, excel_sample_every=args.sample_every)
+        md_path = os.path.join(work_dir, "bench.md")
+        start = time.perf_counter()
+        converter._convert_excel(xlsx_path, md_path)
+        elapsed = time.perf_counter() - start
+        converter.close()
+
+        print(f"rows={args.rows} cols={args.cols} elapsed={elapsed:.2f}s "
+              f"throughput={args.rows / elapsed:.0f} rows/s output={os.path.getsize(md_path) / 1e6:.1f} MB")
+        if rss_before is not None:
+            print(f"peak RSS {peak_rss_mb():.0f} MB (generation alone: {rss_before:.0f} MB)")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def bench_html_images(args):
+    """Time concurrent remote image fetching against a local image server"""
+    work_dir = tempfile.mkdtemp()
+    try:
+        with StubImageServer(latency=args.latency) as server:
+            urls = [f"{server.base_url}/img/{i}.png" for i in range(args.images)]
+            urls += [f"{server.base_url}/dup/{i}.png" for i in range(args.duplicates)]
+            for workers in args.workers:
+                converter = DocumentConverter("stub-key", output_dir=os.path.join(work_dir, str(workers)),
+                                              use_cache=False, image_fetch_workers=workers,
+                                              image_fetch_per_host=workers)
+                start = time.perf_counter()
+                fetched = converter._get_image_fetcher().fetch_all(urls)
+                elapsed = time.perf_counter() - start
+                saved = len(set(name for name in fetched.values() if name))
+                converter.close()
+                print(f"workers={workers:<3} urls={len(urls):<5} files={saved:<5} elapsed={elapsed:.2f}s "
+                      f"throughput={len(urls) / elapsed:.0f} images/s")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+BUNDLED_DOCUMENTS = {
+    "docx": "test-worddoc.docx",
+    "xlsx": "test-exceldoc.xlsx",
+    "html": "test-htmldoc.html",
+}
+
+
+def bench_markitdown(args):
+    """Compare markitdown backends: first-file latency (startup) and steady-state throughput"""
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    documents = [os.path.join(repo_dir, name) for name in BUNDLED_DOCUMENTS.values()]
+    work_dir = tempfile.mkdtemp()
+    try:
+        for backend in args.backends:
+            converter = DocumentConverter("stub-key", output_dir=os.path.join(work_dir, backend),
+                                          use_cache=False, markitdown_backend=backend)
+            timings = []
+            failures = 0
+            for i in range(args.repeat):
+                for path in documents:
+                    output_path = os.path.join(converter.output_dir, f"{i}-{os.path.basename(path)}.md")
+                    start = time.perf_counter()
+                    if not converter._try_markitdown(path, output_path):
+                        failures += 1
+                    timings.append(time.perf_counter() - start)
+            converter.close()
+
+            steady = timings[1:] or timings
+            print(f"{backend:<10} first={timings[0] * 1000:.0f}ms "
+                  f"steady={sum(steady) / len(steady) * 1000:.1f}ms/file "
+                  f"throughput={len(steady) / sum(steady):.1f} files/s failures={failures}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def bench_startup(args):
+    """Cold CLI latency: `--help` and one conversion per bundled format in a fresh interpreter"""
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(repo_dir, "doc_to_markdown.py")
+    documents = dict(BUNDLED_DOCUMENTS, pdf="test-pdfdoc.pdf")
+    work_dir = tempfile.mkdtemp()
+    over_budget = False
+    try:
+        with StubLLMServer(latency=0.0) as server:
+            runs = [("help", [script, "--help"])]
+            for fmt, name in sorted(documents.items()):
+                runs.append((fmt, [script, os.path.join(repo_dir, name), "--api-key", "stub-key",
+                                   "--base-url", server.base_url, "--output-dir", work_dir,
+                                   "--no-cache", "--force"]))
+            for label, command in runs:
+                timings = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    subprocess.run([sys.executable] + command, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+                    timings.append((time.perf_counter() - start) * 1000)
+                best = min(timings)
+                print(f"{label:<6} best={best:.0f}ms mean={sum(timings) / len(timings):.0f}ms")
+                if label == "help" and args.budget_ms and best > args.budget_ms:
+                    print(f"--help exceeded the {args.budget_ms}ms startup budget")
+                    over_budget = True
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if over_budget:
+        sys.exit(1)
+
+
+def synthetic_pdf(path, pages):
+    """Write a PDF of text pages with headings, paragraphs and a small aligned table on every third page"""
+    import fitz
+    document = fitz.open()
+    for n in range(pages):
+        page = document.new_page()
+        page.insert_text((72, 72), f"Chapter {n + 1}", fontsize=18)
+        y = 110
+        for line in range(20):
+            page.insert_text((72, y), f"Line {line} of page {n + 1}: lorem ipsum dolor sit amet, consectetur.", fontsize=10)
+            y += 14
+        if n % 3 == 0:
+            for row in range(5):
+                for col, x in enumerate((72, 200, 330)):
+                    page.insert_text((x, y + 10), f"r{row}c{col}" if row else f"Head {col}", fontsize=10)
+                y += 14
+    document.save(path)
+    document.close()
+
+
+def synthetic_docx(path, tables):
+    """Write a DOCX with a heading, a paragraph and a 5 x 4 table per section"""
+    import docx
+    document = docx.Document()
+    for n in range(tables):
+        document.add_heading(f"Section {n + 1}", level=2)
+        document.add_paragraph(f"Paragraph {n + 1}: lorem ipsum dolor sit amet, consectetur adipiscing elit.")
+        table = document.add_table(rows=5, cols=4)
+        for r, row in enumerate(table.rows):
+            for c, cell in enumerate(row.cells):
+                cell.text = f"r{r}c{c}-{n}"
+    document.save(path)
+
+
+def synthetic_datauri_markdown(path, megabytes, image_kb=256):
+    """Write Markdown with roughly megabytes of inline PNG data URIs between paragraphs"""
+    rng = random.Random(0)
+    images = max(1, int(megabytes * 1024 / image_kb))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("# Inline images\n\n")
+        for n in range(images):
+            payload = b"\x89PNG\r\n\x1a\n" + rng.randbytes(image_kb * 1024 * 3 // 4)
+            f.write(f"Figure {n + 1} follows.\n\n![figure {n + 1}](data:image/png;base64,"
+                    f"{base64.b64encode(payload).decode('ascii')})\n\n")
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def _run_suite_case(path, kind, work_dir, base_url, repeat):
+    """Convert one document repeat times in a fresh process and report timings and peak RSS"""
+    timings = []
+    stages = {}
+    llm_calls = 0
+    error = None
+    for i in range(repeat):
+        output_dir = os.path.join(work_dir, f"run{i}")
+        converter = DocumentConverter("stub-key", output_dir=output_dir, base_url=base_url,
+                                      use_cache=False, markitdown_backend="none", llm_http2=False)
+        try:
+            start = time.perf_counter()
+            if kind == "pipeline":
+                # Post-processing only: the document is already Markdown
+                md_path = os.path.join(output_dir, os.path.basename(path))
+                shutil.copy(path, md_path)
+                converter.metrics = ConversionMetrics(md_path, "markdown")
+                converter.markitdown_pipeline.run(MarkdownDocument(md_path, md_path), converter.metrics)
+                converter.last_metrics = converter.metrics.finish("converted")
+                converter.metrics = None
+            else:
+                converter.convert_file(path)
+            timings.append(time.perf_counter() - start)
+            if converter.last_metrics:
+                llm_calls += len(converter.last_metrics["llm_calls"])
+                for name, stage in converter.last_metrics["stages"].items():
+                    stages.setdefault(name, []).append(stage["wall_seconds"])
+        except Exception as e:
+            error = str(e)
+            break
+        finally:
+            converter.close()
+            shutil.rmtree(output_dir, ignore_errors=True)
+    return {"timings": timings, "stages": stages, "llm_calls": llm_calls,
+            "peak_rss_mb": peak_rss_mb(), "error": error}
+
+
+def bench_suite(args):
+    """Convert the bundled documents and synthetic scale-ups against a deterministic stub LLM"""
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp()
+    # (name, path or builder, kind, units, unit count)
+    cases = []
+    if args.scale in ("bundled", "all"):
+        for name in ("test-pdfdoc.pdf", "test-pdfdoc1.pdf", "test-worddoc.docx",
+                     "test-exceldoc.xlsx", "test-htmldoc.html"):
+            cases.append((name, os.path.join(repo_dir, name), "convert", None, None))
+    if args.scale in ("large", "all"):
+        cases += [
+            (f"pdf-{args.pdf_pages}-pages", lambda p: synthetic_pdf(p, args.pdf_pages), "convert",
+             "pages", args.pdf_pages),
+            (f"xlsx-{args.excel_rows}-rows", lambda p: synthetic_workbook(p, args.excel_rows, 10), "convert",
+             "rows", args.excel_rows),
+            (f"docx-{args.docx_tables}-tables", lambda p: synthetic_docx(p, args.docx_tables), "convert",
+             "tables", args.docx_tables),
+            (f"md-{args.datauri_mb}mb-datauri", lambda p: synthetic_datauri_markdown(p, args.datauri_mb), "pipeline",
+             "MB", args.datauri_mb),
+        ]
+    if args.cases:
+        cases = [case for case in cases if any(pattern in case[0] for pattern in args.cases)]
+
+    extensions = {"pdf": ".pdf", "xlsx": ".xlsx", "docx": ".docx", "md": ".md"}
+    results = []
+    try:
+        with StubLLMServer(latency=args.latency) as server:
+            for name, source, kind, units, count in cases:
+                if callable(source):
+                    path = os.path.join(work_dir, name + extensions[name.split("-")[0]])
+                    print(f"Generating {name}...")
+                    source(path)
+                else:
+                    path = source
+                # A fresh spawned process per case, so peak RSS belongs to that case alone
+                context = multiprocessing.get_context("spawn")
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    run = executor.submit(_run_suite_case, path, kind, os.path.join(work_dir, "out-" + name),
+                                          server.base_url, args.repeat).result()
+
+                result = {"case": name, "kind": kind, "input_bytes": os.path.getsize(path),
+                          "repeat": len(run["timings"]), "peak_rss_mb": run["peak_rss_mb"],
+                          "llm_calls": run["llm_calls"], "error": run["error"]}
+                if run["timings"]:
+                    p50 = percentile(run["timings"], 50)
+                    result.update({
+                        "p50_seconds": round(p50, 4),
+                        "p95_seconds": round(percentile(run["timings"], 95), 4),
+                        "min_seconds": round(min(run["timings"]), 4),
+                        "throughput_mb_s": round(result["input_bytes"] / 1e6 / p50, 3),
+                        "stages_p50_seconds": {stage: round(percentile(values, 50), 4)
+                                               for stage, values in sorted(run["stages"].items())},
+                    })
+                    if units:
+                        result[f"{units}_per_second"] = round(count / p50, 1)
+                results.append(result)
+
+                line = f"{name:<24} "
+                if run["timings"]:
+                    line += (f"p50={result['p50_seconds']:.3f}s p95={result['p95_seconds']:.3f}s "
+                             f"{result['throughput_mb_s']:.2f} MB/s")
+                line += f" rss={result['peak_rss_mb'] or 0:.0f}MB llm_calls={result['llm_calls']}"
+                if run["error"]:
+                    line += f" ERROR {run['error']}"
+                print(line)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "stub_latency_seconds": args.latency,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "cases": results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = {case["case"]: case for case in json.load(f)["cases"]}
+        regressed = False
+        for result in results:
+            before = baseline.get(result["case"], {}).get("p50_seconds")
+            if before and result.get("p50_seconds"):
+                change = (result["p50_seconds"] - before) / before * 100
+                print(f"{result['case']:<24} p50 {before:.3f}s -> {result['p50_seconds']:.3f}s ({change:+.1f}%)")
+                if args.max_regression is not None and change > args.max_regression:
+                    regressed = True
+        if regressed:
+            print(f"p50 regressed by more than {args.max_regression}% for at least one case")
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark doc_to_markdown against a local stub LLM server')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    dispatch = subparsers.add_parser('llm-dispatch', help='Concurrent chunk dispatch in _enhance_with_llm')
+    dispatch.add_argument('--size', type=int, default=96000, help='Characters of synthetic Markdown')
+    dispatch.add_argument('--latency', type=float, default=0.2, help='Stub server latency per request in seconds')
+    dispatch.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 429')
+    dispatch.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8], help='Concurrency caps to compare')
+    dispatch.set_defaults(func=bench_llm_dispatch)
+
+    connections = subparsers.add_parser('llm-connections', help='Connection setup cost: pooled vs per-call client')
+    connections.add_argument('--requests', type=int, default=200, help='Sequential requests per client strategy')
+    connections.set_defaults(func=bench_llm_connections)
+
+    excel = subparsers.add_parser('excel', help='Streaming Excel conversion on a synthetic workbook')
+    excel.add_argument('--rows', type=int, default=500000, help='Data rows in the synthetic sheet')
+    excel.add_argument('--cols', type=int, default=10, help='Columns in the synthetic sheet')
+    excel.add_argument('--max-rows', type=int, help='Pass --excel-max-rows to the converter')
+    excel.add_argument('--sample-every', type=int, default=1, help='Pass --excel-sample-every to the converter')
+    excel.set_defaults(func=bench_excel)
+
+    html_images = subparsers.add_parser('html-images', help='Concurrent remote image fetching for HTML')
+    html_images.add_argument('--images', type=int, default=200, help='Distinct images to fetch')
+    html_images.add_argument('--duplicates', type=int, default=50, help='Extra URLs serving identical content')
+    html_images.add_argument('--latency', type=float, default=0.05, help='Stub server latency per image in seconds')
+    html_images.add_argument('--workers', type=int, nargs='+', default=[1, 8, 16], help='Fetch worker counts to compare')
+    html_images.set_defaults(func=bench_html_images)
+
+    markitdown = subparsers.add_parser('markitdown', help='Startup and throughput of the markitdown backends')
+    markitdown.add_argument('--repeat', type=int, default=10, help='Passes over the bundled documents per backend')
+    markitdown.add_argument('--backends', nargs='+', default=['cli', 'worker', 'inprocess'],
+                            choices=['cli', 'worker', 'inprocess'], help='Backends to compare')
+    markitdown.set_defaults(func=bench_markitdown)
+
+    startup = subparsers.add_parser('startup', help='Cold start latency of the CLI per format')
+    startup.add_argument('--repeat', type=int, default=5, help='Fresh interpreter launches per measurement')
+    startup.add_argument('--budget-ms', type=float, help='Exit non-zero when `--help` takes longer than this')
+    startup.set_defaults(func=bench_startup)
+
+    suite = subparsers.add_parser('suite', help='Bundled documents and synthetic scale-ups, reported as JSON')
+    suite.add_argument('--scale', choices=['bundled', 'large', 'all'], default='bundled', help='Which inputs to run')
+    suite.add_argument('--cases', nargs='+', help='Only run cases whose name contains one of these strings')
+    suite.add_argument('--repeat', type=int, default=3, help='Conversions per case')
+    suite.add_argument('--latency', type=float, default=0.05, help='Stub LLM latency per request in seconds')
+    suite.add_argument('--pdf-pages', type=int, default=1000, help='Pages in the synthetic PDF')
+    suite.add_argument('--excel-rows', type=int, default=500000, help='Rows in the synthetic workbook')
+    suite.add_argument('--docx-tables', type=int, default=2000, help='Tables in the synthetic DOCX')
+    suite.add_argument('--datauri-mb', type=int, default=16, help='MB of inline data-URI images in the synthetic Markdown')
+    suite.add_argument('--output', help='Write the results as JSON to this file')
+    suite.add_argument('--baseline', help='Earlier --output file to compare p50 latencies against')
+    suite.add_argument('--max-regression', type=float, help='Exit non-zero when a p50 grows by more than this percent')
+    suite.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import shutil
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from doc_to_markdown import (COST_LLM, detect_format, add_converter_arguments, converter_kwargs_from_args,
+                             _init_batch_worker, _convert_in_worker, _enhance_in_worker)
+
+
+# Largest JSON job request read; the document itself is referenced by path
+MAX_JSON_BYTES = 64 * 1024
+
+
+class ServiceBusy(Exception):
+    """Raised when a job's queue is full; the client should retry later"""
+
+
+class ConversionJob:
+    """One submitted document and, once it has run, its batch-style result dict
+
+    A job's stage is "convert", or "enhance" once its conversion has left LLM
+    enhancement to the LLM lane. An uploaded document (upload=True) is deleted
+    once its job has run.
+    """
+
+    def __init__(self, input_path, lane, force=False, upload=False):
+        self.id = uuid.uuid4().hex[:16]
+        self.input_path = input_path
+        self.lane = lane
+        self.force = force
+        self.upload = upload
+        self.stage = "convert"
+        self.status = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.done = threading.Event()
+
+    def describe(self):
+        info = {
+            "id": self.id,
+            "input": self.input_path,
+            "lane": self.lane,
+            "stage": self.stage,
+            "status": self.status,
+            "queued_seconds": round((self.started or time.time()) - self.submitted, 3),
+        }
+        if self.result is not None:
+            info.update(output=self.result["output"], seconds=self.result["seconds"],
+                        error=self.result["error"], metrics=self.result.get("metrics"))
+        return info
+
+
+class ConversionLane:
+    """A bounded job queue feeding a pool of worker processes, each with a warm DocumentConverter
+
+    One runner thread per worker process takes the next job and waits for it, so
+    jobs wait in the bounded queue (where they can be refused) and never pile up
+    inside the executor. A converted job whose LLM enhancement was deferred is
+    passed to handoff (a callable taking the job) instead of being finished here.
+    """
+
+    def __init__(self, name, workers, queue_size, converter_kwargs, handoff=None):
+        self.name = name
+        self.handoff = handoff
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.running = 0
+        self.lock = threading.Lock()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_batch_worker,
+                                            initargs=(converter_kwargs,))
+        self.threads = [threading.Thread(target=self._run, name=f"{name}-runner-{i}", daemon=True)
+                        for i in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, job):
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            raise ServiceBusy(f"the {self.name} queue is full ({self.queue.maxsize} jobs)")
+
+    def put(self, job):
+        """Queue a job handed over by another lane, waiting for room rather than refusing it"""
+        self.queue.put(job)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            with self.lock:
+                self.running += 1
+            job.status = "running"
+            job.started = job.started or time.time()
+            try:
+                if job.stage == "enhance":
+                    result = self.executor.submit(_enhance_in_worker, job.input_path).result()
+                else:
+                    result = self.executor.submit(_convert_in_worker, job.input_path, job.force).result()
+            except Exception as e:
+                # The worker process itself died (e.g. killed for memory)
+                result = {"input": job.input_path, "output": None, "status": "failed",
+                          "seconds": 0.0, "error": str(e)}
+            with self.lock:
+                self.running -= 1
+
+            if job.stage == "convert" and result.get("enhancement_pending") and self.handoff is not None:
+                job.result = result
+                job.stage = "enhance"
+                job.status = "queued"
+                self.handoff(job)
+                continue
+            if job.stage == "enhance":
+                # Report both stages: total time, and the conversion's metrics next to the enhancement's
+                result["seconds"] = round(job.result["seconds"] + result["seconds"], 3)
+                result["convert_metrics"] = job.result.get("metrics")
+            job.result = result
+            if job.upload:
+                try:
+                    os.remove(job.input_path)
+                except OSError as e:
+                    print(f"Could not remove upload {job.input_path}: {e}", file=sys.stderr)
+            job.status = job.result["status"]
+            job.finished = time.time()
+            job.done.set()
+
+    def stats(self):
+        return {"workers": self.workers, "queued": self.queue.qsize(), "running": self.running,
+                "queue_size": self.queue.maxsize}
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout=5)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ConversionService:
+    """Route conversion jobs to a CPU lane or an LLM lane by the format handler's cost class
+
+    LLM-bound documents (e.g. PDFs streamed through the LLM) mostly wait on the
+    API, so they get their own worker processes and queue. They cannot starve
+    CPU-bound conversions. CPU-lane workers defer LLM enhancement: a document
+    with chunks that fail lint moves on to the LLM lane for that step. The
+    number of documents talking to the LLM at once therefore stays capped at
+    llm_workers.
+    """
+
+    def __init__(self, converter_kwargs, cpu_workers=None, llm_workers=2, queue_size=64,
+                 upload_dir=None, max_jobs=1000):
+        # Jobs already run in parallel, so keep image extraction and OCR inside each worker
+        converter_kwargs = dict(converter_kwargs)
+        if converter_kwargs.get("image_workers") is None:
+            converter_kwargs["image_workers"] = 1
+        if converter_kwargs.get("ocr_workers") is None:
+            converter_kwargs["ocr_workers"] = 1
+
+        self.upload_dir = upload_dir or os.path.join(converter_kwargs["output_dir"], ".uploads")
+        os.makedirs(self.upload_dir, exist_ok=True)
+        self.lanes = {
+            "cpu": ConversionLane("cpu", cpu_workers or os.cpu_count() or 1, queue_size,
+                                  dict(converter_kwargs, defer_enhancement=True), handoff=self._to_llm_lane),
+            "llm": ConversionLane("llm", llm_workers, queue_size, converter_kwargs),
+        }
+        self.jobs = OrderedDict()
+        self.max_jobs = max_jobs
+        self.lock = threading.Lock()
+
+    def _to_llm_lane(self, job):
+        job.lane = "llm"
+        self.lanes["llm"].put(job)
+
+    def submit(self, input_path, force=False, job=None):
+        """Queue a document and return its ConversionJob
+
+        Raises:
+            ValueError: The document's format is not supported
+            ServiceBusy: The lane's queue is full
+        """
+        lane = "llm" if detect_format(input_path).cost == COST_LLM else "cpu"
+        if job is None:
+            job = ConversionJob(input_path, lane, force)
+        else:
+            job.lane = lane
+        with self.lock:
+            self.jobs[job.id] = job
+        try:
+            self.lanes[lane].submit(job)
+        except ServiceBusy:
+            with self.lock:
+                del self.jobs[job.id]
+            raise
+        with self.lock:
+            # Forget the oldest finished jobs so a long-running service does not grow without bound
+            while len(self.jobs) > self.max_jobs:
+                oldest = next(iter(self.jobs.values()))
+                if not oldest.done.is_set():
+                    break
+                self.jobs.popitem(last=False)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def stats(self):
+        with self.lock:
+            statuses = {}
+            for job in self.jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {"lanes": {name: lane.stats() for name, lane in self.lanes.items()}, "jobs": statuses}
+
+    def close(self):
+        for lane in self.lanes.values():
+            lane.close()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """HTTP API for ConversionService
+
+    POST /jobs               JSON {"path": "...", "force": false}, or the document itself as the
+                             request body with ?filename=report.pdf; replies 202 with the job
+    GET  /jobs/<id>          Job status
+    GET  /jobs/<id>/result   The Markdown once the job is done; ?wait=SECONDS waits for it first
+    GET  /health             Queue depths and job counts
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path.rstrip('/') != '/jobs':
+            self.close_connection = True
+            return self._send_json(404, {"error": "not found"})
+        service = self.server.service
+        params = parse_qs(url.query)
+        is_json = self.headers.get('Content-Type', '').startswith('application/json')
+
+        # Refuse bad lengths before reading; the unread body means the connection cannot be reused
+        length = self.headers.get('Content-Length')
+        if length is None:
+            self.close_connection = True
+            return self._send_json(411, {"error": "Content-Length required"})
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            return self._send_json(400, {"error": "invalid Content-Length"})
+        limit = MAX_JSON_BYTES if is_json else self.server.max_upload_bytes
+        if length > limit:
+            self.close_connection = True
+            return self._send_json(413, {"error": f"request body larger than {limit} bytes"})
+
+        job = None
+        if is_json:
+            try:
+                request = json.loads(self.rfile.read(length) or b"{}")
+                input_path = os.path.abspath(request["path"])
+            except (ValueError, KeyError, TypeError):
+                return self._send_json(400, {"error": "expected JSON with a 'path' field"})
+            if not os.path.isfile(input_path):
+                return self._send_json(400, {"error": f"no such file: {input_path}"})
+            force = bool(request.get("force"))
+        else:
+            filename = os.path.basename(params.get("filename", [""])[0])
+            if not filename:
+                self.close_connection = True
+                return self._send_json(400, {"error": "uploads need a ?filename= parameter"})
+            # Uploads are named after the job, so documents with the same name do not collide
+            job = ConversionJob(None, None, force=params.get("force", ["0"])[0] in ("1", "true"), upload=True)
+            input_path = os.path.join(service.upload_dir, f"{job.id}_{filename}")
+            job.input_path = input_path
+            with open(input_path, 'wb') as f:
+                remaining = length
+                while remaining > 0:
+                    data = self.rfile.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        break
+                    f.write(data)
+                    remaining -= len(data)
+            force = job.force
+
+        try:
+            job = service.submit(input_path, force=force, job=job)
+        except ServiceBusy as e:
+            if job is not None:
+                os.remove(input_path)
+            return self._send_json(503, {"error": str(e)}, {"Retry-After": "1"})
+        except ValueError as e:
+            if job is not None:
+                os.remove(input_path)
+            return self._send_json(415, {"error": str(e)})
+        return self._send_json(202, job.describe(), {"Location": f"/jobs/{job.id}"})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        service = self.server.service
+        if parts == ["health"]:
+            return self._send_json(200, service.stats())
+        if len(parts) < 2 or parts[0] != "jobs" or len(parts) > 3 or (len(parts) == 3 and parts[2] != "result"):
+            return self._send_json(404, {"error": "not found"})
+        job = service.get(parts[1])
+        if job is None:
+            return self._send_json(404, {"error": "unknown job"})
+        if len(parts) == 2:
+            return self._send_json(200, job.describe())
+
+        wait = parse_qs(url.query).get("wait", ["0"])[0]
+        try:
+            job.done.wait(timeout=min(float(wait), self.server.max_wait))
+        except ValueError:
+            return self._send_json(400, {"error": "wait must be a number of seconds"})
+        if not job.done.is_set():
+            return self._send_json(202, job.describe())
+        if job.status == "failed" or not job.result["output"]:
+            return self._send_json(500, job.describe())
+        self._send_file(job.result["output"])
+
+    def _send_file(self, path):
+        # Streamed in pieces so a large document is never held in memory whole
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/markdown; charset=utf-8')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, 64 * 1024)
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        print(format % args, file=sys.stderr)
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    """ServiceHandler served on a Unix socket instead of a TCP port"""
+
+    daemon_threads = True
+
+    def __init__(self, path, handler):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve document conversions over HTTP with warm converters')
+    parser.add_argument('--host', default="127.0.0.1", help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='TCP port to listen on')
+    parser.add_argument('--socket', help='Listen on this Unix socket path instead of a TCP port')
+    parser.add_argument('--cpu-workers', type=int, help='Worker processes for CPU-bound formats (default: CPU count)')
+    parser.add_argument('--llm-workers', type=int, default=2, help='Worker processes for LLM-bound formats such as PDF')
+    parser.add_argument('--queue-size', type=int, default=64, help='Jobs waiting per lane before new ones get 503')
+    parser.add_argument('--upload-dir', help='Where uploaded documents are stored (default: <output-dir>/.uploads)')
+    parser.add_argument('--max-upload-mb', type=float, default=200, help='Largest document accepted as an upload')
+    parser.add_argument('--max-wait', type=float, default=300, help='Longest a result request may wait, in seconds')
+    parser.add_argument('--max-jobs', type=int, default=1000, help='Finished jobs remembered for status requests')
+    add_converter_arguments(parser)
+    args = parser.parse_args()
+
+    service = ConversionService(converter_kwargs_from_args(args), cpu_workers=args.cpu_workers,
+                                llm_workers=args.llm_workers, queue_size=args.queue_size,
+                                upload_dir=args.upload_dir, max_jobs=args.max_jobs)
+    if args.socket:
+        server = UnixHTTPServer(args.socket, ServiceHandler)
+        where = args.socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), ServiceHandler)
+        server.daemon_threads = True
+        where = f"http://{args.host}:{server.server_address[1]}"
+    server.service = service
+    server.max_upload_bytes = int(args.max_upload_mb * 1024 * 1024)
+    server.max_wait = args.max_wait
+
+    print(f"Conversion service listening on {where} "
+          f"({service.lanes['cpu'].workers} CPU workers, {service.lanes['llm'].workers} LLM workers)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,158 +5,2154 @@ import shutil
 import base64
 from pathlib import Path
 import subprocess
+import sys
 import json
 import re
+import glob
+import time
+import random
+import asyncio
+import threading
+import hashlib
+import zipfile
+import importlib
+import importlib.util
+from collections import Counter, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from urllib.parse import urlsplit
+
+class LazyModule:
+    """Stand-in for a module that is only imported when one of its attributes is used
+    
+    Heavy libraries are bound through this at module level, so `--help` and a
+    run that only converts one format do not pay for importing all of them.
+    """
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
 
 # Import OpenAI for OpenRouter integration
-from openai import OpenAI
-
-# Import document processing libraries
-import fitz  # PyMuPDF for PDF
-from pdf2image import convert_from_path
-import pytesseract 
-from docx import Document
-import pandas as pd
-import openpyxl #excel
-from bs4 import BeautifulSoup # HTML parsing
-import markdown
-import requests
+openai = LazyModule("openai")
+httpx = LazyModule("httpx")
+
+# Import document processing libraries, each loaded on first use
+fitz = LazyModule("fitz")  # PyMuPDF for PDF
+docx = LazyModule("docx")
+docx_table = LazyModule("docx.table")
+openpyxl = LazyModule("openpyxl")  # excel
+bs4 = LazyModule("bs4")  # HTML parsing
+requests = LazyModule("requests")
+requests_adapters = LazyModule("requests.adapters")
+pytesseract = LazyModule("pytesseract")  # OCR for scanned PDF pages
+PIL_Image = LazyModule("PIL.Image")
+
+# Recorded in the conversion manifest; bump when a change alters the Markdown produced
+CONVERTER_VERSION = "2.2"
+
+# Bytes read from the start of a file to recognise its format
+SNIFF_BYTES = 8192
+
+# Compound File Binary header used by legacy .doc and .xls files
+OLE2_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+
+# Resource that dominates a format handler's conversion, used to order batch work
+COST_LLM = "llm"
+COST_CPU = "cpu"
+COST_IO = "io"
+COST_ORDER = {COST_LLM: 0, COST_CPU: 1, COST_IO: 2}
+
+# Model used for every LLM call; part of the response cache key
+LLM_MODEL = "openai/gpt-4o"
+
+# Marks page boundaries in text handed to _convert_with_llm so chunks can split between pages
+PAGE_BREAK = "\f"
+
+# Token budget for the content of one LLM request (PDF page batches and Markdown chunks)
+LLM_CHUNK_TOKENS = 2000
+
+# tiktoken encoding used to count tokens for LLM_MODEL
+LLM_TOKEN_ENCODING = "o200k_base"
+
+# Most chunks of one document sent for LLM enhancement; the ones with most lint issues go first
+ENHANCE_MAX_CHUNKS = 25
+
+# PDF pages whose local layout analysis scores at least this are written without the LLM
+LAYOUT_CONFIDENCE_THRESHOLD = 0.8
+
+# Indirect references in PDF object source, and back-references that lead out of a page's resources
+PDF_REF_RE = re.compile(r'(\d+) \d+ R\b')
+PDF_BACK_REF_RE = re.compile(r'/(?:Parent|P)\s+\d+ \d+ R\b')
+
+# Files under .page_cache: per-page layout results and OCR text
+PAGE_CACHE_SUFFIXES = (".json", ".txt")
+
+# DOCX image references: DrawingML pictures (a:blip r:embed) and legacy VML ones (v:imagedata r:id)
+# (Clark notation, as docx.oxml.ns.qn would produce, so python-docx is not imported up front)
+DOCX_REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+DOCX_IMAGE_REFS = {
+    "{http://schemas.openxmlformats.org/drawingml/2006/main}blip": DOCX_REL_NS + "embed",
+    "{urn:schemas-microsoft-com:vml}imagedata": DOCX_REL_NS + "id",
+}
+
+# A streamed PDF batch also ends after any page whose hash is divisible by this, so batch
+# boundaries depend on page content rather than position and an edit to one page only
+# changes the LLM request for that page's batch
+PDF_BATCH_BOUNDARY = 4
+
+# Base64 characters decoded at a time when extracting data URI images (a multiple of 4)
+BASE64_DECODE_CHUNK = 1024 * 1024
+
+# Status codes worth retrying an LLM request for: rate limiting and transient server errors
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Longest wait for one document's LLM work on the background event loop, so a wedged
+# loop fails the document instead of hanging the process
+ASYNC_RESULT_TIMEOUT = 3600.0
+
+class HeadingNormalizer:
+    """Keep heading levels consistent across separately converted chunks
+    
+    Each chunk is converted without seeing the others, so a later chunk may
+    promote its first heading to a level above the document's top level. The
+    first chunk with headings sets the base level; any later chunk whose
+    shallowest heading is above it is shifted down. Chunks are fed in order
+    through apply(), so the same normalizer works for streamed output.
+    """
+    
+    HEADING_RE = re.compile(r'^(#{1,6})(\s)', re.MULTILINE)
+    
+    def __init__(self):
+        self.base = None
+    
+    def apply(self, chunk):
+        levels = [len(m.group(1)) for m in self.HEADING_RE.finditer(chunk)]
+        if not levels:
+            return chunk
+        level = min(levels)
+        if self.base is None:
+            self.base = level
+        elif level < self.base:
+            shift = self.base - level
+            chunk = self.HEADING_RE.sub(lambda m: '#' * min(6, len(m.group(1)) + shift) + m.group(2), chunk)
+        return chunk
+
+class MarkdownChunker:
+    """Split Markdown into chunks that fit a token budget, cutting only between blocks
+    
+    Blocks are paragraphs, headings, lists, tables and fenced code blocks; a
+    PAGE_BREAK also ends a block. Blocks are packed in order while they fit, and
+    a heading is carried over rather than left at the end of a chunk. A block
+    larger than the budget is split between lines, repeating a table's header or
+    a code block's fences in the LLM request for every piece; a single line that
+    is still too long is split between words. Chunks are kept as offsets into
+    the source text, so replies can be spliced back without disturbing the text
+    around them.
+    
+    Tokens are counted with tiktoken when it is installed, otherwise estimated
+    at four characters per token.
+    """
+    
+    FENCE_RE = re.compile(r'^\s*(```|~~~)')
+    TABLE_SEPARATOR_RE = re.compile(r'^\s*\|?\s*:?-{3,}')
+    
+    def __init__(self, max_tokens=LLM_CHUNK_TOKENS, encoding=LLM_TOKEN_ENCODING):
+        self.max_tokens = max(16, max_tokens)
+        self._encoding = None
+        if importlib.util.find_spec("tiktoken") is not None:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding(encoding)
+        self.tokenizer = f"tiktoken/{encoding}" if self._encoding else "estimate (4 chars/token)"
+    
+    def count(self, text):
+        """Number of tokens in text"""
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return (len(text) + 3) // 4
+    
+    def blocks(self, text):
+        """Split text into Markdown blocks, keeping fenced code blocks whole"""
+        return [text[start:end] for start, end in self._block_spans(text)]
+    
+    def _block_spans(self, text):
+        """(start, end) offsets of each Markdown block in text"""
+        spans = []
+        page_start = 0
+        for page in text.split(PAGE_BREAK):
+            start = end = None
+            in_fence = False
+            offset = page_start
+            for line in page.split("\n"):
+                if self.FENCE_RE.match(line):
+                    in_fence = not in_fence
+                if not line.strip() and not in_fence:
+                    if start is not None:
+                        spans.append((start, end))
+                        start = None
+                else:
+                    if start is None:
+                        start = offset
+                    end = offset + len(line)
+                offset += len(line) + 1
+            if start is not None:
+                spans.append((start, end))
+            page_start += len(page) + len(PAGE_BREAK)
+        return spans
+    
+    def chunk(self, text):
+        """Pack the blocks of text into chunks of at most max_tokens each, as LLM request text"""
+        return [self.request_text(text, span) for span in self.spans(text)]
+    
+    def request_text(self, text, span):
+        """The text sent to the LLM for a span: its slice, plus any table header or fence repeated for it"""
+        start, end, prefix, suffix = span
+        return prefix + text[start:end].replace(PAGE_BREAK, "\n\n") + suffix
+    
+    def spans(self, text):
+        """Pack the blocks of text into chunks of at most max_tokens each
+        
+        Returns:
+            list: (start, end, prefix, suffix) per chunk. text[start:end] is the
+                  chunk's own slice of text; prefix and suffix are the table
+                  header or code fences repeated from a split block, which belong
+                  in the LLM request only (see strip_repeated).
+        """
+        chunks = []
+        current = []  # (start, end, prefix, suffix) pieces
+        current_tokens = 0
+        for block_start, block_end in self._block_spans(text):
+            tokens = self.count(text[block_start:block_end])
+            pieces = [(block_start, block_end, "", "", tokens)] if tokens <= self.max_tokens else [
+                (start, end, prefix, suffix, self.count(prefix + text[start:end] + suffix))
+                for start, end, prefix, suffix in self._split_block(text, block_start, block_end)]
+            for start, end, prefix, suffix, piece_tokens in pieces:
+                if current and current_tokens + piece_tokens + 1 > self.max_tokens:
+                    # Carry a trailing heading over to the chunk with its content
+                    carried = []
+                    if len(current) > 1 and text[current[-1][0]:current[-1][1]].lstrip().startswith("#"):
+                        carried = [current.pop()]
+                    chunks.append((current[0][0], current[-1][1], current[0][2], current[-1][3]))
+                    current = carried
+                    current_tokens = sum(self.count(text[c[0]:c[1]]) + 1 for c in carried)
+                current.append((start, end, prefix, suffix))
+                current_tokens += piece_tokens + 1
+        if current:
+            chunks.append((current[0][0], current[-1][1], current[0][2], current[-1][3]))
+        return chunks
+    
+    def strip_repeated(self, reply, prefix, suffix):
+        """Remove the repeated table header or fences of a split block from an LLM reply
+        
+        Returns:
+            str: The reply without them, or None when the reply does not start
+                 (or end) with lines of the same kind, so it cannot be trusted
+                 to splice back in
+        """
+        lines = reply.split("\n")
+        head = prefix.split("\n")[:-1] if prefix else []
+        tail = suffix.split("\n")[1:] if suffix else []
+        if len(lines) < len(head) + len(tail):
+            return None
+        for expected, line in zip(head, lines):
+            if self.FENCE_RE.match(expected):
+                matches = self.FENCE_RE.match(line)
+            elif self.TABLE_SEPARATOR_RE.match(expected):
+                matches = self.TABLE_SEPARATOR_RE.match(line)
+            else:
+                matches = line.lstrip().startswith("|")
+            if not matches:
+                return None
+        if tail and not self.FENCE_RE.match(lines[-1]):
+            return None
+        return "\n".join(lines[len(head):len(lines) - len(tail)])
+    
+    def _split_block(self, text, block_start, block_end):
+        """Split an oversized block between lines (and long lines between words)
+        
+        Returns:
+            list: (start, end, prefix, suffix) per piece; the first piece keeps the
+                  block's own header or opening fence and the last its closing
+                  fence, while the others get copies as prefix and suffix
+        """
+        lines = []
+        offset = block_start
+        for line in text[block_start:block_end].split("\n"):
+            lines.append((offset, offset + len(line)))
+            offset += len(line) + 1
+        
+        def line_text(span):
+            return text[span[0]:span[1]]
+        
+        head, tail = [], []
+        if len(lines) > 1 and self.FENCE_RE.match(line_text(lines[0])):
+            head, lines = lines[:1], lines[1:]
+            if self.FENCE_RE.match(line_text(lines[-1])):
+                tail, lines = lines[-1:], lines[:-1]
+        elif (len(lines) > 2 and line_text(lines[0]).lstrip().startswith("|")
+              and self.TABLE_SEPARATOR_RE.match(line_text(lines[1]))):
+            head, lines = lines[:2], lines[2:]
+        head_text = "\n".join(line_text(span) for span in head)
+        tail_text = "\n".join(line_text(span) for span in tail)
+        budget = max(8, self.max_tokens - self.count(head_text + tail_text) - 2)
+        
+        pieces = []
+        current = []
+        current_tokens = 0
+        for line_start, line_end in lines:
+            tokens = self.count(text[line_start:line_end])
+            parts = [(line_start, line_end, tokens)] if tokens <= budget else [
+                (line_start + start, line_start + end, self.count(text[line_start + start:line_start + end]))
+                for start, end in self._split_line(text[line_start:line_end], budget)]
+            for start, end, part_tokens in parts:
+                if current and current_tokens + part_tokens + 1 > budget:
+                    pieces.append((current[0], current[-1]))
+                    current = []
+                    current_tokens = 0
+                current.append((start, end))
+                current_tokens += part_tokens + 1
+        if current:
+            pieces.append((current[0], current[-1]))
+        if not pieces:
+            return [(block_start, block_end, "", "")]
+        
+        spans = []
+        for index, (first, last) in enumerate(pieces):
+            is_first, is_last = index == 0, index == len(pieces) - 1
+            spans.append((
+                block_start if is_first else first[0],
+                block_end if is_last else last[1],
+                "" if is_first or not head else head_text + "\n",
+                "" if is_last or not tail else "\n" + tail_text,
+            ))
+        return spans
+    
+    def _split_line(self, line, budget):
+        """(start, end) offsets of parts of line, split between words, each within budget"""
+        parts = []
+        start = end = None
+        for match in re.finditer(r'\S+', line):
+            word_start, word_end = match.span()
+            if start is not None and self.count(line[start:word_end]) > budget:
+                parts.append((start, end))
+                start = None
+            while self.count(line[word_start:word_end]) > budget:
+                # A single "word" over the budget (e.g. base64): cut it by characters
+                word = line[word_start:word_end]
+                cut = max(1, len(word) * budget // self.count(word))
+                parts.append((word_start, word_start + cut))
+                word_start += cut
+            if start is None:
+                start = word_start if parts else 0
+            end = word_end
+        if start is not None:
+            parts.append((start, end))
+        return parts
+
+class MarkdownLinter:
+    """Fast local checks for the Markdown problems LLM enhancement is meant to fix
+    
+    Reports tables whose separator row is missing or whose rows have a different
+    number of cells than the header, image links that point at missing local
+    files, headings that skip a level or lack the space after the #s, and
+    unclosed code fences. Heading levels carry over between calls to check(),
+    so chunks of one document are checked in order with the same linter.
+    """
+    
+    HEADING_RE = re.compile(r'^(#{1,6})(\s|$)')
+    BAD_HEADING_RE = re.compile(r'^#{1,6}[^#\s]')
+    IMAGE_RE = re.compile(r'!\[[^\]]*\]\(([^)\s]*)')
+    
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.heading_level = None
+    
+    def check(self, text):
+        """Return a list of human-readable issues found in text"""
+        issues = []
+        in_fence = False
+        table = []
+        for line in text.split("\n") + [""]:
+            if MarkdownChunker.FENCE_RE.match(line):
+                in_fence = not in_fence
+                continue
+            if in_fence:
+                continue
+            
+            if line.lstrip().startswith("|"):
+                table.append(line)
+                continue
+            if table:
+                issues.extend(self._check_table(table))
+                table = []
+            
+            match = self.HEADING_RE.match(line)
+            if match:
+                level = len(match.group(1))
+                if self.heading_level is not None and level > self.heading_level + 1:
+                    issues.append(f"heading level jumps from {self.heading_level} to {level}: {line[:60]}")
+                self.heading_level = level
+            elif self.BAD_HEADING_RE.match(line):
+                issues.append(f"heading without a space after #: {line[:60]}")
+            
+            for path in self.IMAGE_RE.findall(line):
+                if not path or "placeholder" in path.lower():
+                    issues.append(f"image link without a target: {line[:60]}")
+                elif not re.match(r'^[a-z][a-z0-9+.-]*:', path, re.IGNORECASE) and not os.path.exists(
+                        os.path.join(self.base_dir, path)):
+                    issues.append(f"image file not found: {path}")
+        if in_fence:
+            issues.append("unclosed code fence")
+        return issues
+    
+    def _check_table(self, rows):
+        def cells(row):
+            # Escaped pipes (\|) are cell content, e.g. from Excel cells
+            parts = re.split(r'(?<!\\)\|', row.strip())
+            if parts and not parts[0].strip():
+                parts = parts[1:]
+            if parts and not parts[-1].strip():
+                parts = parts[:-1]
+            return len(parts)
+        
+        if len(rows) < 2 or not MarkdownChunker.TABLE_SEPARATOR_RE.match(rows[1]):
+            return [f"table without a separator row: {rows[0][:60]}"]
+        width = cells(rows[0])
+        uneven = sum(1 for row in rows[1:] if cells(row) != width)
+        if uneven:
+            return [f"table with {uneven} rows not matching its {width} header cells: {rows[0][:60]}"]
+        return []
+
+def file_sha256(path):
+    """Hash a file in 1 MiB reads"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class FileLock:
+    """Cross-process lock held by exclusively creating a lock file
+    
+    Works the same on Windows and POSIX. A lock file older than stale_after
+    seconds is assumed to belong to a crashed process and is removed.
+    """
+    
+    def __init__(self, path, timeout=30.0, stale_after=120.0):
+        self.path = path
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self._fd = None
+    
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                self._fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.stale_after:
+                        os.remove(self.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Timed out waiting for lock {self.path}")
+                time.sleep(0.02)
+    
+    def __exit__(self, *exc):
+        os.close(self._fd)
+        self._fd = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class LLMRateLimiter:
+    """Requests-per-minute and tokens-per-minute token buckets shared by every process
+    
+    Bucket levels live in a small JSON state file guarded by a FileLock, so batch
+    workers, service workers and separate CLI runs using the same file draw from
+    one budget. Enhancement requests leave the last `reserve` share of each
+    bucket to conversion requests, so conversion keeps moving when the budget
+    is tight. A 429 from the API pauses every process until its Retry-After has
+    passed. Either limit may be None (unlimited).
+    """
+    
+    PRIORITIES = ("conversion", "enhancement")
+    
+    def __init__(self, state_path, requests_per_minute=None, tokens_per_minute=None, reserve=0.2):
+        self.state_path = state_path
+        self.lock_path = state_path + ".lock"
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.reserve = reserve
+        # Queueing delay seen by this process: priority -> [waits, seconds waited, longest wait]
+        self.delays = {priority: [0, 0.0, 0.0] for priority in self.PRIORITIES}
+        os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+    
+    async def acquire(self, tokens, priority="conversion"):
+        """Wait until a request of about `tokens` tokens fits the budget
+        
+        Returns:
+            float: Seconds spent waiting
+        """
+        start = time.monotonic()
+        while True:
+            wait = await asyncio.to_thread(self._take, tokens, priority)
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+        waited = time.monotonic() - start
+        delay = self.delays[priority]
+        delay[0] += 1
+        delay[1] += waited
+        delay[2] = max(delay[2], waited)
+        return waited
+    
+    def _take(self, tokens, priority):
+        """Take one request and `tokens` tokens if available; otherwise return seconds to wait"""
+        with FileLock(self.lock_path):
+            state = self._load()
+            now = time.time()
+            if state.get("paused_until", 0) > now:
+                return state["paused_until"] - now
+            
+            wait = 0.0
+            wanted = {"requests": 1, "tokens": tokens}
+            for name, limit in self.limits.items():
+                if not limit:
+                    continue
+                floor = limit * self.reserve if priority != "conversion" else 0.0
+                # A request bigger than the bucket could never fit; let it run once the bucket is full
+                need = min(wanted[name], limit - floor)
+                if state[name] - need < floor:
+                    wait = max(wait, (floor + need - state[name]) * 60.0 / limit)
+            if not wait:
+                for name, limit in self.limits.items():
+                    if limit:
+                        state[name] -= wanted[name]
+            self._save(state)
+            return max(wait, 0.05) if wait else 0.0
+    
+    def settle(self, estimated_tokens, actual_tokens):
+        """Charge the difference between a request's estimated and reported token use"""
+        if not self.limits["tokens"] or actual_tokens == estimated_tokens:
+            return
+        with FileLock(self.lock_path):
+            state = self._load()
+            state["tokens"] -= actual_tokens - estimated_tokens
+            self._save(state)
+    
+    def pause(self, seconds):
+        """Hold every process sharing the state file for `seconds` (after a 429)"""
+        with FileLock(self.lock_path):
+            state = self._load()
+            state["paused_until"] = max(state.get("paused_until", 0), time.time() + seconds)
+            self._save(state)
+    
+    def _load(self):
+        """Read the buckets and refill them for the time since the last update (lock held)"""
+        now = time.time()
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = {"updated": now}
+        elapsed = max(0.0, now - state.get("updated", now))
+        for name, limit in self.limits.items():
+            if limit:
+                level = state.get(name, limit)
+                state[name] = min(limit, level + elapsed * limit / 60.0)
+        state["updated"] = now
+        return state
+    
+    def _save(self, state):
+        with open(self.state_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+
+class ConversionManifest:
+    """JSON record of what was converted, from what, and with which settings
+    
+    Each entry is keyed by the absolute source path and stores the source hash,
+    size and mtime, the converter version, the output options, the artifacts
+    written (relative to the output directory) and, for PDFs, one hash per page
+    and its images. Entries are separate files under manifest_dir, sharded by
+    the hash of their key, so reading or recording one document costs the same
+    however many are recorded. Each file is replaced atomically and no lock is
+    shared, so batch workers record results concurrently.
+    """
+    
+    def __init__(self, manifest_dir):
+        self.manifest_dir = manifest_dir
+    
+    @staticmethod
+    def key(source_path):
+        return os.path.abspath(source_path)
+    
+    def _entry_path(self, source_path):
+        digest = hashlib.sha256(self.key(source_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.manifest_dir, digest[:2], digest + ".json")
+    
+    def get(self, source_path):
+        try:
+            with open(self._entry_path(source_path), 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        # A full key comparison guards against (improbable) hash prefix collisions
+        return record["entry"] if record.get("source") == self.key(source_path) else None
+    
+    def record(self, source_path, entry):
+        path = self._entry_path(source_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"source": self.key(source_path), "entry": entry}, f)
+        os.replace(tmp_path, path)
+
+# Script run by MarkitdownWorker: converts one JSON request per stdin line, answers on stdout
+MARKITDOWN_WORKER_SCRIPT = '''
+import sys, json
+# Replies go to the real stdout; anything the libraries print is sent to stderr instead
+replies = sys.stdout
+sys.stdout = sys.stderr
+from markitdown import MarkItDown
+converter = MarkItDown()
+for line in sys.stdin:
+    request = json.loads(line)
+    try:
+        result = converter.convert(request["input"], keep_data_uris=True)
+        markdown = getattr(result, "markdown", None) or result.text_content
+        with open(request["output"], "w", encoding="utf-8") as f:
+            f.write(markdown)
+        reply = {"ok": True}
+    except Exception as e:
+        reply = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+    replies.write(json.dumps(reply) + "\\n")
+    replies.flush()
+'''
+
+class MarkitdownWorker:
+    """Long-lived markitdown process fed conversion requests over a pipe
+    
+    markitdown is imported once when the worker starts instead of once per file.
+    The worker can run under a different interpreter than the converter (for
+    example one where markitdown is installed), and a crash in a converter
+    library only takes down the worker, which is restarted on the next request.
+    """
+    
+    def __init__(self, python=None):
+        self.python = python or sys.executable
+        self.process = None
+        self._lock = threading.Lock()
+    
+    def _start(self):
+        self.process = subprocess.Popen(
+            [self.python, "-c", MARKITDOWN_WORKER_SCRIPT],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, encoding='utf-8',
+        )
+    
+    def convert(self, input_path, output_path):
+        """Convert one file; raises RuntimeError with the worker's error message on failure"""
+        request = json.dumps({"input": os.path.abspath(input_path), "output": os.path.abspath(output_path)})
+        with self._lock:
+            if self.process is None or self.process.poll() is not None:
+                self._start()
+            self.process.stdin.write(request + "\n")
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        
+        if not line:
+            self.close()
+            raise RuntimeError("markitdown worker exited unexpectedly")
+        reply = json.loads(line)
+        if not reply["ok"]:
+            raise RuntimeError(reply["error"])
+    
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except Exception:
+                self.process.kill()
+            self.process = None
+
+class MarkdownDocument:
+    """A converted Markdown document held in memory while post-processing stages run
+    
+    The file at path is read once when the document is created and written once
+    by save(), however many stages change content in between.
+    """
+    
+    def __init__(self, path, source_path=None):
+        self.path = path
+        self.source_path = source_path
+        with open(path, 'r', encoding='utf-8') as f:
+            self.content = f.read()
+        self.stage_timings = {}
+    
+    def save(self):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(self.content)
+
+class PostProcessingPipeline:
+    """Ordered post-processing stages run over one in-memory MarkdownDocument
+    
+    Each stage is a callable taking the document and updating document.content in
+    place. A stage can be given a condition (a callable taking the document) to
+    run only for some documents. Wall time per stage is recorded on the document.
+    """
+    
+    def __init__(self):
+        self.stages = []
+    
+    def register(self, name, stage, condition=None):
+        self.stages.append((name, stage, condition))
+        return self
+    
+    def run(self, document, metrics=None):
+        """Run every applicable stage in order, then write the document once"""
+        for name, stage, condition in self.stages:
+            if condition is not None and not condition(document):
+                continue
+            start = time.perf_counter()
+            if metrics is not None:
+                with metrics.stage("post." + name):
+                    stage(document)
+            else:
+                stage(document)
+            document.stage_timings[name] = time.perf_counter() - start
+        document.save()
+        
+        if document.stage_timings:
+            print("Post-processing: " + ", ".join(
+                f"{name} {seconds:.2f}s" for name, seconds in document.stage_timings.items()))
+        return document
+
+class ConversionMetrics:
+    """Timings and counters for converting one document
+    
+    Stages record wall and CPU time; CPU time is for the whole process, so it
+    includes helper threads but not worker processes. Stage names with a dot
+    (e.g. "pdf.extract") are nested inside another stage. LLM calls record
+    latency, tokens and whether they were served from the cache.
+    """
+    
+    def __init__(self, input_path, format_name):
+        self.record = {
+            "input": input_path,
+            "format": format_name,
+            "bytes_in": os.path.getsize(input_path),
+            "bytes_out": 0,
+            "images": 0,
+            "wall_seconds": 0.0,
+            "cpu_seconds": 0.0,
+            "stages": {},
+            "llm_calls": [],
+        }
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+    
+    @contextmanager
+    def stage(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - wall_start, time.process_time() - cpu_start)
+    
+    def add_stage(self, name, wall, cpu=0.0):
+        """Add time to a stage, for work timed elsewhere (e.g. in worker processes)"""
+        stage = self.record["stages"].setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0})
+        stage["wall_seconds"] += wall
+        stage["cpu_seconds"] += cpu
+        stage["calls"] += 1
+    
+    def llm_call(self, latency, prompt_tokens=0, completion_tokens=0, cached=False, retries=0,
+                 priority="conversion", queue_seconds=0.0):
+        self.record["llm_calls"].append({
+            "latency_seconds": round(latency, 4),
+            "queue_seconds": round(queue_seconds, 4),
+            "priority": priority,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached": cached,
+            "retries": retries,
+        })
+    
+    def outputs(self, paths):
+        """Count the written Markdown file and the images it references"""
+        self.record["bytes_out"] = sum(os.path.getsize(path) for path in paths)
+        self.record["images"] = max(0, len(paths) - 1)
+    
+    def finish(self, status):
+        self.record["status"] = status
+        self.record["wall_seconds"] = time.perf_counter() - self._wall_start
+        self.record["cpu_seconds"] = time.process_time() - self._cpu_start
+        for stage in self.record["stages"].values():
+            stage["wall_seconds"] = round(stage["wall_seconds"], 4)
+            stage["cpu_seconds"] = round(stage["cpu_seconds"], 4)
+        self.record["wall_seconds"] = round(self.record["wall_seconds"], 4)
+        self.record["cpu_seconds"] = round(self.record["cpu_seconds"], 4)
+        return self.record
+
+def write_metrics(path, records, metrics_format="jsonl"):
+    """Write per-document metrics records as JSON lines (appended) or a Prometheus text file
+    
+    The Prometheus file holds totals over records and is replaced atomically, so
+    it can be read by node_exporter's textfile collector.
+    """
+    if metrics_format == "jsonl":
+        with open(path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        return
+    
+    stages = {}
+    llm = {"calls": Counter(), "tokens": Counter(), "latency_sum": 0.0, "latency_count": 0,
+           "queue": Counter(), "queue_count": Counter()}
+    totals = Counter()
+    for record in records:
+        totals["documents_" + record.get("status", "converted")] += 1
+        totals["bytes_in"] += record["bytes_in"]
+        totals["bytes_out"] += record["bytes_out"]
+        totals["images"] += record["images"]
+        for name, stage in record["stages"].items():
+            stage_totals = stages.setdefault(name, Counter())
+            stage_totals["wall"] += stage["wall_seconds"]
+            stage_totals["cpu"] += stage["cpu_seconds"]
+        for call in record["llm_calls"]:
+            llm["calls"]["true" if call["cached"] else "false"] += 1
+            llm["tokens"]["prompt"] += call["prompt_tokens"]
+            llm["tokens"]["completion"] += call["completion_tokens"]
+            llm["latency_sum"] += call["latency_seconds"]
+            llm["latency_count"] += 1
+            llm["queue"][call.get("priority", "conversion")] += call.get("queue_seconds", 0.0)
+            llm["queue_count"][call.get("priority", "conversion")] += 1
+    
+    lines = []
+    
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP doc2md_{name} {help_text}")
+        lines.append(f"# TYPE doc2md_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"doc2md_{name}{labels} {value}")
+    
+    metric("documents_total", "counter", "Documents processed, by status",
+           [(f'{{status="{key[len("documents_"):]}"}}', value)
+            for key, value in sorted(totals.items()) if key.startswith("documents_")])
+    metric("bytes_in_total", "counter", "Bytes of source documents read", [("", totals["bytes_in"])])
+    metric("bytes_out_total", "counter", "Bytes of Markdown and images written", [("", totals["bytes_out"])])
+    metric("images_total", "counter", "Images referenced from converted documents", [("", totals["images"])])
+    metric("stage_seconds_total", "counter", "Wall time per conversion stage",
+           [(f'{{stage="{name}"}}', round(values["wall"], 4)) for name, values in sorted(stages.items())])
+    metric("stage_cpu_seconds_total", "counter", "Process CPU time per conversion stage",
+           [(f'{{stage="{name}"}}', round(values["cpu"], 4)) for name, values in sorted(stages.items())])
+    metric("llm_calls_total", "counter", "LLM requests, by whether the cache answered",
+           [(f'{{cached="{key}"}}', value) for key, value in sorted(llm["calls"].items())])
+    metric("llm_tokens_total", "counter", "LLM tokens reported by the API",
+           [(f'{{kind="{key}"}}', value) for key, value in sorted(llm["tokens"].items())])
+    metric("llm_latency_seconds", "summary", "LLM request latency",
+           [("_sum", round(llm["latency_sum"], 4)), ("_count", llm["latency_count"])])
+    metric("llm_queue_seconds", "summary", "Time LLM requests waited for the shared rate limiter, by priority",
+           [(f'_sum{{priority="{key}"}}', round(value, 4)) for key, value in sorted(llm["queue"].items())]
+           + [(f'_count{{priority="{key}"}}', value) for key, value in sorted(llm["queue_count"].items())])
+    
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temp_path, path)
+
+class FormatHandler:
+    """One document format: how to recognise it and how to convert it
+    
+    Args:
+        name (str): Short format name, e.g. "pdf"
+        extensions (tuple): Lower-case extensions used when no sniffer recognises the content
+        convert: DocumentConverter method name, or a callable taking (converter, input_path, output_path)
+        cost (str): COST_LLM, COST_CPU or COST_IO
+        sniff (callable): Optional test taking (head, path), where head is the first SNIFF_BYTES of the file
+        markitdown (bool): Try markitdown before the handler's own conversion
+    """
+    
+    def __init__(self, name, extensions, convert, cost=COST_CPU, sniff=None, markitdown=True):
+        self.name = name
+        self.extensions = tuple(extensions)
+        self.convert = convert
+        self.cost = cost
+        self.sniff = sniff
+        self.markitdown = markitdown
+    
+    def run(self, converter, input_path, output_path):
+        if isinstance(self.convert, str):
+            return getattr(converter, self.convert)(input_path, output_path)
+        return self.convert(converter, input_path, output_path)
+
+def _zip_has_prefix(path, prefix):
+    """Whether the ZIP archive at path has a member under prefix (OOXML part folders)"""
+    try:
+        with zipfile.ZipFile(path) as archive:
+            return any(name.startswith(prefix) for name in archive.namelist())
+    except (zipfile.BadZipFile, OSError):
+        return False
+
+def _looks_like_html(head):
+    start = head.lstrip(b"\xef\xbb\xbf \t\r\n")[:256].lower()
+    return start.startswith((b"<!doctype html", b"<html")) or (start.startswith(b"<") and b"<html" in start)
+
+# Checked in order: sniffers first, then extensions. register_format_handler puts new
+# handlers at the front, so a third-party handler can take over a built-in format.
+FORMAT_HANDLERS = [
+    FormatHandler("pdf", ('.pdf',), "_convert_pdf", COST_LLM, markitdown=False,
+                  sniff=lambda head, path: head.startswith(b"%PDF-")),
+    FormatHandler("docx", ('.docx',), "_convert_docx", COST_CPU,
+                  sniff=lambda head, path: head.startswith(b"PK") and _zip_has_prefix(path, "word/")),
+    FormatHandler("xlsx", ('.xlsx',), "_convert_excel", COST_CPU,
+                  sniff=lambda head, path: head.startswith(b"PK") and _zip_has_prefix(path, "xl/")),
+    # Legacy binary Office files: markitdown can read .xls, nothing here can read .doc
+    FormatHandler("xls", ('.xls',), "_convert_legacy_office", COST_CPU,
+                  sniff=lambda head, path: head.startswith(OLE2_MAGIC) and (
+                      path.lower().endswith('.xls') or "Workbook".encode("utf-16-le") in head)),
+    FormatHandler("doc", ('.doc',), "_convert_legacy_office", COST_CPU, markitdown=False,
+                  sniff=lambda head, path: head.startswith(OLE2_MAGIC)),
+    FormatHandler("html", ('.html', '.htm'), "_convert_html", COST_LLM,
+                  sniff=lambda head, path: _looks_like_html(head)),
+    FormatHandler("text", ('.md', '.markdown', '.txt'), "_process_text", COST_IO),
+]
+
+def register_format_handler(handler):
+    """Add a FormatHandler, taking precedence over the handlers already registered"""
+    FORMAT_HANDLERS.insert(0, handler)
+    return handler
+
+def supported_extensions():
+    """File extensions picked up when a directory or glob is given on the command line"""
+    return tuple(ext for handler in FORMAT_HANDLERS for ext in handler.extensions)
+
+def detect_format(path):
+    """Find the FormatHandler for a file from its leading bytes, falling back to its extension
+    
+    Raises:
+        ValueError: No handler recognises the content or the extension
+    """
+    with open(path, 'rb') as f:
+        head = f.read(SNIFF_BYTES)
+    for handler in FORMAT_HANDLERS:
+        if handler.sniff is not None and handler.sniff(head, path):
+            return handler
+    
+    file_extension = os.path.splitext(path)[1].lower()
+    for handler in FORMAT_HANDLERS:
+        if file_extension in handler.extensions:
+            return handler
+    raise ValueError(f"Unsupported file format: {file_extension or path}")
+
+def cache_entries(directory, suffixes):
+    """Yield (path, mtime, size) for every file under directory ending in one of suffixes"""
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.endswith(suffixes):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+def evict_lru(directory, max_bytes, suffixes):
+    """Delete the least recently used cache files under directory until they fit in max_bytes
+    
+    Recency is the file mtime, which the caches refresh with os.utime on every hit.
+    
+    Returns:
+        int: Bytes the remaining files take up
+    """
+    entries = sorted(cache_entries(directory, suffixes), key=lambda entry: entry[1])
+    total = sum(size for _, _, size in entries)
+    for path, _, size in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+    return total
+
+class LLMResponseCache:
+    """Persistent on-disk cache of LLM replies keyed by a hash of the request
+    
+    Each reply is stored as its own JSON file named by the SHA-256 of
+    (model, system prompt, user prompt), so identical chunks are only ever paid
+    for once. File mtimes track recency and the least recently used entries are
+    evicted once the cache grows past max_bytes.
+    """
+    
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+    
+    @staticmethod
+    def make_key(model, system_prompt, user_prompt):
+        payload = json.dumps([model, system_prompt, user_prompt], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+    
+    def _entries(self):
+        return cache_entries(self.cache_dir, (".json",))
+    
+    def get(self, key):
+        """Return the cached reply for key, or None on a miss"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                reply = json.load(f)["reply"]
+            os.utime(path)  # mark as recently used
+        except (FileNotFoundError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return reply
+    
+    def put(self, key, reply):
+        """Store a reply, evicting least recently used entries if the cache is full"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({"reply": reply}, ensure_ascii=False).encode('utf-8')
+        
+        # Write to a temp file first so concurrent readers never see a partial entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        
+        with self._lock:
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+    
+    def _evict(self):
+        # Drop the oldest entries until the cache is back under 90% of its cap
+        self._size = evict_lru(self.cache_dir, self.max_bytes * 0.9, (".json",))
+    
+    def prune(self):
+        """Trim the cache to max_bytes and return the bytes it still holds"""
+        with self._lock:
+            self._size = evict_lru(self.cache_dir, self.max_bytes, (".json",))
+            return self._size
+    
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes": self._size}
+
+class ImageStore:
+    """Content-addressed image files shared by every document in an output directory
+    
+    Each image is kept once in store_dir under a name derived from the SHA-256
+    of its bytes, and hard-linked into the images directory of each document
+    that uses it (copied where the filesystem cannot link). Files enter the
+    store by atomic rename, so documents converted in parallel never overwrite
+    each other's images, and two writers of the same image produce the same file.
+    """
+    
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+    
+    @staticmethod
+    def filename_for(digest, ext):
+        return f"image_{digest[:16]}.{ext}"
+    
+    def temp_path(self, suffix=".tmp"):
+        """A unique path in the store directory for writing an image before add_file"""
+        return os.path.join(self.store_dir, f".tmp-{os.getpid()}-{threading.get_ident()}-{time.time_ns()}{suffix}")
+    
+    def add_bytes(self, data, ext):
+        """Store image bytes and return the image's filename"""
+        return self.add_pieces(hashlib.sha256(data).hexdigest(), ext, [data])
+    
+    def add_pieces(self, digest, ext, pieces):
+        """Store an image given as byte pieces whose SHA-256 hex digest is already known"""
+        img_filename = self.filename_for(digest, ext)
+        if not os.path.exists(os.path.join(self.store_dir, img_filename)):
+            tmp_path = self.temp_path()
+            with open(tmp_path, 'wb') as f:
+                for piece in pieces:
+                    f.write(piece)
+            os.replace(tmp_path, os.path.join(self.store_dir, img_filename))
+        return img_filename
+    
+    def add_file(self, path, ext, digest=None, move=False):
+        """Store the image at path (moved when move is set, e.g. a temp_path) and return its filename"""
+        img_filename = self.filename_for(digest or file_sha256(path), ext)
+        store_path = os.path.join(self.store_dir, img_filename)
+        if os.path.exists(store_path):
+            if move:
+                os.remove(path)  # Already stored by an earlier document
+        elif move:
+            os.replace(path, store_path)
+        else:
+            tmp_path = self.temp_path()
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, store_path)
+        return img_filename
+    
+    def link(self, img_filename, images_dir):
+        """Hard-link a stored image into a document's images directory
+        
+        Returns:
+            bool: False when the image is not in the store
+        """
+        store_path = os.path.join(self.store_dir, img_filename)
+        if not os.path.exists(store_path):
+            return False
+        target = os.path.join(images_dir, img_filename)
+        if not os.path.exists(target):
+            os.makedirs(images_dir, exist_ok=True)
+            try:
+                os.link(store_path, target)
+            except FileExistsError:
+                pass
+            except OSError:
+                # No hard links here (e.g. another device or a FAT volume), so copy instead
+                shutil.copyfile(store_path, target)
+        return True
+    
+    def prune(self, min_age=3600):
+        """Delete stored images that no document links to any more
+        
+        A store file with a single link is only referenced by the store itself
+        (documents that had to copy an image keep their own copy). Files newer
+        than min_age seconds are kept, as a running conversion may be about to
+        link them; abandoned temp files from interrupted writers go the same way.
+        
+        Returns:
+            int: Number of files removed
+        """
+        removed = 0
+        cutoff = time.time() - min_age
+        for entry in os.scandir(self.store_dir):
+            try:
+                stat = entry.stat()
+                if stat.st_nlink == 1 and stat.st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+class RemoteImageFetcher:
+    """Download remote images concurrently over a shared connection pool
+    
+    Downloads run on a thread pool with a per-host concurrency limit, connect and
+    read timeouts, and a cap on the bytes read per image. Images go into an
+    ImageStore, so the same image served from different URLs or needed by
+    different documents is stored once, and URLs already fetched by this
+    fetcher are not requested again (failures are retried next time; at most
+    max_cached_urls successes are remembered). Callers link the returned
+    filenames into their document's images directory.
+    """
+    
+    # Extensions for the image content types servers commonly send
+    CONTENT_TYPE_EXTENSIONS = {
+        'image/png': 'png', 'image/jpeg': 'jpg', 'image/jpg': 'jpg', 'image/gif': 'gif',
+        'image/webp': 'webp', 'image/svg+xml': 'svg', 'image/bmp': 'bmp', 'image/tiff': 'tiff',
+    }
+    
+    def __init__(self, image_store, max_workers=8, per_host_limit=4, timeout=(5.0, 30.0),
+                 max_bytes=20 * 1024 * 1024, max_cached_urls=10000):
+        self.image_store = image_store
+        self.max_cached_urls = max_cached_urls
+        self.max_workers = max_workers
+        self.per_host_limit = per_host_limit
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        
+        self.session = requests.Session()
+        adapter = requests_adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-fetch")
+        
+        self._url_files = {}
+        self._host_limits = {}
+        self._lock = threading.Lock()
+    
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+    
+    def fetch_all(self, urls):
+        """Fetch several image URLs concurrently
+        
+        Returns:
+            dict: url -> saved filename, or None for images that could not be fetched
+        """
+        urls = list(dict.fromkeys(urls))
+        return dict(zip(urls, self.executor.map(self.fetch, urls)))
+    
+    def fetch(self, url):
+        """Fetch one image URL and return its saved filename, or None on failure"""
+        with self._lock:
+            if url in self._url_files:
+                return self._url_files[url]
+            host = urlsplit(url).netloc
+            host_limit = self._host_limits.setdefault(host, threading.Semaphore(self.per_host_limit))
+        
+        try:
+            with host_limit:
+                img_filename = self._download(url)
+        except Exception as e:
+            print(f"Error downloading image {url}: {e}")
+            img_filename = None
+        
+        # Only successes are remembered, so a timeout in a long-lived worker is retried later
+        if img_filename:
+            with self._lock:
+                self._url_files[url] = img_filename
+                while len(self._url_files) > self.max_cached_urls:
+                    del self._url_files[next(iter(self._url_files))]  # Oldest first
+        return img_filename
+    
+    def _download(self, url):
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            if response.status_code != 200:
+                print(f"Error downloading image {url}: HTTP {response.status_code}")
+                return None
+            
+            declared = response.headers.get('Content-Length')
+            if declared and declared.isdigit() and int(declared) > self.max_bytes:
+                print(f"Skipping image {url}: {declared} bytes exceeds the {self.max_bytes} byte limit")
+                return None
+            
+            # Read in pieces so an oversized image is abandoned without being buffered whole
+            digest = hashlib.sha256()
+            pieces = []
+            size = 0
+            for piece in response.iter_content(chunk_size=64 * 1024):
+                size += len(piece)
+                if size > self.max_bytes:
+                    print(f"Skipping image {url}: larger than the {self.max_bytes} byte limit")
+                    return None
+                digest.update(piece)
+                pieces.append(piece)
+            
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        
+        img_ext = self.CONTENT_TYPE_EXTENSIONS.get(content_type)
+        if not img_ext:
+            img_ext = urlsplit(url).path.rsplit('.', 1)[-1].lower()
+            if len(img_ext) > 5 or '/' in img_ext:  # Not a valid extension
+                img_ext = 'png'
+        
+        return self.image_store.add_pieces(digest.hexdigest(), img_ext, pieces)
+
+class PdfLayoutAnalyzer:
+    """Recover Markdown structure for one PDF page from PyMuPDF's get_text("dict") spans
+    
+    Headings are lines set noticeably larger than the page's body text, or short
+    bold lines at body size. List items are recognised by bullet and number
+    prefixes, and tables by runs of rows whose cells start in the same columns
+    and look like cells: mostly short or numeric, or ragged in length. Aligned
+    runs of long, even lines are side-by-side prose columns; they are read
+    column by column instead.
+    
+    Each page also gets a confidence score: the share of its characters whose
+    role was clear. Text slightly larger than body text, rotated lines, stray
+    multi-cell rows and multi-column prose count against it, so such pages are
+    left to the LLM.
+    """
+    
+    BOLD_FLAG = 16
+    BULLET_RE = re.compile(r'^[\u2022\u25e6\u25aa\u25cf\u2013*-]\s+')
+    NUMBERED_RE = re.compile(r'^\(?(\d{1,3})[.)]\s+')
+    # (size / body size, heading level), largest first
+    HEADING_RATIOS = ((1.6, 1), (1.3, 2), (1.15, 3))
+    AMBIGUOUS_RATIO = 1.05
+    COLUMN_TOLERANCE = 6.0  # points
+    MAX_CELL_CHARS = 60
+    SHORT_CELL_CHARS = 25
+    NUMERIC_CELL_RE = re.compile(r'^[(\-+−]?[$€£]?[\d.,:/%\s-]+[)%]?$')
+    
+    def analyze(self, page_dict):
+        """Build Markdown for a page
+        
+        Returns:
+            tuple: (markdown, plain text in reading order, confidence from 0 to 1)
+        """
+        lines = self._lines(page_dict)
+        plain_text = "\n".join(line["text"] for line in lines)
+        total_chars = sum(len(line["text"]) for line in lines)
+        if not total_chars:
+            return "", plain_text, 0.0
+        
+        sizes = Counter()
+        for line in lines:
+            sizes[round(line["size"], 1)] += len(line["text"])
+        body_size = sizes.most_common(1)[0][0]
+        
+        blocks = []
+        unclear_chars = 0
+        rows = self._rows(lines)
+        i = 0
+        while i < len(rows):
+            table_end = self._table_end(rows, i)
+            if table_end - i >= 2:
+                table_rows = rows[i:table_end]
+                if self._is_table(table_rows):
+                    blocks.append(("table", self._table_markdown(table_rows), None))
+                    i = table_end
+                    continue
+                # Aligned but not table-like: prose columns side by side, read one column at a time
+                run_lines = [row[column] for column in range(len(table_rows[0])) for row in table_rows]
+            else:
+                table_end = i + 1
+                run_lines = rows[i]
+            
+            # Multi-cell rows outside a table are stray columns or multi-column prose;
+            # their reading order is a guess, so they count as unclear
+            multi_cell = len(rows[i]) > 1
+            for line in run_lines:
+                kind, text = self._classify(line, body_size)
+                if kind == "unclear" or multi_cell:
+                    unclear_chars += len(text)
+                blocks.append(("body" if kind == "unclear" else kind, text, line))
+            i = table_end
+        
+        confidence = max(0.0, 1.0 - unclear_chars / total_chars)
+        return self._join_blocks(blocks), plain_text, round(confidence, 3)
+    
+    def _lines(self, page_dict):
+        lines = []
+        for block_num, block in enumerate(page_dict.get("blocks", [])):
+            if block.get("type") != 0:
+                continue
+            for line in block.get("lines", []):
+                spans = [span for span in line["spans"] if span["text"].strip()]
+                if not spans:
+                    continue
+                text = "".join(span["text"] for span in line["spans"]).strip()
+                main_span = max(spans, key=lambda span: len(span["text"]))
+                x0, y0, x1, y1 = line["bbox"]
+                lines.append({
+                    "text": text,
+                    "size": main_span["size"],
+                    "bold": all(span["flags"] & self.BOLD_FLAG or "bold" in span["font"].lower()
+                                for span in spans),
+                    "rotated": abs(line.get("dir", (1.0, 0.0))[1]) > 0.01,
+                    "block": block_num,
+                    "x0": x0, "y0": y0, "x1": x1, "y1": y1,
+                })
+        return lines
+    
+    def _rows(self, lines):
+        """Group lines that share a baseline band into rows, each sorted left to right"""
+        rows = []
+        for line in sorted(lines, key=lambda line: (line["y0"], line["x0"])):
+            center = (line["y0"] + line["y1"]) / 2
+            if rows and rows[-1][0]["y0"] <= center <= rows[-1][0]["y1"]:
+                rows[-1].append(line)
+            else:
+                rows.append([line])
+        return [sorted(row, key=lambda line: line["x0"]) for row in rows]
+    
+    def _table_end(self, rows, start):
+        """Index after the run of rows from start whose cells line up with rows[start]"""
+        first = rows[start]
+        if len(first) < 2:
+            return start
+        end = start + 1
+        while end < len(rows) and len(rows[end]) == len(first) and all(
+                abs(cell["x0"] - ref["x0"]) <= self.COLUMN_TOLERANCE
+                or abs(cell["x1"] - ref["x1"]) <= self.COLUMN_TOLERANCE
+                for cell, ref in zip(rows[end], first)):
+            end += 1
+        return end
+    
+    def _is_table(self, rows):
+        """Whether aligned rows hold table cells rather than lines of side-by-side prose columns
+        
+        Cells must be short or mostly numeric, or vary in length within a
+        column. Long, even lines are typical of justified prose. When each
+        column is a single PyMuPDF block spanning the whole run, it is a text
+        column, and only short or numeric cells count as evidence.
+        """
+        cells = [cell["text"] for row in rows for cell in row]
+        if sum(len(cell) for cell in cells) / len(cells) > self.MAX_CELL_CHARS:
+            return False
+        short = sum(len(cell) <= self.SHORT_CELL_CHARS for cell in cells) / len(cells)
+        numeric = sum(bool(self.NUMERIC_CELL_RE.match(cell)) for cell in cells) / len(cells)
+        if short >= 0.6 or numeric >= 0.3:
+            return True
+        
+        columns = list(zip(*rows))
+        if all(len({cell["block"] for cell in column}) == 1 for column in columns):
+            return False
+        
+        # Ragged: some column's cell lengths vary widely (coefficient of variation over 0.5)
+        for column in columns:
+            lengths = [len(cell["text"]) for cell in column]
+            mean = sum(lengths) / len(lengths)
+            variance = sum((length - mean) ** 2 for length in lengths) / len(lengths)
+            if mean and variance ** 0.5 / mean > 0.5:
+                return True
+        return False
+    
+    def _classify(self, line, body_size):
+        """Return (kind, text) for a line: heading level, list item, body or unclear"""
+        text = line["text"]
+        if line["rotated"]:
+            return "unclear", text
+        
+        ratio = line["size"] / body_size if body_size else 1.0
+        if len(text) <= 200:
+            for min_ratio, level in self.HEADING_RATIOS:
+                if ratio >= min_ratio:
+                    return f"h{level}", text
+        if self.BULLET_RE.match(text):
+            return "list", "- " + self.BULLET_RE.sub("", text, count=1)
+        match = self.NUMBERED_RE.match(text)
+        if match:
+            return "list", f"{match.group(1)}. " + text[match.end():]
+        if line["bold"] and len(text) <= 100 and not text.endswith(('.', ',', ';', ':')):
+            return "h3", text
+        if ratio >= self.AMBIGUOUS_RATIO:
+            return "unclear", text
+        return "body", text
+    
+    def _table_markdown(self, rows):
+        def cell_text(cell):
+            return cell["text"].replace("|", "\\|")
+        
+        header = "| " + " | ".join(cell_text(cell) for cell in rows[0]) + " |"
+        separator = "| " + " | ".join("---" for _ in rows[0]) + " |"
+        body = ["| " + " | ".join(cell_text(cell) for cell in row) + " |" for row in rows[1:]]
+        return "\n".join([header, separator] + body)
+    
+    def _join_blocks(self, blocks):
+        """Merge lines into paragraphs, list items and headings, and join them as Markdown"""
+        parts = []
+        previous = None  # (kind, source line) of the last line merged into parts[-1]
+        for kind, text, line in blocks:
+            same_block = (previous is not None and line is not None and previous[1] is not None
+                          and previous[1]["block"] == line["block"])
+            
+            if kind == "body" and same_block and previous[0] in ("body", "list"):
+                # Continuation of a paragraph or a wrapped list item
+                joined = parts[-1][1]
+                if joined.endswith("-") and text[:1].islower():
+                    parts[-1] = (parts[-1][0], joined[:-1] + text)
+                else:
+                    parts[-1] = (parts[-1][0], joined + " " + text)
+            elif kind.startswith("h") and same_block and previous[0] == kind:
+                parts[-1] = (kind, parts[-1][1] + " " + text)  # Heading wrapped onto two lines
+            else:
+                parts.append((kind, text))
+            previous = (kind, line)
+        
+        output = []
+        for index, (kind, text) in enumerate(parts):
+            if kind.startswith("h") and kind[1:].isdigit():
+                text = "#" * int(kind[1:]) + " " + text
+            if output and not (kind == "list" and parts[index - 1][0] == "list"):
+                output.append("\n\n")
+            elif output:
+                output.append("\n")
+            output.append(text)
+        return "".join(output)
+
+def _extract_pdf_page_images(pdf_path, page_numbers, xref_owners, store_dir, images_dir, dpi, image_format,
+                             previous_pages=None):
+    """Save the images for a range of PDF pages; runs in a worker process
+    
+    Each embedded image (xref) is only extracted by the page listed as its owner in
+    xref_owners, so an image shared by many pages is written once. Pages without
+    embedded images are rendered at the given DPI instead. Images go into the
+    ImageStore at store_dir and are linked into images_dir. previous_pages maps
+    unchanged pages to their image filenames from an earlier run, which are
+    relinked from the store instead of extracted again.
+    
+    Returns:
+        dict: page number -> list of ("image" or "page", filename) entries
+    """
+    image_store = ImageStore(store_dir)
+    previous_pages = previous_pages or {}
+    pdf_document = fitz.open(pdf_path)
+    results = {}
+    try:
+        for page_num in page_numbers:
+            previous = previous_pages.get(page_num)
+            if previous is not None and all(image_store.link(filename, images_dir) for _, filename in previous):
+                results[page_num] = [tuple(entry) for entry in previous]
+                continue
+            
+            page = pdf_document[page_num]
+            image_list = page.get_images(full=True)
+            entries = []
+            
+            if image_list:
+                for img_info in image_list:
+                    xref = img_info[0]
+                    if xref_owners.get(xref) != page_num:
+                        continue
+                    try:
+                        base_img = pdf_document.extract_image(xref)
+                        img_filename = image_store.add_bytes(base_img["image"], base_img["ext"])
+                        image_store.link(img_filename, images_dir)
+                        print(f"Extracted image to {os.path.join(images_dir, img_filename)}")
+                        entries.append(("image", img_filename))
+                    except Exception as e:
+                        print(f"Error saving image: {e}")
+            else:
+                # If no vector images, render the page as an image
+                tmp_path = image_store.temp_path("." + image_format)
+                try:
+                    page.get_pixmap(dpi=dpi, alpha=False).save(tmp_path)
+                    img_filename = image_store.add_file(tmp_path, image_format, move=True)
+                    image_store.link(img_filename, images_dir)
+                    print(f"Rendered page {page_num+1} as image: {os.path.join(images_dir, img_filename)}")
+                    entries.append(("page", img_filename))
+                except Exception as e:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    print(f"Error saving page image: {e}")
+            
+            results[page_num] = entries
+    finally:
+        pdf_document.close()
+    return results
+
+def _ocr_pdf_page(pdf_path, page_num, dpi, lang, cache_dir):
+    """Rasterise one PDF page in grayscale and OCR it; runs in a worker process
+    
+    The OCR text is cached under the SHA-256 of the rendered pixels and the
+    language, so a page image seen before (in this or another document) skips
+    tesseract entirely. A hit refreshes the file's mtime, which the page
+    cache's least-recently-used eviction goes by.
+    
+    Returns:
+        tuple: (text, seconds, cached)
+    """
+    start = time.perf_counter()
+    pdf_document = fitz.open(pdf_path)
+    try:
+        pixmap = pdf_document[page_num].get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+    finally:
+        pdf_document.close()
+    
+    digest = hashlib.sha256(f"{lang}:{pixmap.width}x{pixmap.height}:".encode('utf-8'))
+    digest.update(pixmap.samples)
+    cache_path = os.path.join(cache_dir, digest.hexdigest() + ".txt")
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        os.utime(cache_path)  # mark as recently used
+        return text, time.perf_counter() - start, True
+    except FileNotFoundError:
+        pass
+    
+    image = PIL_Image.frombytes("L", (pixmap.width, pixmap.height), pixmap.samples)
+    text = pytesseract.image_to_string(image, lang=lang)
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return text, time.perf_counter() - start, False
 
 class DocumentConverter:
-    def __init__(self, openrouter_api_key, site_url="Your Website", site_name="Document Converter"):
-        self.output_dir = "markdown_output"
+    def __init__(self, openrouter_api_key, site_url="Your Website", site_name="Document Converter",
+                 output_dir="markdown_output", base_url="https://openrouter.ai/api/v1",
+                 llm_concurrency=4, llm_max_retries=5, llm_chunk_tokens=LLM_CHUNK_TOKENS,
+                 llm_rpm=None, llm_tpm=None, llm_rate_file=None,
+                 enhance_max_chunks=ENHANCE_MAX_CHUNKS, defer_enhancement=False,
+                 use_cache=True, cache_dir=None, cache_max_mb=256, page_cache_max_mb=512,
+                 llm_timeout=120.0, llm_connect_timeout=10.0, llm_max_connections=20, llm_http2=True,
+                 image_workers=None, page_image_dpi=72, page_image_format="png",
+                 ocr=True, ocr_dpi=300, ocr_lang="eng", ocr_workers=None,
+                 layout_threshold=LAYOUT_CONFIDENCE_THRESHOLD,
+                 excel_max_rows=None, excel_sample_every=1,
+                 image_fetch_workers=8, image_fetch_per_host=4, image_fetch_timeout=30.0,
+                 image_max_bytes=20 * 1024 * 1024,
+                 markitdown_backend="auto", markitdown_python=None,
+                 profile_dir=None, trace_memory=False):
+        self.output_dir = output_dir
+        # Each document is written to its own directory, with its images linked from a shared
+        # content-addressed store; images_dir is set per document by convert_file
         self.images_dir = os.path.join(self.output_dir, "images")
+        self.image_store = ImageStore(os.path.join(self.output_dir, ".image_store"))
         self.temp_dir = tempfile.mkdtemp()
-        
-        # Set up OpenRouter client
-        self.client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=openrouter_api_key,
-        )
         self.site_url = site_url
         self.site_name = site_name
         
+        # One pooled OpenRouter client shared by every LLM call, so keep-alive connections
+        # and TLS sessions survive across chunks and documents; built on first LLM call
+        self._client = None
+        self._client_settings = (openrouter_api_key, base_url, llm_timeout,
+                                 llm_connect_timeout, llm_max_connections, llm_http2)
+        self.llm_concurrency = max(1, llm_concurrency)
+        self.llm_max_retries = llm_max_retries
+        
+        # Requests/tokens per minute shared with every converter using the same state file
+        self.rate_limiter = None
+        if llm_rpm or llm_tpm:
+            self.rate_limiter = LLMRateLimiter(
+                llm_rate_file or os.path.join(self.output_dir, ".llm_rate.json"),
+                requests_per_minute=llm_rpm, tokens_per_minute=llm_tpm,
+            )
+        
+        # Splits text for LLM requests at Markdown block boundaries within a token budget
+        self.chunker = MarkdownChunker(llm_chunk_tokens)
+        self.enhance_max_chunks = enhance_max_chunks
+        # Leave chunks that fail lint for a later enhance_file call (e.g. by another worker)
+        # instead of sending them to the LLM during conversion
+        self.defer_enhancement = defer_enhancement
+        
+        # PDF image extraction and page rendering settings
+        self.image_workers = image_workers if image_workers is not None else (os.cpu_count() or 1)
+        self.page_image_dpi = page_image_dpi
+        self.page_image_format = page_image_format
+        
+        # PDF pages whose local layout confidence reaches this skip the LLM (above 1: none do)
+        self.layout_threshold = layout_threshold
+        
+        # OCR for PDF pages that have images but no text layer (scans)
+        self.ocr = ocr
+        self.ocr_dpi = ocr_dpi
+        self.ocr_lang = ocr_lang
+        self.ocr_workers = ocr_workers if ocr_workers is not None else (os.cpu_count() or 1)
+        
+        # Remote image downloads for HTML, set up on first use and kept for later documents
+        self.image_fetcher = None
+        self.image_fetch_workers = image_fetch_workers
+        self.image_fetch_per_host = image_fetch_per_host
+        self.image_fetch_timeout = image_fetch_timeout
+        self.image_max_bytes = image_max_bytes
+        
+        # markitdown backend ("auto", "inprocess", "worker" or "cli"), loaded on first use
+        self.markitdown_backend = markitdown_backend
+        self.markitdown_python = markitdown_python
+        self._markitdown = None
+        self._markitdown_worker = None
+        
+        # Per-sheet limits for Excel conversion: at most excel_max_rows data rows, every Nth row
+        self.excel_max_rows = excel_max_rows
+        self.excel_sample_every = max(1, excel_sample_every)
+        
+        # Cache LLM replies on disk so re-converting unchanged content costs no API calls
+        self.llm_cache = None
+        if use_cache:
+            self.llm_cache = LLMResponseCache(
+                cache_dir or os.path.join(self.output_dir, ".llm_cache"),
+                max_bytes=cache_max_mb * 1024 * 1024,
+            )
+        
+        # Post-processing stages run on the in-memory document after conversion
+        self.markitdown_pipeline = (PostProcessingPipeline()
+            .register("pdf_images", self._extract_images_from_pdf_post_markitdown,
+                      condition=lambda document: document.source_path.lower().endswith('.pdf'))
+            .register("base64_images", self._extract_base64_images)
+            .register("placeholder_images", self._fix_placeholder_image_references)
+            .register("llm_enhance", self._enhance_with_llm))
+        self.conversion_pipeline = (PostProcessingPipeline()
+            .register("llm_enhance", self._enhance_with_llm)
+            .register("verify_images", self._verify_image_paths))
+        self.enhancement_pipeline = PostProcessingPipeline().register("llm_enhance", self._enhance_with_llm)
+        
+        # Record of converted documents, used to skip unchanged sources and reuse PDF pages
+        self.manifest = ConversionManifest(os.path.join(self.output_dir, ".manifest"))
+        self.page_cache_dir = os.path.join(self.output_dir, ".page_cache")
+        # Page and OCR results share one size cap; least recently used files go first
+        self.page_cache_max_bytes = page_cache_max_mb * 1024 * 1024
+        self._page_cache_bytes = None
+        self._previous_entry = None
+        self._manifest_entry = None
+        self._conversion_state = {}
+        
+        # Per-document ConversionMetrics (set while convert_file runs) and optional profiling
+        self.metrics = None
+        self.last_metrics = None
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        
+        # Characters, tokens, seconds and chunks spent in LLM calls for the current document,
+        # for throughput and cost reporting; seconds is wall time with any request in flight
+        self.llm_stats = None
+        self._llm_active = 0
+        self._llm_active_since = 0.0
+        self._reset_llm_stats()
+        
+        # Event loop running in a background thread, started on first async LLM call
+        self._loop = None
+        self._loop_thread = None
+        self._loop_lock = threading.Lock()
+        
         # Initialize directories
         os.makedirs(self.output_dir, exist_ok=True)
-        os.makedirs(self.images_dir, exist_ok=True)
     
     def __del__(self):
+        # Only ask the loop to stop: waiting on it here can hang interpreter shutdown,
+        # so callers release connections with close()
+        loop = getattr(self, '_loop', None)
+        if loop is not None and loop.is_running():
+            try:
+                loop.call_soon_threadsafe(loop.stop)
+            except RuntimeError:
+                pass
+    
+    def close(self):
+        """Stop the background event loop, close pooled connections and clean up the temp directory"""
+        if getattr(self, 'image_fetcher', None) is not None:
+            self.image_fetcher.close()
+            self.image_fetcher = None
+        if getattr(self, '_markitdown_worker', None) is not None:
+            self._markitdown_worker.close()
+            self._markitdown_worker = None
+        
+        loop = getattr(self, '_loop', None)
+        if loop is not None and loop.is_running():
+            if self._client is not None:
+                try:
+                    self._run_async(self._client.close(), timeout=5)
+                except Exception:
+                    pass
+                self._client = None
+            loop.call_soon_threadsafe(loop.stop)
+            self._loop_thread.join(timeout=5)
+            self._loop = None
+        
         # Clean up temp directory
         if hasattr(self, 'temp_dir') and os.path.exists(self.temp_dir):
             shutil.rmtree(self.temp_dir)
     
+    @property
+    def client(self):
+        """The shared OpenRouter client, created (and openai imported) on first use"""
+        if self._client is None:
+            self._client = self._build_llm_client(*self._client_settings)
+        return self._client
+    
+    def _build_llm_client(self, api_key, base_url, timeout, connect_timeout, max_connections, http2):
+        """Create the shared async OpenRouter client with a bounded connection pool"""
+        if http2 and importlib.util.find_spec("h2") is None:
+            print("HTTP/2 requested but the 'h2' package is not installed, using HTTP/1.1")
+            http2 = False
+        
+        http_client = openai.DefaultAsyncHttpxClient(
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections),
+            http2=http2,
+        )
+        # Retries are handled by _chat_completion_async so backoff can be tuned in one place
+        return openai.AsyncOpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            max_retries=0,
+            http_client=http_client,
+            default_headers={
+                "HTTP-Referer": self.site_url,
+                "X-Title": self.site_name,
+            },
+        )
+    
+    def _submit_async(self, coro):
+        """Schedule a coroutine on the converter's background event loop without waiting
+        
+        Returns:
+            concurrent.futures.Future: Resolves to the coroutine's result
+        """
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever,
+                                                     name="llm-event-loop", daemon=True)
+                self._loop_thread.start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+    
+    def _run_async(self, coro, timeout=ASYNC_RESULT_TIMEOUT):
+        """Run a coroutine on the converter's background event loop and wait for its result
+        
+        Raises:
+            TimeoutError: If the result is not ready within timeout seconds
+        """
+        future = self._submit_async(coro)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError(f"LLM event loop gave no result within {timeout}s")
+    
+    def output_path_for(self, input_path):
+        """Return the Markdown path that convert_file writes for input_path
+        
+        Every document gets a directory of its own, <output_dir>/<file name>-<hash>/<name>.md
+        next to an images/ directory, so documents never share image files. The
+        directory keeps the extension and adds a short hash of the absolute source
+        path, so report.pdf and report.docx, or a/x.pdf and b/x.pdf, never collide.
+        """
+        name = os.path.basename(input_path).rsplit('.', 1)[0]
+        return os.path.join(self.output_dir, self._source_stem(input_path), name + '.md')
+    
+    @staticmethod
+    def _source_stem(input_path):
+        """<file name>-<hash of the absolute path>: a name unique to one source document"""
+        path_hash = hashlib.sha256(os.path.abspath(input_path).encode('utf-8')).hexdigest()[:8]
+        return f"{os.path.basename(input_path)}-{path_hash}"
+    
+    @property
+    def output_options(self):
+        """Settings that change the Markdown produced; a change forces re-conversion"""
+        return {
+            "page_image_dpi": self.page_image_dpi,
+            "page_image_format": self.page_image_format,
+            "ocr": [self.ocr_dpi, self.ocr_lang] if self.ocr else None,
+            "layout_threshold": self.layout_threshold,
+            "llm_chunk_tokens": self.chunker.max_tokens,
+            "enhance_max_chunks": self.enhance_max_chunks,
+            "excel_max_rows": self.excel_max_rows,
+            "excel_sample_every": self.excel_sample_every,
+        }
+    
+    def is_up_to_date(self, input_path):
+        """Check the manifest for an up-to-date conversion of input_path
+        
+        The source counts as unchanged if its size and mtime match the manifest,
+        or failing that if its SHA-256 does. The converter version, output
+        options and every recorded artifact must also still match.
+        """
+        entry = self.manifest.get(input_path)
+        if (not entry or entry.get("converter_version") != CONVERTER_VERSION
+                or entry.get("options") != self.output_options or entry.get("enhancement_pending")):
+            return False
+        if not all(os.path.exists(os.path.join(self.output_dir, artifact)) for artifact in entry["artifacts"]):
+            return False
+        
+        stat = os.stat(input_path)
+        if entry["source_size"] == stat.st_size and entry["source_mtime"] == stat.st_mtime:
+            return True
+        return file_sha256(input_path) == entry["source_sha256"]
+    
+    def _record_conversion(self, input_path, output_path):
+        """Write the manifest entry for a finished conversion"""
+        with open(output_path, 'r', encoding='utf-8') as f:
+            image_paths = re.findall(r'!\[.*?\]\((.*?)\)', f.read())
+        
+        output_dir = os.path.dirname(output_path)
+        artifacts = [os.path.relpath(output_path, self.output_dir)]
+        for path in dict.fromkeys(image_paths):
+            full_path = os.path.join(output_dir, path)
+            if os.path.exists(full_path):
+                artifacts.append(os.path.relpath(full_path, self.output_dir).replace("\\", "/"))
+        
+        # Unlink images the previous conversion used but this one does not (the store keeps them)
+        previous = self._manifest_entry or {}
+        images_prefix = os.path.relpath(self.images_dir, self.output_dir).replace("\\", "/") + "/"
+        for artifact in set(previous.get("artifacts", [])) - set(artifacts):
+            if artifact.startswith(images_prefix) and os.path.exists(os.path.join(self.output_dir, artifact)):
+                os.remove(os.path.join(self.output_dir, artifact))
+        
+        stat = os.stat(input_path)
+        entry = {
+            "source_sha256": file_sha256(input_path),
+            "source_size": stat.st_size,
+            "source_mtime": stat.st_mtime,
+            "converter_version": CONVERTER_VERSION,
+            "options": self.output_options,
+            "artifacts": artifacts,
+            "converted_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        entry.update(self._conversion_state)
+        self.manifest.record(input_path, entry)
+        if self.metrics is not None:
+            self.metrics.outputs([os.path.join(self.output_dir, artifact) for artifact in artifacts])
+    
     def convert_file(self, input_path):
-        """Convert a file to Markdown based on its extension"""
-        file_extension = os.path.splitext(input_path)[1].lower()
-        output_filename = os.path.basename(input_path).rsplit('.', 1)[0] + '.md'
-        output_path = os.path.join(self.output_dir, output_filename)
+        """Convert a file to Markdown with the FormatHandler that recognises it
+        
+        Stage timings, LLM calls and output sizes are collected in a
+        ConversionMetrics record, left in last_metrics afterwards. With
+        profile_dir set the conversion runs under cProfile (main thread only) and
+        the stats are saved as <profile_dir>/<file name>-<hash>.prof, named like
+        the document's output directory; with trace_memory the peak traced
+        allocation and the top allocation sites are added to the record.
+        """
+        self.last_metrics = None
+        self._reset_llm_stats()
+        handler = detect_format(input_path)
+        self.metrics = ConversionMetrics(input_path, handler.name)
+        
+        profiler = None
+        if self.profile_dir:
+            import cProfile
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler = cProfile.Profile()
+            profiler.enable()
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+        
+        status = "failed"
+        try:
+            output_path = self._convert_with_handler(handler, input_path)
+            status = "converted"
+            return output_path
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir, self._source_stem(input_path) + ".prof"))
+            if self.trace_memory:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self.metrics.record["memory"] = {
+                    "peak_bytes": peak,
+                    "top": [str(stat) for stat in snapshot.statistics("lineno")[:10]],
+                }
+            self.last_metrics = self.metrics.finish(status)
+            self.metrics = None
+    
+    def enhance_file(self, input_path):
+        """Run the LLM enhancement that a deferred conversion of input_path left pending
+        
+        The Markdown written by convert_file is enhanced in place and the
+        manifest entry is marked complete; until then is_up_to_date is False.
+        """
+        self.last_metrics = None
+        self._reset_llm_stats()
+        output_path = self.output_path_for(input_path)
+        self.images_dir = os.path.join(os.path.dirname(output_path), "images")
+        self.metrics = ConversionMetrics(input_path, "enhance")
+        
+        status = "failed"
+        defer, self.defer_enhancement = self.defer_enhancement, False
+        try:
+            self.enhancement_pipeline.run(MarkdownDocument(output_path, input_path), self.metrics)
+            entry = self.manifest.get(input_path)
+            if entry is not None and entry.pop("enhancement_pending", None):
+                self.manifest.record(input_path, entry)
+            self._report_llm_stats()
+            status = "converted"
+            return output_path
+        finally:
+            self.defer_enhancement = defer
+            self.last_metrics = self.metrics.finish(status)
+            self.metrics = None
+    
+    def _convert_with_handler(self, handler, input_path):
+        """Run markitdown or the handler's conversion, then post-processing and the manifest update"""
+        output_path = self.output_path_for(input_path)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        self.images_dir = os.path.join(os.path.dirname(output_path), "images")
         
         print(f"Converting {input_path} to Markdown...")
+        if os.path.splitext(input_path)[1].lower() not in handler.extensions:
+            print(f"Detected {handler.name} content in {input_path}")
         
-        if self._try_markitdown_cli(input_path, output_path):
-            print(f"Successfully converted using markitdown CLI to {output_path}")
-            
-            # Special handling for PDF images
-            if input_path.lower().endswith('.pdf'):
-                print("Adding PDF images to the converted markdown...")
-                self._extract_images_from_pdf_post_markitdown(input_path, output_path)
+        # The previous entry lets handlers reuse work for parts of the source that did not change
+        self._manifest_entry = self.manifest.get(input_path)
+        self._previous_entry = self._manifest_entry
+        if self._previous_entry and (self._previous_entry.get("converter_version") != CONVERTER_VERSION
+                                     or self._previous_entry.get("options") != self.output_options):
+            self._previous_entry = None
+        self._conversion_state = {}
+        
+        converted = False
+        if handler.markitdown:
+            with self.metrics.stage("markitdown"):
+                converted = self._try_markitdown(input_path, output_path)
+        if converted:
+            print(f"Successfully converted using markitdown to {output_path}")
             
-            # Continue with normal processing
-            self._extract_base64_images(output_path)
-            self._fix_placeholder_image_references(output_path)
-            self._enhance_with_llm(output_path)
+            # Image extraction, placeholder fixes and LLM enhancement, written back once
+            self.markitdown_pipeline.run(MarkdownDocument(output_path, input_path), self.metrics)
+            self._record_conversion(input_path, output_path)
+            self._report_llm_stats()
             return output_path
         
-        # If markitdown CLI fails or isn't suitable, use our custom conversion methods
-        if file_extension in ['.pdf']:
-            self._convert_pdf(input_path, output_path)
-        elif file_extension in ['.docx', '.doc']:
-            self._convert_docx(input_path, output_path)
-        elif file_extension in ['.xlsx', '.xls']:
-            self._convert_excel(input_path, output_path)
-        elif file_extension in ['.html', '.htm']:
-            self._convert_html(input_path, output_path)
-        elif file_extension in ['.md', '.markdown', '.txt']:
-            self._process_text(input_path, output_path)
-        else:
-            raise ValueError(f"Unsupported file format: {file_extension}")
-            
-        # Post-process to enhance formatting
-        self._enhance_with_llm(output_path)
+        # If markitdown fails or isn't suitable, use the handler's own conversion
+        with self.metrics.stage("convert." + handler.name):
+            handler.run(self, input_path, output_path)
         
-        # After conversion is complete
-        self._verify_image_paths(output_path)
+        # Post-process to enhance formatting and verify image paths, written back once
+        self.conversion_pipeline.run(MarkdownDocument(output_path, input_path), self.metrics)
             
         print(f"Successfully converted to {output_path}")
+        self._record_conversion(input_path, output_path)
+        self._report_llm_stats()
         return output_path
     
-    def _extract_images_from_pdf_post_markitdown(self, pdf_path, markdown_path):
+    def _reset_llm_stats(self):
+        """Start LLM, cache and rate limiter counters afresh for the next document"""
+        self.llm_stats = {"chars": 0, "tokens": 0, "seconds": 0.0, "chunks": 0,
+                          "prompt_tokens": 0, "completion_tokens": 0}
+        if getattr(self, 'llm_cache', None):
+            self.llm_cache.hits = 0
+            self.llm_cache.misses = 0
+        if getattr(self, 'rate_limiter', None):
+            self.rate_limiter.delays = {priority: [0, 0.0, 0.0] for priority in self.rate_limiter.PRIORITIES}
+    
+    def _report_llm_stats(self):
+        stats = self.llm_stats
+        if stats["seconds"]:
+            print(f"LLM throughput: {stats['chars']} chars, {stats['tokens']} tokens in {stats['seconds']:.1f}s "
+                  f"({stats['tokens'] / stats['seconds']:.0f} tokens/sec, {stats['chunks']} chunks, "
+                  f"counted with {self.chunker.tokenizer})")
+        if stats["prompt_tokens"] or stats["completion_tokens"]:
+            print(f"LLM usage reported by the API: {stats['prompt_tokens']} prompt tokens, "
+                  f"{stats['completion_tokens']} completion tokens")
+        if self.llm_cache and (self.llm_cache.hits or self.llm_cache.misses):
+            stats = self.llm_cache.stats()
+            print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses, {stats['bytes'] // 1024} KB on disk")
+        if self.rate_limiter:
+            for priority, (waits, seconds, longest) in self.rate_limiter.delays.items():
+                if waits:
+                    print(f"LLM rate limit ({priority}): {waits} requests waited {seconds:.1f}s in total, "
+                          f"longest {longest:.1f}s")
+    
+    def _extract_images_from_pdf_post_markitdown(self, document):
         """Extract images from PDF and add them to the markdown after MarkItDown conversion"""
+        print("Adding PDF images to the converted markdown...")
+        image_references = self._extract_pdf_images(document.source_path, alt_text="Image from document")
+        
+        # Append image references to the markdown content if any images were found
+        if image_references:
+            document.content += "\n\n" + "\n\n".join(image_references) + "\n\n"
+            
+            print(f"Added {len(image_references)} image references to the markdown")
+    
+    def _extract_pdf_images(self, pdf_path, alt_text=None):
+        """Save every image in a PDF and return Markdown references in page order"""
+        return self._start_pdf_image_extraction(pdf_path, alt_text)()
+    
+    def _start_pdf_image_extraction(self, pdf_path, alt_text=None, unchanged_pages=frozenset()):
+        """Start saving every image in a PDF, spreading pages across worker processes
+        
+        Pages are split into contiguous ranges and each worker opens its own fitz
+        handle. Embedded images are de-duplicated by xref, so an image shared by
+        many pages (e.g. a logo) is extracted once and referenced once, from the
+        first page that uses it. Pages without embedded images are rendered at
+        page_image_dpi in page_image_format. Images of pages in unchanged_pages are
+        relinked from the image store when the previous conversion recorded them.
+        
+        Returns:
+            callable: Waits for the workers and returns Markdown image references in page order
+        """
+        # Cheap first pass: find which page first uses each xref, without decoding anything
         pdf_document = fitz.open(pdf_path)
-        extracted_images = []
+        page_count = len(pdf_document)
+        xref_owners = {}
+        for page_num in range(page_count):
+            for img_info in pdf_document[page_num].get_images(full=True):
+                xref_owners.setdefault(img_info[0], page_num)
+        pdf_document.close()
         
-        # Read existing markdown content
-        with open(markdown_path, 'r', encoding='utf-8') as f:
-            markdown_content = f.read()
+        previous_images = (self._previous_entry or {}).get("page_images", {})
+        previous_pages = {int(page): entries for page, entries in previous_images.items()
+                          if int(page) in unchanged_pages}
+        args = (xref_owners, self.image_store.store_dir, self.images_dir, self.page_image_dpi,
+                self.page_image_format, previous_pages)
+        workers = min(self.image_workers, page_count)
+        executor = None
+        futures = []
+        if workers > 1:
+            print(f"Extracting images from {page_count} pages with {workers} processes...")
+            step = -(-page_count // workers)
+            executor = ProcessPoolExecutor(max_workers=workers)
+            futures = [executor.submit(_extract_pdf_page_images, pdf_path,
+                                       range(start, min(start + step, page_count)), *args)
+                       for start in range(0, page_count, step)]
         
-        # Extract images from all pages
-        for page_num in range(len(pdf_document)):
-            page = pdf_document[page_num]
-            image_list = page.get_images(full=True)
-            
-            if image_list:
-                for img_index, img_info in enumerate(image_list):
-                    xref = img_info[0]
-                    base_img = pdf_document.extract_image(xref)
-                    image_bytes = base_img["image"]
-                    
-                    # Save image
-                    img_filename = f"image_p{page_num+1}_{img_index+1}.{base_img['ext']}"
-                    img_path = os.path.join(self.images_dir, img_filename)
-                    
-                    try:
-                        with open(img_path, "wb") as img_file:
-                            img_file.write(image_bytes)
-                        
-                        print(f"Extracted image to {img_path}")
-                        extracted_images.append((img_filename))
-                    except Exception as e:
-                        print(f"Error saving image: {e}")
+        def collect():
+            page_files = {}
+            if executor is None:
+                # Single worker: extract in this process when the caller is ready for it
+                page_files.update(_extract_pdf_page_images(pdf_path, range(page_count), *args))
             else:
-                # If no vectorized images found, try rendering page as image
-                pix = page.get_pixmap(alpha=False)
-                img_filename = f"page_{page_num+1}.png"
-                img_path = os.path.join(self.images_dir, img_filename)
-                
                 try:
-                    pix.save(img_path)
-                    print(f"Rendered page {page_num+1} as image: {img_path}")
-                    extracted_images.append((img_filename))
-                except Exception as e:
-                    print(f"Error saving page image: {e}")
-        
-        # Append image references to the markdown content if any images were found
-        if extracted_images:
-            img_rel_path = f"images/{img_filename}".replace('\\', '/')
-            markdown_content += f"![Image from document]({img_rel_path})\n\n"
-            for img_filename in extracted_images:
-                markdown_content += f"![Image from document](images/{img_filename})\n\n"
+                    for future in futures:
+                        page_files.update(future.result())
+                finally:
+                    executor.shutdown()
             
-            # Write updated markdown
-            with open(markdown_path, 'w', encoding='utf-8') as f:
-                f.write(markdown_content)
+            self._conversion_state["page_images"] = {str(page_num): entries
+                                                     for page_num, entries in page_files.items()}
             
-            print(f"Added {len(extracted_images)} image references to the markdown")
+            # Identical images (even under different xrefs) are referenced once, from the first page
+            image_references = []
+            referenced = set()
+            for page_num in sorted(page_files):
+                for kind, img_filename in page_files[page_num]:
+                    if img_filename in referenced:
+                        continue
+                    referenced.add(img_filename)
+                    # Create a markdown-compatible reference using RELATIVE path
+                    rel_img_path = os.path.join("images", img_filename).replace("\\", "/")
+                    if alt_text:
+                        label = alt_text
+                    elif kind == "page":
+                        label = f"Page {page_num+1}"
+                    else:
+                        label = f"Image from page {page_num+1}"
+                    image_references.append(f"![{label}]({rel_img_path})")
+            return image_references
         
-        pdf_document.close()
+        return collect
     
+    def _try_markitdown(self, input_path, output_path):
+        """Attempt to convert with markitdown using the configured backend
+        
+        Backends: "inprocess" calls the markitdown library directly, "worker" sends
+        the file to a long-lived MarkitdownWorker process, and "cli" runs the
+        markitdown command once per file. "auto" picks inprocess when the library
+        is importable and falls back to the CLI otherwise. "none" always leaves
+        the document to the format handler's own conversion.
+        """
+        if input_path.lower().endswith('.pdf') or self.markitdown_backend == "none":
+            return False
+        
+        backend = self.markitdown_backend
+        if backend == "auto":
+            backend = "inprocess" if importlib.util.find_spec("markitdown") else "cli"
+        
+        if backend == "cli":
+            return self._try_markitdown_cli(input_path, output_path)
+        
+        try:
+            if backend == "inprocess":
+                if self._markitdown is None:
+                    from markitdown import MarkItDown
+                    self._markitdown = MarkItDown()
+                result = self._markitdown.convert(input_path, keep_data_uris=True)
+                markdown_text = getattr(result, "markdown", None) or result.text_content
+                with open(output_path, 'w', encoding='utf-8') as f:
+                    f.write(markdown_text)
+            else:
+                if self._markitdown_worker is None:
+                    self._markitdown_worker = MarkitdownWorker(self.markitdown_python)
+                self._markitdown_worker.convert(input_path, output_path)
+            return os.path.exists(output_path)
+        except Exception as e:
+            print(f"markitdown ({backend}) could not convert {input_path}: {e}")
+            return False
     
     def _try_markitdown_cli(self, input_path, output_path):
         """Attempt to use markitdown CLI tool if available"""
-        if input_path.lower().endswith('.pdf'):
-            return False
-
-        
         try:
             # Check if markitdown CLI is installed and works for this file type
             result = subprocess.run(
@@ -185,83 +2181,114 @@ class DocumentConverter:
             image_bytes = base_img["image"]
             
             # Save image
-            img_filename = f"image_p{page_num+1}_{img_index+1}.{base_img['ext']}"
-            img_path = os.path.join(self.images_dir, img_filename)
-            with open(img_path, "wb") as img_file:
-                img_file.write(image_bytes)
-            
-            image_paths.append((img_path, img_filename))
+            img_filename = self._store_image(image_bytes, base_img['ext'])
+            image_paths.append((os.path.join(self.images_dir, img_filename), img_filename))
             
         pdf_document.close()
         return image_paths
     
     def _convert_pdf(self, pdf_path, output_path):
-        """Enhanced PDF to Markdown conversion with robust image handling"""
+        """Enhanced PDF to Markdown conversion with robust image handling
+        
+        Pages are read once, in order: page text is grouped into batches that are
+        sent to the LLM as soon as they are ready, and converted batches are
+        streamed to output_path in order. Only a bounded number of batches is held
+        in memory at any time. Images are extracted in parallel worker processes
+        meanwhile (see _extract_pdf_images). Scanned pages are OCRed before they
+        are batched, and pages whose layout is clear enough are written straight
+        from PdfLayoutAnalyzer without an LLM call (see _iter_pdf_pages).
+        """
         pdf_document = fitz.open(pdf_path)
-        markdown_content = []
+        
+        # Compare page hashes with the previous run so unchanged pages can be reused
+        page_hashes = self._pdf_page_hashes(pdf_document)
+        previous_hashes = (self._previous_entry or {}).get("pages", [])
+        unchanged_pages = {page_num for page_num, page_hash in enumerate(page_hashes)
+                           if page_num < len(previous_hashes) and previous_hashes[page_num] == page_hash}
+        self._conversion_state["pages"] = page_hashes
+        if previous_hashes:
+            print(f"{len(unchanged_pages)} of {len(page_hashes)} pages unchanged since the last conversion")
+        
+        # Images are extracted by worker processes while the text streams through the LLM
+        collect_images = self._start_pdf_image_extraction(pdf_path, unchanged_pages=unchanged_pages)
+        
         image_references = []
+        heading_normalizer = HeadingNormalizer()
+        pending = deque()  # (batch texts, future), or (local markdown, None)
+        in_flight = 0
+        page_count = 0
+        local_pages = 0
         
-        # Step 1: Extract all text for LLM processing
-        print("Extracting text from PDF...")
-        all_text = ""
-        for page_num in range(len(pdf_document)):
-            page = pdf_document[page_num]
-            text = page.get_text()
-            if text.strip():
-                all_text += text + "\n\n"
-        
-        # Step 2: Use LLM to format the text as markdown
-        print("Converting text to markdown with LLM...")
-        formatted_markdown = self._convert_with_llm(all_text, "pdf")
-        if not formatted_markdown:
-            formatted_markdown = all_text  # Fallback to raw text if LLM fails
-        
-        # Step 3: Extract and save images completely separately from text
-        print("Extracting images from PDF...")
-        for page_num in range(len(pdf_document)):
-            page = pdf_document[page_num]
-            image_list = page.get_images(full=True)
+        print(f"Streaming {len(pdf_document)} PDF pages...")
+        with open(output_path, 'w', encoding='utf-8') as out:
+            first_block = True
             
-            if image_list:
-                for img_index, img_info in enumerate(image_list):
-                    xref = img_info[0]
-                    base_img = pdf_document.extract_image(xref)
-                    image_bytes = base_img["image"]
-                    
-                    # Create unique image filename
-                    img_filename = f"image_p{page_num+1}_{img_index+1}.{base_img['ext']}"
-                    img_path = os.path.join(self.images_dir, img_filename)
-                    
-                    # Save the image
-                    try:
-                        with open(img_path, "wb") as img_file:
-                            img_file.write(image_bytes)
-                        print(f"Extracted image to {img_path}")
-                        
-                        # Create a markdown-compatible reference using RELATIVE path
-                        rel_img_path = os.path.join("images", img_filename).replace("\\", "/")
-                        image_references.append(f"![Image from page {page_num+1}]({rel_img_path})")
-                    except Exception as e:
-                        print(f"Error saving image: {e}")
-            else:
-                # If no vector images, try rendering page as image
-                pix = page.get_pixmap(alpha=False)
-                img_filename = f"page_{page_num+1}.png"
-                img_path = os.path.join(self.images_dir, img_filename)
-                
+            def write_block(text):
+                nonlocal first_block
+                if not first_block:
+                    out.write("\n\n")
+                out.write(text)
+                first_block = False
+            
+            def flush_oldest():
+                # Batches are written in page order, whatever order the LLM finishes them in
+                nonlocal in_flight
+                batch_texts, future = pending.popleft()
+                if future is None:
+                    write_block(heading_normalizer.apply(batch_texts))
+                    return
+                in_flight -= 1
+                wait_start = time.perf_counter()
                 try:
-                    pix.save(img_path)
-                    print(f"Rendered page {page_num+1} as image: {img_path}")
-                    
-                    # Create a markdown-compatible reference using RELATIVE path
-                    rel_img_path = os.path.join("images", img_filename).replace("\\", "/")
-                    image_references.append(f"![Page {page_num+1}]({rel_img_path})")
+                    formatted = future.result()
                 except Exception as e:
-                    print(f"Error saving page image: {e}")
+                    print(f"Error converting PDF pages with LLM: {e}")
+                    formatted = None
+                if self.metrics is not None:
+                    self.metrics.add_stage("pdf.llm_wait", time.perf_counter() - wait_start)
+                if formatted:
+                    write_block(heading_normalizer.apply(formatted))
+                else:
+                    write_block("\n\n".join(batch_texts))  # Fallback to raw text if LLM fails
+            
+            pages = self._iter_pdf_pages(pdf_document, page_hashes, pdf_path)
+            for batch_texts in self._iter_page_batches(pages, self.chunker.max_tokens):
+                if isinstance(batch_texts, str):
+                    pending.append((batch_texts, None))
+                    page_count += 1
+                    local_pages += 1
+                else:
+                    future = self._submit_async(
+                        self._convert_with_llm_async(PAGE_BREAK.join(batch_texts), "pdf"))
+                    pending.append((batch_texts, future))
+                    in_flight += 1
+                    page_count += len(batch_texts)
+                while pending and (pending[0][1] is None or in_flight > self.llm_concurrency
+                                   or len(pending) > 4 * self.llm_concurrency):
+                    flush_oldest()
+            while pending:
+                flush_oldest()
+            
+            if page_count:
+                print(f"Layout: {local_pages} of {page_count} text pages ({local_pages / page_count:.0%}) "
+                      f"written locally, {page_count - local_pages} sent to the LLM")
+            self._conversion_state["layout"] = {"local_pages": local_pages, "text_pages": page_count}
+            
+            wait_start = time.perf_counter()
+            try:
+                image_references = collect_images()
+            except Exception as e:
+                print(f"Error extracting images from PDF: {e}")
+            if self.metrics is not None:
+                self.metrics.add_stage("pdf.images", time.perf_counter() - wait_start)
+            
+            # Image references go in one section after the text
+            if image_references:
+                write_block("## Document Images\n\n" + "\n\n".join(image_references))
         
         pdf_document.close()
         
-        # Step 4: Create a test HTML file to verify image display
+        # Create a test HTML file to verify image display
         html_test_path = os.path.join(os.path.dirname(output_path), "image_test.html")
         with open(html_test_path, 'w', encoding='utf-8') as f:
             f.write("<html><body>\n")
@@ -270,161 +2297,455 @@ class DocumentConverter:
                 f.write(f'<p><img src="{img_path}" alt="Test image"></p>\n')
             f.write("</body></html>")
         
-        # Step 5: Combine text and images in final markdown
-        final_markdown = formatted_markdown
-        if image_references:
-            final_markdown += "\n\n## Document Images\n\n"
-            final_markdown += "\n\n".join(image_references)
-        
-        # Write markdown content to file
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(final_markdown)
-        
-        print(f"PDF successfully converted to {output_path} with {len(image_references)} images")
+        print(f"PDF successfully converted to {output_path} with {page_count} text pages and {len(image_references)} images")
         print(f"To verify image paths, open {html_test_path} in a browser")
         
         return output_path
+    
+    def _pdf_page_hashes(self, pdf_document):
+        """Hash each page's content stream, resources, image list and size without extracting any text
+        
+        Every object the page's /Resources reach is hashed with its stream
+        (fonts and their ToUnicode maps, Form XObjects and their content), so
+        pages whose content stream is just "/Fm0 Do" are told apart. Each
+        object is read and hashed once per document.
+        """
+        object_digests = {}  # xref -> (digest of source and raw stream, referenced xrefs)
+        page_hashes = []
+        for page in pdf_document:
+            digest = hashlib.sha256(page.read_contents())
+            resources = self._pdf_page_resources(pdf_document, page.xref)
+            digest.update(resources.encode('utf-8'))
+            
+            pending = PDF_REF_RE.findall(PDF_BACK_REF_RE.sub('', resources))
+            seen = set()
+            while pending:
+                xref = int(pending.pop())
+                if xref in seen:
+                    continue
+                seen.add(xref)
+                if xref not in object_digests:
+                    source = pdf_document.xref_object(xref, compressed=True)
+                    object_digest = hashlib.sha256(source.encode('utf-8'))
+                    if pdf_document.xref_is_stream(xref):
+                        object_digest.update(pdf_document.xref_stream_raw(xref) or b"")
+                    object_digests[xref] = (object_digest.digest(),
+                                            PDF_REF_RE.findall(PDF_BACK_REF_RE.sub('', source)))
+                object_digest, references = object_digests[xref]
+                digest.update(object_digest)
+                pending.extend(references)
+            
+            digest.update(repr(page.get_images(full=True)).encode('utf-8'))
+            digest.update(repr(tuple(page.rect)).encode('utf-8'))
+            page_hashes.append(digest.hexdigest())
+        return page_hashes
+    
+    def _pdf_page_resources(self, pdf_document, page_xref):
+        """Source of a page's /Resources, following inheritance up the page tree"""
+        xref = page_xref
+        for _ in range(64):
+            kind, value = pdf_document.xref_get_key(xref, "Resources")
+            if kind != "null":
+                if kind == "xref":
+                    return value + pdf_document.xref_object(int(value.split()[0]), compressed=True)
+                return value
+            kind, value = pdf_document.xref_get_key(xref, "Parent")
+            if kind != "xref":
+                break
+            xref = int(value.split()[0])
+        return ""
+    
+    def _iter_pdf_pages(self, pdf_document, page_hashes, pdf_path=None):
+        """Yield (text, page hash, markdown) for each page that has text, in page order
+        
+        Each page goes through PdfLayoutAnalyzer; markdown is the locally built
+        Markdown when its confidence reaches layout_threshold, and None when the
+        page text should go to the LLM instead. Extracted text and layout results
+        are cached by page hash, so a page that is unchanged since an earlier run
+        (even if it moved) is not extracted again. Pages with images
+        but no text layer are OCRed in ocr_workers processes (see _ocr_pdf_page);
+        up to two OCR jobs per worker run ahead of the page being yielded.
+        """
+        os.makedirs(self.page_cache_dir, exist_ok=True)
+        ocr_cache_dir = os.path.join(self.page_cache_dir, "ocr")
+        run_ocr = self.ocr and pdf_path is not None
+        executor = None
+        lookahead = max(1, self.ocr_workers) * 2
+        pending = deque()  # (page number, page hash, text or Future, local markdown)
+        analyzer = PdfLayoutAnalyzer()
+        ocr_stats = {"pages": 0, "cached": 0, "seconds": 0.0}
+        reused = 0
+        cache_growth = 0
+        
+        def resolve(page_num, result):
+            nonlocal run_ocr, cache_growth
+            if not isinstance(result, Future):
+                return result
+            try:
+                text, seconds, cached = result.result()
+            except Exception as e:
+                # Missing pytesseract or tesseract binary: stop trying for this document
+                if run_ocr:
+                    print(f"OCR unavailable, leaving scanned pages as images: {e}")
+                    run_ocr = False
+                return ""
+            ocr_stats["pages"] += 1
+            ocr_stats["cached"] += cached
+            ocr_stats["seconds"] += seconds
+            if not cached:
+                cache_growth += len(text.encode('utf-8'))
+            if self.metrics is not None:
+                self.metrics.add_stage("pdf.ocr", seconds)
+            print(f"OCR page {page_num + 1}: {len(text.strip())} chars in {seconds:.2f}s"
+                  + (" (cached)" if cached else ""))
+            return text
+        
+        try:
+            for page_num, page_hash in enumerate(page_hashes):
+                cache_path = os.path.join(self.page_cache_dir, page_hash + ".json")
+                page_data = None
+                try:
+                    with open(cache_path, 'r', encoding='utf-8') as f:
+                        page_data = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    pass
+                if page_data is not None and page_data.get("converter_version") == CONVERTER_VERSION:
+                    reused += 1
+                    os.utime(cache_path)  # mark as recently used
+                else:
+                    # Image blocks are left out: their pixel data is not needed here
+                    wall_start, cpu_start = time.perf_counter(), time.process_time()
+                    page_dict = pdf_document[page_num].get_text(
+                        "dict", flags=fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES)
+                    markdown, text, confidence = analyzer.analyze(page_dict)
+                    if self.metrics is not None:
+                        self.metrics.add_stage("pdf.extract", time.perf_counter() - wall_start,
+                                               time.process_time() - cpu_start)
+                    page_data = {"converter_version": CONVERTER_VERSION, "text": text,
+                                 "markdown": markdown, "confidence": confidence}
+                    data = json.dumps(page_data)
+                    with open(cache_path, 'w', encoding='utf-8') as f:
+                        f.write(data)
+                    cache_growth += len(data)
+                text = page_data["text"]
+                local_markdown = None
+                if page_data["markdown"].strip() and page_data["confidence"] >= self.layout_threshold:
+                    local_markdown = page_data["markdown"]
+                
+                if run_ocr and not text.strip() and pdf_document[page_num].get_images():
+                    os.makedirs(ocr_cache_dir, exist_ok=True)
+                    args = (pdf_path, page_num, self.ocr_dpi, self.ocr_lang, ocr_cache_dir)
+                    if self.ocr_workers > 1:
+                        if executor is None:
+                            executor = ProcessPoolExecutor(max_workers=self.ocr_workers)
+                        text = executor.submit(_ocr_pdf_page, *args)
+                    else:
+                        text = Future()
+                        try:
+                            text.set_result(_ocr_pdf_page(*args))
+                        except Exception as e:
+                            text.set_exception(e)
+                pending.append((page_num, page_hash, text, local_markdown))
+                
+                # Yield in page order; plain text pages wait only for OCR jobs ahead of them
+                while pending and (not isinstance(pending[0][2], Future) or pending[0][2].done()
+                                   or len(pending) > lookahead):
+                    head_num, head_hash, head_text, head_markdown = pending.popleft()
+                    head_text = resolve(head_num, head_text)
+                    if head_text.strip():
+                        yield head_text, head_hash, head_markdown
+            while pending:
+                head_num, head_hash, head_text, head_markdown = pending.popleft()
+                head_text = resolve(head_num, head_text)
+                if head_text.strip():
+                    yield head_text, head_hash, head_markdown
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+            self._grow_page_cache(cache_growth)
+        
+        if reused:
+            print(f"Reused cached text for {reused} pages")
+        if ocr_stats["pages"]:
+            print(f"OCR: {ocr_stats['pages']} pages in {ocr_stats['seconds']:.1f}s of worker time "
+                  f"({ocr_stats['cached']} from cache)")
+    
+    def _grow_page_cache(self, added_bytes):
+        """Account for bytes added to the page cache, evicting old pages once it passes its cap"""
+        if self._page_cache_bytes is None:
+            # First use in this process: measure what earlier runs left behind
+            self._page_cache_bytes = evict_lru(self.page_cache_dir, self.page_cache_max_bytes, PAGE_CACHE_SUFFIXES)
+        self._page_cache_bytes += added_bytes
+        if self._page_cache_bytes > self.page_cache_max_bytes:
+            self._page_cache_bytes = evict_lru(self.page_cache_dir, self.page_cache_max_bytes * 0.9,
+                                               PAGE_CACHE_SUFFIXES)
+    
+    def prune_caches(self, image_min_age=3600):
+        """Trim the LLM and page caches to their caps and drop store images no document links to
+        
+        Returns:
+            dict: Bytes left in each cache and the number of store images removed
+        """
+        self._page_cache_bytes = evict_lru(self.page_cache_dir, self.page_cache_max_bytes, PAGE_CACHE_SUFFIXES)
+        return {
+            "llm_cache_bytes": self.llm_cache.prune() if self.llm_cache else 0,
+            "page_cache_bytes": self._page_cache_bytes,
+            "images_removed": self.image_store.prune(min_age=image_min_age),
+        }
+    
+    def _iter_page_batches(self, pages, max_tokens):
+        """Group consecutive (text, page hash, markdown) pages into batches of page texts
+        
+        A batch closes when the next page would take it past max_tokens, or after a
+        page whose hash is divisible by PDF_BATCH_BOUNDARY. The second rule makes
+        batch boundaries follow page content, so after an edit the batches (and
+        their cached LLM replies) line up again from the next such page. A page
+        with local markdown closes the current batch and is yielded on its own as
+        a string.
+        """
+        batch = []
+        batch_tokens = 0
+        for text, page_hash, markdown in pages:
+            if markdown is not None:
+                if batch:
+                    yield batch
+                    batch = []
+                    batch_tokens = 0
+                yield markdown
+                continue
+            tokens = self.chunker.count(text)
+            if batch and batch_tokens + tokens > max_tokens:
+                yield batch
+                batch = []
+                batch_tokens = 0
+            batch.append(text)
+            batch_tokens += tokens
+            if int(page_hash[:8], 16) % PDF_BATCH_BOUNDARY == 0:
+                yield batch
+                batch = []
+                batch_tokens = 0
+        if batch:
+            yield batch
 
     def _convert_docx(self, docx_path, output_path):
-        """Convert DOCX to Markdown with images and tables preserved"""
-        doc = Document(docx_path)
-        markdown_content = []
-        
-        # Process paragraphs and tables
-        for i, element in enumerate(doc.element.body):
-            if element.tag.endswith('p'):  # Paragraph
-                paragraph = doc.paragraphs[i] if i < len(doc.paragraphs) else None
-                if paragraph and paragraph.text.strip():
-                    # Handle headings
-                    if paragraph.style.name.startswith('Heading'):
-                        level = paragraph.style.name[-1]
-                        markdown_content.append(f"{'#' * int(level)} {paragraph.text}")
-                    else:
-                        markdown_content.append(paragraph.text)
-            
-            elif element.tag.endswith('tbl'):  # Table
-                table_rows = []
-                table = None
-                for j, tbl in enumerate(doc.tables):
-                    if j == i:
-                        table = tbl
-                        break
+        """Convert DOCX to Markdown with images and tables preserved
+        
+        The body's paragraphs and tables are visited once, in order, with
+        Document.iter_inner_content, so the walk is linear in the size of the
+        document and Markdown is streamed to output_path as it goes. Images are
+        written at the position of the paragraph or table that anchors them;
+        images the walk does not reach (e.g. inside content controls) are
+        appended at the end, in relationship order.
+        """
+        doc = docx.Document(docx_path)
+        image_files = {}  # relationship id -> saved filename, so a reused image is written once
+        
+        with open(output_path, 'w', encoding='utf-8') as out:
+            first_block = True
+            
+            def write_block(text):
+                nonlocal first_block
+                if not first_block:
+                    out.write("\n\n")
+                out.write(text)
+                first_block = False
+            
+            def write_image(rel_id):
+                if rel_id in image_files:
+                    return
+                img_filename = self._save_docx_image(doc, rel_id, image_files)
+                if img_filename:
+                    write_block(f"![Image](images/{img_filename})")
+            
+            def write_images(block):
+                # python-docx has no picture API yet, so read the references from the block's XML
+                for element in block._element.iter(*DOCX_IMAGE_REFS):
+                    write_image(element.get(DOCX_IMAGE_REFS[element.tag]))
+            
+            for block in doc.iter_inner_content():
+                if isinstance(block, docx_table.Table):
+                    rows = block.rows
+                    if len(rows):
+                        # Extract headers
+                        headers = [cell.text for cell in rows[0].cells]
+                        table_rows = ['| ' + ' | '.join(headers) + ' |',
+                                      '| ' + ' | '.join(['---' for _ in headers]) + ' |']
+                        
+                        # Extract data rows
+                        for row in rows[1:]:
+                            row_data = [cell.text for cell in row.cells]
+                            table_rows.append('| ' + ' | '.join(row_data) + ' |')
+                        
+                        write_block('\n'.join(table_rows))
+                else:
+                    paragraph = block
+                    if paragraph.text.strip():
+                        # Handle headings
+                        heading = re.match(r'Heading (\d)', paragraph.style.name or "")
+                        if heading:
+                            write_block(f"{'#' * int(heading.group(1))} {paragraph.text}")
+                        else:
+                            write_block(paragraph.text)
                 
-                if table:
-                    # Extract headers
-                    headers = [cell.text for cell in table.rows[0].cells]
-                    table_rows.append('| ' + ' | '.join(headers) + ' |')
-                    table_rows.append('| ' + ' | '.join(['---' for _ in headers]) + ' |')
+                # Images anchored in this paragraph or table go right after it
+                write_images(block)
+            
+            for rel_id, rel in doc.part.rels.items():
+                if not rel.is_external and rel.reltype.endswith("/image"):
+                    write_image(rel_id)
+    
+    def _store_image(self, data, ext):
+        """Add image bytes to the image store, link them into images_dir and return the filename"""
+        img_filename = self.image_store.add_bytes(data, ext)
+        self.image_store.link(img_filename, self.images_dir)
+        return img_filename
+    
+    def _save_docx_image(self, doc, rel_id, image_files):
+        """Write the image behind a DOCX relationship id once and return its filename"""
+        if not rel_id:
+            return None
+        if rel_id in image_files:
+            return image_files[rel_id]
+        
+        image_part = doc.part.related_parts.get(rel_id)
+        if image_part is None:
+            return None
+        
+        img_ext = image_part.partname.split('.')[-1]
+        img_filename = self._store_image(image_part.blob, img_ext)
+        image_files[rel_id] = img_filename
+        return img_filename
+    
+    def _convert_excel(self, excel_path, output_path):
+        """Convert Excel to Markdown tables, streaming rows straight to the output file
+        
+        The workbook is opened read-only and iterated by value, so memory stays flat
+        regardless of sheet size. Each sheet is read twice: a quick pass finds the
+        used range (trailing empty rows and columns are trimmed) and a second pass
+        writes the table. excel_max_rows and excel_sample_every limit how many data
+        rows are written per sheet.
+        """
+        workbook = openpyxl.load_workbook(excel_path, read_only=True)
+        
+        try:
+            with open(output_path, 'w', encoding='utf-8') as out:
+                for sheet_name in workbook.sheetnames:
+                    sheet = workbook[sheet_name]
+                    # Don't trust the stored dimensions; some writers leave them wrong
+                    sheet.reset_dimensions()
+                    out.write(f"## Sheet: {sheet_name}\n\n")
                     
-                    # Extract data rows
-                    for row in table.rows[1:]:
-                        row_data = [cell.text for cell in row.cells]
-                        table_rows.append('| ' + ' | '.join(row_data) + ' |')
+                    last_row, width, omitted = self._excel_used_range(sheet)
+                    if last_row and width:
+                        written = self._write_excel_rows(sheet, out, last_row, width)
+                        if omitted:
+                            out.write(f"\n_Showing {written} sampled data rows of this sheet._\n")
                     
-                    markdown_content.append('\n'.join(table_rows))
-        
-        # Extract images
-        img_index = 0
-        for rel in doc.part.rels.values():
-            if "image" in rel.target_ref:
-                img_data = rel.target_part.blob
-                img_ext = rel.target_ref.split('.')[-1]
-                img_filename = f"image_{img_index}.{img_ext}"
-                img_path = os.path.join(self.images_dir, img_filename)
-                
-                with open(img_path, "wb") as f:
-                    f.write(img_data)
-                
-                relative_path = os.path.join("images", img_filename)
-                markdown_content.append(f"\n\n![Image]({relative_path})\n\n")
-                img_index += 1
+                    out.write("\n\n\n")
+        finally:
+            workbook.close()
+    
+    def _iter_excel_rows(self, sheet):
+        """Yield (row number, values, selected) for every row of a sheet
         
-        # Write markdown content to file
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write('\n\n'.join(markdown_content))
+        selected marks the header and the data rows chosen for output by
+        excel_sample_every and excel_max_rows.
+        """
+        data_rows = 0
+        for row_num, values in enumerate(sheet.iter_rows(values_only=True), start=1):
+            selected = True
+            if row_num > 1:
+                selected = (not (row_num - 2) % self.excel_sample_every
+                            and (self.excel_max_rows is None or data_rows < self.excel_max_rows))
+                if selected:
+                    data_rows += 1
+            yield row_num, values, selected
     
-    def _convert_excel(self, excel_path, output_path):
-        """Convert Excel to Markdown tables"""
-        workbook = openpyxl.load_workbook(excel_path)
-        markdown_content = []
-        
-        for sheet_name in workbook.sheetnames:
-            sheet = workbook[sheet_name]
-            markdown_content.append(f"## Sheet: {sheet_name}\n")
-            
-            # Determine the data range
-            max_row = sheet.max_row
-            max_col = sheet.max_column
-            
-            if max_row > 0 and max_col > 0:
-                # Create table header
-                header_row = []
-                for col in range(1, max_col + 1):
-                    cell_value = sheet.cell(row=1, column=col).value or ""
-                    header_row.append(str(cell_value))
-                
-                markdown_content.append('| ' + ' | '.join(header_row) + ' |')
-                markdown_content.append('| ' + ' | '.join(['---' for _ in range(max_col)]) + ' |')
-                
-                # Add data rows
-                for row in range(2, max_row + 1):
-                    row_data = []
-                    for col in range(1, max_col + 1):
-                        cell_value = sheet.cell(row=row, column=col).value or ""
-                        row_data.append(str(cell_value))
-                    markdown_content.append('| ' + ' | '.join(row_data) + ' |')
-            
-            markdown_content.append("\n\n")
+    def _excel_used_range(self, sheet):
+        """Find the last non-empty row and column among the rows that will be written
         
-        # Write markdown content to file
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write('\n'.join(markdown_content))
+        Reading stops at the first non-empty row past excel_max_rows, which is
+        only looked at to tell whether rows were left out.
+        
+        Returns:
+            tuple: (last row number, number of columns, whether a non-empty data row is
+            left out), with zeros for an empty sheet
+        """
+        last_row = 0
+        width = 0
+        omitted = False
+        data_rows = 0
+        for row_num, values, selected in self._iter_excel_rows(sheet):
+            used = next((col for col in range(len(values), 0, -1) if values[col - 1] not in (None, "")), 0)
+            if selected:
+                data_rows += row_num > 1
+                if used:
+                    last_row = row_num
+                    width = max(width, used)
+            elif used:
+                omitted = True
+                if self.excel_max_rows is not None and data_rows >= self.excel_max_rows:
+                    break
+        return last_row, width, omitted
+    
+    def _write_excel_rows(self, sheet, out, last_row, width):
+        """Write the selected rows of a sheet as a Markdown table, one row at a time
+        
+        Returns:
+            int: Data rows written
+        """
+        def format_row(values):
+            cells = ["" if value is None else str(value).replace("|", "\\|").replace("\n", " ")
+                     for value in values[:width]]
+            cells.extend([""] * (width - len(cells)))
+            return '| ' + ' | '.join(cells) + ' |\n'
+        
+        written = 0
+        for row_num, values, selected in self._iter_excel_rows(sheet):
+            if row_num > last_row:
+                break
+            if not selected:
+                continue
+            out.write(format_row(values))
+            if row_num == 1:
+                out.write('| ' + ' | '.join(['---' for _ in range(width)]) + ' |\n')
+            else:
+                written += 1
+        return written
     
     def _convert_html(self, html_path, output_path):
         """Convert HTML to Markdown preserving structure"""
         with open(html_path, 'r', encoding='utf-8') as f:
             html_content = f.read()
         
-        soup = BeautifulSoup(html_content, 'html.parser')
+        soup = bs4.BeautifulSoup(html_content, 'html.parser')
+        
+        # Download remote images concurrently before rewriting any tags
+        images = soup.find_all('img')
+        remote_urls = [img.get('src', '') for img in images if img.get('src', '').startswith('http')]
+        fetched = {}
+        if remote_urls:
+            print(f"Fetching {len(set(remote_urls))} remote images...")
+            fetched = self._get_image_fetcher().fetch_all(remote_urls)
         
         # Extract and save images
-        img_index = 0
-        for img in soup.find_all('img'):
+        for img in images:
             img_url = img.get('src', '')
             if img_url:
                 if img_url.startswith('http'):
-                    try:
-                        response = requests.get(img_url, stream=True)
-                        if response.status_code == 200:
-                            img_ext = img_url.split('.')[-1].split('?')[0]
-                            if len(img_ext) > 5:  # Not a valid extension
-                                img_ext = 'png'
-                            
-                            img_filename = f"image_{img_index}.{img_ext}"
-                            img_path = os.path.join(self.images_dir, img_filename)
-                            
-                            with open(img_path, 'wb') as f:
-                                f.write(response.content)
-                            
-                            relative_path = os.path.join("images", img_filename)
-                            img['src'] = relative_path
-                            img_index += 1
-                    except Exception as e:
-                        print(f"Error downloading image {img_url}: {e}")
+                    img_filename = fetched.get(img_url)
+                    if img_filename and self.image_store.link(img_filename, self.images_dir):
+                        relative_path = os.path.join("images", img_filename)
+                        img['src'] = relative_path
                 elif img_url.startswith('data:image'):
                     # Handle base64 encoded images
                     try:
                         img_format = img_url.split(';')[0].split('/')[1]
-                        img_data = img_url.split(',')[1]
-                        img_filename = f"image_{img_index}.{img_format}"
-                        img_path = os.path.join(self.images_dir, img_filename)
-                        
-                        with open(img_path, 'wb') as f:
-                            f.write(base64.b64decode(img_data))
+                        data_start = img_url.index(',') + 1
+                        img_filename = self._save_base64_image(img_url, data_start, len(img_url), img_format)
                         
                         relative_path = os.path.join("images", img_filename)
                         img['src'] = relative_path
-                        img_index += 1
                     except Exception as e:
                         print(f"Error processing base64 image: {e}")
         
@@ -451,6 +2772,10 @@ class DocumentConverter:
         with open(output_path, 'w', encoding='utf-8') as f:
             f.write(markdown_content)
     
+    def _convert_legacy_office(self, input_path, output_path):
+        """Legacy binary .doc/.xls files reach here only when markitdown could not read them"""
+        raise ValueError(f"{input_path} is a legacy binary Office file; save it as .docx or .xlsx to convert it")
+    
     def _process_text(self, text_path, output_path):
         """Process text or markdown files, enhancing formatting if needed"""
         with open(text_path, 'r', encoding='utf-8') as f:
@@ -463,9 +2788,9 @@ class DocumentConverter:
             for img_match in re.finditer(image_pattern, content):
                 img_path = img_match.group(1)
                 if os.path.exists(img_path):
-                    img_filename = os.path.basename(img_path)
-                    target_path = os.path.join(self.images_dir, img_filename)
-                    shutil.copy(img_path, target_path)
+                    img_ext = img_path.rsplit('.', 1)[-1].lower() if '.' in os.path.basename(img_path) else 'png'
+                    img_filename = self.image_store.add_file(img_path, img_ext)
+                    self.image_store.link(img_filename, self.images_dir)
                     
                     # Update the image reference in the content
                     relative_path = os.path.join("images", img_filename)
@@ -475,52 +2800,87 @@ class DocumentConverter:
         with open(output_path, 'w', encoding='utf-8') as f:
             f.write(content)
     
-    def _extract_base64_images(self, markdown_path):
-        """Extract base64 images to files and update markdown references"""
-        with open(markdown_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+    def _extract_base64_images(self, document):
+        """Extract base64 images to files and update markdown references
         
-        # Find data URLs
-        pattern = r'!\[([^\]]*)\]\(data:image/([^;]+);base64,([^)]+)\)'
-        matches = list(re.finditer(pattern, content))
-        
-        if not matches:
+        Data URIs are located with plain substring searches rather than a regex over
+        the whole document, decoded in fixed-size pieces straight to disk, and
+        named by the SHA-256 of the decoded image, so identical images are stored
+        once across documents. The updated document is assembled from slices in
+        one join.
+        """
+        content = document.content
+        marker = "](data:image/"
+        pos = content.find(marker)
+        if pos < 0:
             return  # No base64 images found
-            
-        print(f"Found {len(matches)} base64-encoded images to extract")
         
-        def replace_match(match):
-            alt_text = match.group(1)
-            image_type = match.group(2)
-            base64_data = match.group(3)
+        parts = []
+        last = 0
+        extracted = 0
+        while pos >= 0:
+            alt_start = content.rfind("![", last, pos)
+            type_start = pos + len(marker)
+            data_marker = content.find(";base64,", type_start, type_start + 64)
+            end = content.find(")", data_marker)
             
-            # Generate image filename - FIX: Convert hash to string before slicing
-            img_filename = f"image_{str(hash(base64_data))[:8]}.{image_type}"
-            img_path = os.path.join(self.images_dir, img_filename)
+            # Only rewrite well-formed ![alt](data:image/<type>;base64,<data>) references
+            if alt_start < 0 or data_marker < 0 or end < 0 or "]" in content[alt_start + 2:pos]:
+                pos = content.find(marker, type_start)
+                continue
             
-            # Save image file
+            alt_text = content[alt_start + 2:pos]
+            image_type = content[type_start:data_marker]
             try:
-                with open(img_path, 'wb') as img_file:
-                    img_file.write(base64.b64decode(base64_data))
-                
-                print(f"Extracted image to {img_path}")
-                # Return updated markdown reference
-                return f'![{alt_text}](images/{img_filename})'
+                img_filename = self._save_base64_image(content, data_marker + len(";base64,"), end, image_type)
+                parts.append(content[last:alt_start])
+                parts.append(f"![{alt_text}](images/{img_filename})")
+                last = end + 1
+                extracted += 1
             except Exception as e:
-                print(f"Failed to extract image: {e}")
-                return match.group(0)  # Return original if failed
+                print(f"Failed to extract image: {e}")  # Keep the original reference
+            pos = content.find(marker, end)
         
-        # Replace all data URLs
-        updated_content = re.sub(pattern, replace_match, content)
-        
-        # Write updated markdown
-        with open(markdown_path, 'w', encoding='utf-8') as f:
-            f.write(updated_content)
+        if extracted:
+            parts.append(content[last:])
+            document.content = "".join(parts)
+            print(f"Extracted {extracted} base64-encoded images")
+    
+    def _save_base64_image(self, text, start, end, image_type):
+        """Decode text[start:end] as base64 into the image store, piece by piece
         
-    def _fix_placeholder_image_references(self, markdown_path):
+        Returns:
+            str: Filename derived from the SHA-256 of the decoded image, linked into images_dir
+        """
+        img_ext = image_type.split('+')[0].lower()  # e.g. svg+xml -> svg
+        digest = hashlib.sha256()
+        tmp_path = self.image_store.temp_path()
+        try:
+            with open(tmp_path, 'wb') as img_file:
+                carry = ""
+                for piece_start in range(start, end, BASE64_DECODE_CHUNK):
+                    piece = carry + "".join(text[piece_start:min(piece_start + BASE64_DECODE_CHUNK, end)].split())
+                    usable = len(piece) - len(piece) % 4
+                    data = base64.b64decode(piece[:usable])
+                    carry = piece[usable:]
+                    digest.update(data)
+                    img_file.write(data)
+                if carry:
+                    data = base64.b64decode(carry + "=" * (-len(carry) % 4))
+                    digest.update(data)
+                    img_file.write(data)
+            
+            img_filename = self.image_store.add_file(tmp_path, img_ext, digest=digest.hexdigest(), move=True)
+            self.image_store.link(img_filename, self.images_dir)
+            return img_filename
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    
+    def _fix_placeholder_image_references(self, document):
         """Replace placeholder image references with actual image paths"""
-        with open(markdown_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        content = document.content
         
         # Check for placeholder patterns
         if 'path_to_image' in content:
@@ -534,9 +2894,8 @@ class DocumentConverter:
             content = content.replace('(path_to_image1)', f'({sample_img1})')
             content = content.replace('(path_to_image2)', f'({sample_img2})')
             
-            with open(markdown_path, 'w', encoding='utf-8') as f:
-                f.write(content)    
-        
+            document.content = content
+    
     def _extract_tables_from_text(self, text):
         """Extract table-like structures from text"""
         # This is a simplified approach - in a real implementation, 
@@ -558,15 +2917,13 @@ class DocumentConverter:
         
         return tables
     
-    def _verify_image_paths(self, markdown_path):
+    def _verify_image_paths(self, document):
         """Verify image paths in markdown file and create HTML test file"""
-        with open(markdown_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        markdown_path = document.path
         
         # Extract image paths
-        import re
         image_regex = r'!\[.*?\]\((.*?)\)'
-        image_paths = re.findall(image_regex, content)
+        image_paths = re.findall(image_regex, document.content)
         
         if not image_paths:
             print("No image references found in markdown")
@@ -593,29 +2950,42 @@ class DocumentConverter:
         print(f"Open this file in a browser to check if images display correctly")
     
     
+    def _get_image_fetcher(self):
+        """Return the converter's remote image fetcher, creating it on first use"""
+        if self.image_fetcher is None:
+            self.image_fetcher = RemoteImageFetcher(
+                self.image_store,
+                max_workers=self.image_fetch_workers,
+                per_host_limit=self.image_fetch_per_host,
+                timeout=(min(5.0, self.image_fetch_timeout), self.image_fetch_timeout),
+                max_bytes=self.image_max_bytes,
+            )
+        return self.image_fetcher
+    
     def _convert_with_llm(self, content, source_format):
+        """Use LLM to convert content from various formats to Markdown (blocking)"""
+        try:
+            return self._run_async(self._convert_with_llm_async(content, source_format))
+        except Exception as e:
+            print(f"Error using LLM for conversion: {e}")
+            return None
+    
+    async def _convert_with_llm_async(self, content, source_format):
         """Use LLM to convert content from various formats to Markdown
         
+        The whole document is converted: content is split into token-budgeted
+        chunks at page and Markdown block boundaries (see MarkdownChunker), the
+        chunks are sent concurrently and the replies are stitched back together
+        in order.
+        
         Args:
-            content (str): The raw content to convert
+            content (str): The raw content to convert; PDF pages are separated by PAGE_BREAK
             source_format (str): The format of the source content (e.g., "pdf", "html")
             
         Returns:
             str: Converted markdown content or None if conversion failed
         """
         try:
-            # Get API key directly from command line args
-            import sys
-            api_key = None
-            for i, arg in enumerate(sys.argv):
-                if arg == '--api-key' and i+1 < len(sys.argv):
-                    api_key = sys.argv[i+1]
-                    break
-            
-            if not api_key:
-                print("Error: No API key found. Please provide --api-key parameter.")
-                return None
-            
             # Customize prompt based on source format
             if source_format == "pdf":
                 prompt = (
@@ -635,62 +3005,90 @@ class DocumentConverter:
                     f"Content to convert (preserve all text exactly):\n\n"
                 )
             
+            # Split into chunks small enough for one request each
+            spans = self.chunker.spans(content)
+            chunks = [self.chunker.request_text(content, span) for span in spans]
+            if not chunks:
+                return None
             
-            # Handle content size limitations
-            content_limit = 8000 if source_format == "pdf" else 10000
-            truncated_content = content[:content_limit]
-            prompt += truncated_content
-            
-            # Get site info from command line or use defaults
-            site_url = "example.com"
-            site_name = "Document Converter"
-            
-            for i, arg in enumerate(sys.argv):
-                if arg == '--site-url' and i+1 < len(sys.argv):
-                    site_url = sys.argv[i+1]
-                elif arg == '--site-name' and i+1 < len(sys.argv):
-                    site_name = sys.argv[i+1]
-            
-            # Create OpenAI client with OpenRouter API
-            client = OpenAI(
-                base_url="https://openrouter.ai/api/v1",
-                api_key=api_key,
-                default_headers={
-                    "HTTP-Referer": site_url,
-                    "X-Title": site_name
-                }
-            )
+            system_prompt = "You are a document conversion specialist."
+            total_chars = sum(len(chunk) for chunk in chunks)
+            total_tokens = sum(self.chunker.count(chunk) for chunk in chunks)
+            print(f"Sending {total_chars} characters ({total_tokens} tokens) to LLM for {source_format} "
+                  f"conversion in {len(chunks)} chunks...")
             
-            # Send the conversion request to the API
-            print(f"Sending content to LLM for {source_format} conversion...")
-            completion = client.chat.completions.create(
-                model="openai/gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are a document conversion specialist."},
-                    {"role": "user", "content": prompt}
-                ]
+            start = time.perf_counter()
+            replies = await self._dispatch_chunks(
+                system_prompt, [prompt + chunk for chunk in chunks], return_exceptions=True
             )
+            elapsed = time.perf_counter() - start
+            
+            # Keep the raw text for any chunk the LLM failed on rather than dropping it; the table
+            # header or fences repeated for a piece of a split block are dropped from its reply
+            converted_chunks = []
+            failed = 0
+            for (start, end, prefix, suffix), chunk, reply in zip(spans, chunks, replies):
+                if isinstance(reply, BaseException) or not reply:
+                    print(f"Error converting chunk with LLM: {reply}")
+                    converted_chunks.append(content[start:end].replace(PAGE_BREAK, "\n\n"))
+                    failed += 1
+                else:
+                    text = self._reply_text(reply, chunk)
+                    stripped = self.chunker.strip_repeated(text, prefix, suffix)
+                    converted_chunks.append(text if stripped is None else stripped)
+            
+            if failed == len(chunks):
+                return None
+            
+            self.llm_stats["chars"] += total_chars
+            self.llm_stats["tokens"] += total_tokens
+            self.llm_stats["chunks"] += len(chunks)
+            print(f"Successfully converted {total_chars} characters with LLM in {elapsed:.1f}s "
+                  f"({total_tokens / max(elapsed, 1e-6):.0f} tokens/sec, {failed} chunks kept as raw text)")
             
-            # Extract and return the converted markdown
-            converted_text = completion.choices[0].message.content
-            print(f"Successfully converted {len(truncated_content)} characters with LLM")
-            return converted_text
+            # Chunks are joined the way their source was: a piece of a split block continues
+            # the previous chunk's table, list or paragraph instead of starting a new block
+            parts = []
+            for index, text in enumerate(self._normalize_heading_levels(converted_chunks)):
+                if index:
+                    gap = content[spans[index - 1][1]:spans[index][0]]
+                    parts.append("\n\n" if gap.count("\n") >= 2 or PAGE_BREAK in gap else gap)
+                parts.append(text)
+            return "".join(parts)
             
         except Exception as e:
             print(f"Error using LLM for conversion: {e}")
             return None
+    
+    def _strip_code_fences(self, text):
+        """Remove a ```markdown fence the model sometimes wraps its reply in"""
+        text = re.sub(r'^\s*```(?:markdown|md)?\s*\n', '', text)
+        return re.sub(r'\n\s*```\s*$', '', text)
+    
+    def _reply_text(self, reply, request):
+        """An LLM reply without a wrapping fence, unless the request itself was fenced code"""
+        if self.chunker.FENCE_RE.match(request):
+            return reply
+        return self._strip_code_fences(reply)
+    
+    def _normalize_heading_levels(self, chunks):
+        """Keep heading levels consistent across separately converted chunks"""
+        normalizer = HeadingNormalizer()
+        return [normalizer.apply(chunk) for chunk in chunks]
 
-    def _enhance_with_llm(self, markdown_path):
-        """Enhance the converted markdown with LLM"""
+    def _enhance_with_llm(self, document):
+        """Enhance the converted markdown with LLM
+        
+        The document is chunked and each chunk is checked by MarkdownLinter; only
+        chunks with issues are sent, at most enhance_max_chunks of them (most
+        issues first), so well-formed documents cost no LLM calls and large ones
+        are enhanced where it matters rather than skipped. Replies are spliced
+        into the original text by offset, so every other chunk stays byte for
+        byte as it was.
+        """
         try:
-            with open(markdown_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            content = document.content
             
-            # Only process if the content isn't too long
-            if len(content) > 100000:
-                print("Content too long for LLM enhancement, skipping...")
-                return
-                
             prompt = """
             Review and enhance the following markdown content:
             1. Fix any formatting issues
@@ -702,63 +3100,487 @@ class DocumentConverter:
             Markdown content:
             """
             
-            # Process in chunks if needed
-            chunk_size = 8000
-            chunks = [content[i:i+chunk_size] for i in range(0, len(content), chunk_size)]
-            enhanced_content = []
-            
-            for i, chunk in enumerate(chunks):
-                completion = self.client.chat.completions.create(
-                    extra_headers={
-                        "HTTP-Referer": self.site_url, 
-                        "X-Title": self.site_name,
-                    },
-                    model="openai/gpt-4o",
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "You are a document formatting specialist. Fix markdown formatting issues without changing content."
-                        },
-                        {
-                            "role": "user",
-                            "content": f"{prompt}\n\n{chunk}"
-                        }
-                    ]
-                )
-                
-                enhanced_chunk = completion.choices[0].message.content
-                enhanced_content.append(enhanced_chunk)
+            # Token-budgeted chunks that never cut through a table, list or code block
+            spans = self.chunker.spans(content)
+            chunks = [self.chunker.request_text(content, span) for span in spans]
+            linter = MarkdownLinter(os.path.dirname(document.path))
+            issues = [linter.check(chunk) for chunk in chunks]
+            failing = [i for i in range(len(chunks)) if issues[i]]
+            if not failing:
+                print(f"Markdown passed lint in all {len(chunks)} chunks, skipping LLM enhancement")
+                return
+            
+            selected = sorted(sorted(failing, key=lambda i: len(issues[i]), reverse=True)[:self.enhance_max_chunks])
+            if not selected:
+                print(f"{len(failing)} of {len(chunks)} chunks failed lint, but enhance_max_chunks is "
+                      f"{self.enhance_max_chunks}; skipping LLM enhancement")
+                return
+            if self.defer_enhancement:
+                print(f"{len(failing)} of {len(chunks)} chunks failed lint, leaving LLM enhancement for later")
+                self._conversion_state["enhancement_pending"] = True
+                return
+            system_prompt = "You are a document formatting specialist. Fix markdown formatting issues without changing content."
+            tokens = sum(self.chunker.count(chunks[i]) for i in selected)
+            print(f"Enhancing {len(selected)} of {len(chunks)} chunks ({tokens} tokens, {self.chunker.tokenizer}); "
+                  f"{len(failing)} failed lint, e.g. {issues[selected[0]][0]}")
+            if len(selected) < len(failing):
+                print(f"Leaving {len(failing) - len(selected)} chunks with lint issues as they are "
+                      f"(limit of {self.enhance_max_chunks} chunks per document)")
             
-            # Combine enhanced chunks and write back to file
-            enhanced_full = '\n'.join(enhanced_content)
+            # Send the selected chunks concurrently; results come back in chunk order
+            replies = self._run_async(self._dispatch_chunks(
+                system_prompt, [f"{prompt}\n\n{chunks[i]}" for i in selected], return_exceptions=True,
+                priority="enhancement",
+            ))
+            self.llm_stats["chars"] += sum(len(chunks[i]) for i in selected)
+            self.llm_stats["tokens"] += tokens
+            self.llm_stats["chunks"] += len(selected)
             
-            # Strip any added markdown code fences if present
-            enhanced_full = re.sub(r'^```markdown\s*', '', enhanced_full)
-            enhanced_full = re.sub(r'\s*```$', '', enhanced_full)
+            # Splice the enhanced chunks into the original text; a chunk the LLM failed on,
+            # or whose reply lost the repeated table header or fences, keeps its original text
+            replacements = {}
+            for i, reply in zip(selected, replies):
+                if isinstance(reply, BaseException) or not reply:
+                    print(f"Error enhancing chunk {i + 1}: {reply}")
+                    continue
+                start, end, prefix, suffix = spans[i]
+                text = self.chunker.strip_repeated(self._reply_text(reply, chunks[i]), prefix, suffix)
+                if text is None:
+                    print(f"Keeping chunk {i + 1} as it was: the reply does not match its split table or code block")
+                    continue
+                replacements[i] = text
+            if not replacements:
+                return
             
-            with open(markdown_path, 'w', encoding='utf-8') as f:
-                f.write(enhanced_full)
+            parts = []
+            last = 0
+            for i in sorted(replacements):
+                start, end = spans[i][:2]
+                parts.append(content[last:start])
+                parts.append(replacements[i])
+                last = end
+            parts.append(content[last:])
+            document.content = "".join(parts)
                 
         except Exception as e:
             print(f"Error enhancing markdown: {e}")
 
-def main():
-    parser = argparse.ArgumentParser(description='Convert documents to Markdown with preserved formatting')
-    parser.add_argument('input_file', help='Input document file (PDF, DOCX, XLSX, HTML, MD)')
+    async def _chat_completion_async(self, system_prompt, user_prompt, semaphore, priority="conversion"):
+        """Send one chat completion, retrying rate limits and server errors with backoff
+        
+        Args:
+            system_prompt (str): System message for the model
+            user_prompt (str): User message for the model
+            semaphore (asyncio.Semaphore): Caps the number of requests in flight
+            priority (str): "conversion" or "enhancement", for the shared rate limiter
+            
+        Returns:
+            str: The model's reply
+        """
+        metrics = self.metrics
+        start = time.perf_counter()
+        cache_key = LLMResponseCache.make_key(LLM_MODEL, system_prompt, user_prompt)
+        if self.llm_cache:
+            cached = self.llm_cache.get(cache_key)
+            if cached is not None:
+                if metrics is not None:
+                    metrics.llm_call(time.perf_counter() - start, cached=True)
+                return cached
+        
+        # Expect a reply about as long as the prompt (conversion and clean-up both echo their input)
+        estimated_tokens = 2 * self.chunker.count(system_prompt + user_prompt)
+        queue_seconds = 0.0
+        attempt = 0
+        while True:
+            try:
+                async with semaphore:
+                    if self.rate_limiter:
+                        queue_seconds += await self.rate_limiter.acquire(estimated_tokens, priority)
+                    completion = await self.client.chat.completions.create(
+                        model=LLM_MODEL,
+                        messages=[
+                            {"role": "system", "content": system_prompt},
+                            {"role": "user", "content": user_prompt}
+                        ]
+                    )
+                reply = completion.choices[0].message.content
+                usage = getattr(completion, "usage", None)
+                prompt_tokens = (usage.prompt_tokens or 0) if usage is not None else 0
+                completion_tokens = (usage.completion_tokens or 0) if usage is not None else 0
+                self.llm_stats["prompt_tokens"] += prompt_tokens
+                self.llm_stats["completion_tokens"] += completion_tokens
+                if self.rate_limiter and usage is not None:
+                    await asyncio.to_thread(self.rate_limiter.settle, estimated_tokens,
+                                            prompt_tokens + completion_tokens)
+                if metrics is not None:
+                    metrics.llm_call(time.perf_counter() - start, prompt_tokens, completion_tokens,
+                                     retries=attempt, priority=priority, queue_seconds=queue_seconds)
+                if self.llm_cache:
+                    self.llm_cache.put(cache_key, reply)
+                return reply
+            except (openai.APIStatusError, openai.APIConnectionError) as e:
+                status = getattr(e, 'status_code', None)
+                retryable = status is None or status in RETRYABLE_STATUS_CODES
+                if not retryable or attempt >= self.llm_max_retries:
+                    raise
+                
+                # Honour Retry-After when the server sends one, otherwise back off exponentially
+                delay = None
+                response = getattr(e, 'response', None)
+                if response is not None:
+                    try:
+                        delay = float(response.headers.get('retry-after'))
+                    except (TypeError, ValueError):
+                        delay = None
+                if delay is None:
+                    delay = min(30.0, 0.5 * (2 ** attempt)) * (0.5 + random.random())
+                # The provider's limit is shared, so hold back every process using the limiter too
+                if status == 429 and self.rate_limiter:
+                    await asyncio.to_thread(self.rate_limiter.pause, delay)
+                
+                attempt += 1
+                print(f"LLM request failed ({status or type(e).__name__}), retry {attempt}/{self.llm_max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+    
+    async def _dispatch_chunks(self, system_prompt, user_prompts, return_exceptions=False, priority="conversion"):
+        """Send several prompts concurrently, at most llm_concurrency at a time
+        
+        Enhancement passes priority="enhancement" so conversion requests keep a
+        reserved share of a shared rate limit.
+        
+        Returns:
+            list: The replies in the same order as user_prompts; with return_exceptions,
+                  a failed prompt's slot holds its exception instead of aborting the rest
+        """
+        semaphore = asyncio.Semaphore(self.llm_concurrency)
+        print(f"Sending {len(user_prompts)} chunks to LLM ({self.llm_concurrency} at a time)...")
+        # PDF batches overlap, so count wall time while any dispatch is running, not the sum of them
+        if not self._llm_active:
+            self._llm_active_since = time.perf_counter()
+        self._llm_active += 1
+        try:
+            return await asyncio.gather(*(
+                self._chat_completion_async(system_prompt, user_prompt, semaphore, priority)
+                for user_prompt in user_prompts
+            ), return_exceptions=return_exceptions)
+        finally:
+            self._llm_active -= 1
+            if not self._llm_active:
+                self.llm_stats["seconds"] += time.perf_counter() - self._llm_active_since
+
+def collect_input_files(inputs, manifest_path=None, exclude_dir=None):
+    """Expand files, directories, glob patterns and manifest entries into a list of documents
+    
+    Args:
+        inputs (list): Paths, directories or glob patterns from the command line
+        manifest_path (str): Optional text file with one path or pattern per line
+        exclude_dir (str): Directory whose contents are never collected, normally the output directory
+        
+    Returns:
+        list: De-duplicated document paths in the order they were found
+    """
+    patterns = list(inputs)
+    if manifest_path:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    patterns.append(line)
+    
+    files = []
+    seen = set()
+    
+    def add(path):
+        key = os.path.abspath(path)
+        if key not in seen:
+            seen.add(key)
+            files.append(path)
+    
+    extensions = supported_extensions()
+    excluded = os.path.abspath(exclude_dir) if exclude_dir else None
+    
+    def is_excluded(path):
+        return excluded is not None and (os.path.abspath(path) + os.sep).startswith(excluded + os.sep)
+    
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, names in os.walk(pattern):
+                dirs[:] = [d for d in dirs if not is_excluded(os.path.join(root, d))]
+                for name in sorted(names):
+                    if name.lower().endswith(extensions):
+                        add(os.path.join(root, name))
+        elif os.path.isfile(pattern):
+            add(pattern)
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True))
+            if not matches:
+                print(f"Warning: no files match {pattern}")
+            for match in matches:
+                if is_excluded(match):
+                    continue
+                if os.path.isfile(match) and match.lower().endswith(extensions):
+                    add(match)
+    
+    return files
+
+# Each batch worker process builds one converter and keeps it for every file it is given,
+# so interpreter startup and the heavy imports are paid once per worker, not once per file
+_batch_converter = None
+
+def _init_batch_worker(converter_kwargs):
+    global _batch_converter
+    _batch_converter = DocumentConverter(**converter_kwargs)
+
+def _close_batch_worker():
+    global _batch_converter
+    if _batch_converter is not None:
+        _batch_converter.close()
+        _batch_converter = None
+
+def _convert_in_worker(input_path, force=False):
+    """Convert one document inside a batch worker and describe the outcome"""
+    result = {"input": input_path, "output": None, "status": "converted", "seconds": 0.0, "error": None}
+    start = time.perf_counter()
+    try:
+        if not force and _batch_converter.is_up_to_date(input_path):
+            result["status"] = "skipped"
+            result["output"] = _batch_converter.output_path_for(input_path)
+        else:
+            result["output"] = _batch_converter.convert_file(input_path)
+            result["enhancement_pending"] = bool(_batch_converter._conversion_state.get("enhancement_pending"))
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = str(e)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    if result["status"] != "skipped" and _batch_converter.last_metrics is not None:
+        result["metrics"] = _batch_converter.last_metrics
+    return result
+
+def _enhance_in_worker(input_path):
+    """Run a deferred LLM enhancement inside a batch worker and describe the outcome"""
+    result = {"input": input_path, "output": None, "status": "converted", "seconds": 0.0, "error": None}
+    start = time.perf_counter()
+    try:
+        result["output"] = _batch_converter.enhance_file(input_path)
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = str(e)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    if _batch_converter.last_metrics is not None:
+        result["metrics"] = _batch_converter.last_metrics
+    return result
+
+def _cost_of(path):
+    try:
+        return detect_format(path).cost
+    except (ValueError, OSError):
+        return None  # Scheduled last; the worker reports the failure
+
+def _size_of(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0  # Vanished or unreadable; the worker reports the failure
+
+def convert_batch(input_files, converter_kwargs, workers=1, force=False):
+    """Convert many documents, fanning them out across a process pool
+    
+    Args:
+        input_files (list): Document paths to convert
+        converter_kwargs (dict): Keyword arguments used to build each worker's DocumentConverter
+        workers (int): Number of worker processes (1 converts in this process)
+        force (bool): Re-convert documents whose output is already up to date
+        
+    Returns:
+        list: One result dict per document, in input order
+    """
+    # LLM-bound documents start first so their network waits overlap with CPU-bound ones;
+    # within a cost class the biggest go first so no worker is left with a long tail at the end
+    ordered = sorted(input_files, key=lambda p: (COST_ORDER.get(_cost_of(p), len(COST_ORDER)),
+                                                 -_size_of(p)))
+    results = {}
+    
+    if workers <= 1 or len(ordered) <= 1:
+        _init_batch_worker(converter_kwargs)
+        try:
+            for path in ordered:
+                results[path] = _convert_in_worker(path, force)
+                _print_batch_result(results[path], len(results), len(ordered))
+        finally:
+            _close_batch_worker()
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker,
+                                 initargs=(converter_kwargs,)) as executor:
+            futures = {executor.submit(_convert_in_worker, path, force): path for path in ordered}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    results[path] = future.result()
+                except Exception as e:
+                    # The worker process itself died (e.g. killed for memory)
+                    results[path] = {"input": path, "output": None, "status": "failed",
+                                     "seconds": 0.0, "error": str(e)}
+                _print_batch_result(results[path], len(results), len(ordered))
+    
+    return [results[path] for path in input_files]
+
+def _print_batch_result(result, done, total):
+    line = f"[{done}/{total}] {result['status'].upper()} {result['input']}"
+    if result["status"] == "failed":
+        line += f" - {result['error']}"
+    else:
+        line += f" -> {result['output']} ({result['seconds']}s)"
+    print(line)
+
+def add_converter_arguments(parser):
+    """Add the command-line options that configure a DocumentConverter"""
     parser.add_argument('--api-key', required=True, help='OpenRouter API key')
     parser.add_argument('--site-url', default="https://example.com", help='Your site URL for OpenRouter')
     parser.add_argument('--site-name', default="Document Converter", help='Your site name for OpenRouter')
+    parser.add_argument('--output-dir', default="markdown_output", help='Directory for Markdown output and images')
+    parser.add_argument('--llm-concurrency', type=int, default=4, help='Maximum LLM requests in flight per document')
+    parser.add_argument('--llm-chunk-tokens', type=int, default=LLM_CHUNK_TOKENS,
+                        help='Token budget for the content of one LLM request')
+    parser.add_argument('--llm-rpm', type=int, help='Requests per minute shared by every process using the same rate file')
+    parser.add_argument('--llm-tpm', type=int, help='Tokens per minute shared by every process using the same rate file')
+    parser.add_argument('--llm-rate-file', help='Shared rate limiter state (default: <output-dir>/.llm_rate.json)')
+    parser.add_argument('--enhance-max-chunks', type=int, default=ENHANCE_MAX_CHUNKS,
+                        help='Most chunks per document sent for LLM enhancement (chunks failing lint only)')
+    parser.add_argument('--no-cache', action='store_true', help='Bypass the on-disk LLM response cache')
+    parser.add_argument('--cache-dir', help='LLM response cache directory (default: <output-dir>/.llm_cache)')
+    parser.add_argument('--cache-size-mb', type=int, default=256, help='Maximum size of the LLM response cache')
+    parser.add_argument('--page-cache-size-mb', type=int, default=512,
+                        help='Maximum size of the PDF page and OCR cache under <output-dir>/.page_cache')
+    parser.add_argument('--llm-timeout', type=float, default=120.0, help='Read timeout for LLM requests in seconds')
+    parser.add_argument('--llm-connect-timeout', type=float, default=10.0,
+                        help='Connect timeout for LLM requests in seconds')
+    parser.add_argument('--llm-max-connections', type=int, default=20, help='Size of the shared LLM connection pool')
+    parser.add_argument('--no-http2', action='store_true', help='Use HTTP/1.1 for LLM requests')
+    parser.add_argument('--image-workers', type=int, help='Processes for PDF image extraction (default: CPU count)')
+    parser.add_argument('--page-image-dpi', type=int, default=72, help='DPI for PDF pages rendered as images')
+    parser.add_argument('--page-image-format', choices=['png', 'jpg'], default='png', help='Format for rendered PDF pages')
+    parser.add_argument('--layout-threshold', type=float, default=LAYOUT_CONFIDENCE_THRESHOLD,
+                        help='Layout confidence at which a PDF page is written without the LLM (above 1 sends every page)')
+    parser.add_argument('--no-ocr', action='store_true', help='Do not OCR scanned PDF pages')
+    parser.add_argument('--ocr-dpi', type=int, default=300, help='DPI at which scanned PDF pages are rasterised for OCR')
+    parser.add_argument('--ocr-lang', default="eng", help='Tesseract language(s) for OCR, e.g. eng+deu')
+    parser.add_argument('--ocr-workers', type=int, help='Processes for OCR (default: CPU count)')
+    parser.add_argument('--excel-max-rows', type=int, help='Maximum data rows written per Excel sheet')
+    parser.add_argument('--excel-sample-every', type=int, default=1, help='Write only every Nth data row of each Excel sheet')
+    parser.add_argument('--image-fetch-workers', type=int, default=8, help='Concurrent remote image downloads for HTML')
+    parser.add_argument('--image-fetch-per-host', type=int, default=4, help='Concurrent downloads allowed per host')
+    parser.add_argument('--image-fetch-timeout', type=float, default=30.0, help='Read timeout for remote images in seconds')
+    parser.add_argument('--image-max-mb', type=float, default=20, help='Largest remote image to download, in MB')
+    parser.add_argument('--markitdown-backend', choices=['auto', 'inprocess', 'worker', 'cli', 'none'], default='auto',
+                        help='How to run markitdown: library in this process, a persistent worker process, the CLI per file, or not at all')
+    parser.add_argument('--markitdown-python', help='Interpreter for the markitdown worker (default: this one)')
+    parser.add_argument('--profile-dir', help='Save a cProfile .prof file per document in this directory')
+    parser.add_argument('--trace-memory', action='store_true', help='Record peak traced memory and top allocation sites per document')
+    parser.add_argument('--base-url', default="https://openrouter.ai/api/v1", help='OpenAI-compatible API endpoint')
+
+def converter_kwargs_from_args(args):
+    """DocumentConverter keyword arguments for options added by add_converter_arguments"""
+    return {
+        "openrouter_api_key": args.api_key,
+        "site_url": args.site_url,
+        "site_name": args.site_name,
+        "output_dir": args.output_dir,
+        "base_url": args.base_url,
+        "llm_concurrency": args.llm_concurrency,
+        "llm_chunk_tokens": args.llm_chunk_tokens,
+        "llm_rpm": args.llm_rpm,
+        "llm_tpm": args.llm_tpm,
+        "llm_rate_file": args.llm_rate_file,
+        "enhance_max_chunks": args.enhance_max_chunks,
+        "use_cache": not args.no_cache,
+        "cache_dir": args.cache_dir,
+        "cache_max_mb": args.cache_size_mb,
+        "page_cache_max_mb": args.page_cache_size_mb,
+        "llm_timeout": args.llm_timeout,
+        "llm_connect_timeout": args.llm_connect_timeout,
+        "llm_max_connections": args.llm_max_connections,
+        "llm_http2": not args.no_http2,
+        "image_workers": args.image_workers,
+        "page_image_dpi": args.page_image_dpi,
+        "page_image_format": args.page_image_format,
+        "layout_threshold": args.layout_threshold,
+        "ocr": not args.no_ocr,
+        "ocr_dpi": args.ocr_dpi,
+        "ocr_lang": args.ocr_lang,
+        "ocr_workers": args.ocr_workers,
+        "excel_max_rows": args.excel_max_rows,
+        "excel_sample_every": args.excel_sample_every,
+        "image_fetch_workers": args.image_fetch_workers,
+        "image_fetch_per_host": args.image_fetch_per_host,
+        "image_fetch_timeout": args.image_fetch_timeout,
+        "image_max_bytes": int(args.image_max_mb * 1024 * 1024),
+        "markitdown_backend": args.markitdown_backend,
+        "markitdown_python": args.markitdown_python,
+        "profile_dir": args.profile_dir,
+        "trace_memory": args.trace_memory,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert documents to Markdown with preserved formatting')
+    parser.add_argument('inputs', nargs='*',
+                        help='Input document files, directories or glob patterns (PDF, DOCX, XLSX, HTML, MD)')
+    parser.add_argument('--manifest', help='Text file listing input files, directories or globs, one per line')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes for batch conversion')
+    parser.add_argument('--force', action='store_true', help='Re-convert documents whose output is already up to date')
+    parser.add_argument('--report', help='Write per-file batch results to this JSON file')
+    parser.add_argument('--metrics-file', help='Write per-document stage timings, LLM calls and sizes to this file')
+    parser.add_argument('--metrics-format', choices=['jsonl', 'prometheus'], default='jsonl',
+                        help='JSON lines appended per document, or a Prometheus text file of totals')
+    parser.add_argument('--prune-caches', action='store_true',
+                        help='Trim the LLM and page caches to their size caps and delete stored images '
+                             'no document links to, then convert any inputs given')
+    add_converter_arguments(parser)
     
     args = parser.parse_args()
     
-    converter = DocumentConverter(
-        openrouter_api_key=args.api_key,
-        site_url=args.site_url,
-        site_name=args.site_name
-    )
+    converter_kwargs = converter_kwargs_from_args(args)
+    if args.prune_caches:
+        converter = DocumentConverter(**converter_kwargs)
+        try:
+            pruned = converter.prune_caches()
+        finally:
+            converter.close()
+        print(f"Pruned caches: LLM cache {pruned['llm_cache_bytes'] / 1e6:.1f} MB, "
+              f"page cache {pruned['page_cache_bytes'] / 1e6:.1f} MB, "
+              f"{pruned['images_removed']} unreferenced images removed")
+        if not args.inputs and not args.manifest:
+            return
+    
+    input_files = collect_input_files(args.inputs, args.manifest, exclude_dir=args.output_dir)
+    if not input_files:
+        parser.error("no input documents found")
+    
+    # Documents already run in parallel in batch mode, so keep image extraction and OCR in-process there
+    if args.workers > 1 and args.image_workers is None:
+        converter_kwargs["image_workers"] = 1
+    if args.workers > 1 and args.ocr_workers is None:
+        converter_kwargs["ocr_workers"] = 1
+    
+    start = time.perf_counter()
+    results = convert_batch(input_files, converter_kwargs, workers=args.workers, force=args.force)
+    elapsed = time.perf_counter() - start
+    
+    counts = {status: sum(1 for r in results if r["status"] == status)
+              for status in ("converted", "skipped", "failed")}
+    print(f"Processed {len(results)} documents in {elapsed:.1f}s: "
+          f"{counts['converted']} converted, {counts['skipped']} skipped, {counts['failed']} failed")
+    
+    if args.metrics_file:
+        write_metrics(args.metrics_file, [r["metrics"] for r in results if r.get("metrics")], args.metrics_format)
+        print(f"Wrote metrics to {args.metrics_file}")
+    
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump({"elapsed_seconds": round(elapsed, 3), "results": results}, f, indent=2)
+        print(f"Wrote batch report to {args.report}")
     
-    output_path = converter.convert_file(args.input_file)
-    print(f"Document successfully converted to {output_path}")
+    if counts["failed"]:
+        raise SystemExit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,40 @@
+import socket
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from conversion_service import ServiceHandler
+
+
+@pytest.fixture
+def service_address():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ServiceHandler)
+    server.daemon_threads = True
+    server.service = None  # Requests refused before they reach the service
+    server.max_upload_bytes = 1000
+    server.max_wait = 1
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address
+    server.shutdown()
+    server.server_close()
+
+
+def post_status(address, headers):
+    """Send a bodiless POST /jobs with exactly these headers and return the reply's status code"""
+    with socket.create_connection(address, timeout=5) as sock:
+        request = "POST /jobs?filename=a.pdf HTTP/1.1\r\nHost: test\r\n" + "".join(f"{h}\r\n" for h in headers) + "\r\n"
+        sock.sendall(request.encode())
+        return int(sock.makefile('rb').readline().split()[1])
+
+
+@pytest.mark.parametrize("headers, status", [
+    ([], 411),
+    (["Content-Length: abc"], 400),
+    (["Content-Length: -5"], 400),
+    (["Content-Length: 1001"], 413),
+    (["Content-Type: application/json", "Content-Length: 100000"], 413),
+])
+def test_bad_content_length_is_refused_before_reading(service_address, headers, status):
+    assert post_status(service_address, headers) == status
@@ -0,0 +1,541 @@
+import io
+import os
+import zlib
+import base64
+import struct
+import asyncio
+import hashlib
+
+import pytest
+
+import doc_to_markdown as d
+from benchmark import StubImageServer, StubLLMServer
+
+
+def make_converter(tmp_path, **kwargs):
+    kwargs.setdefault("use_cache", False)
+    converter = d.DocumentConverter("stub-key", output_dir=str(tmp_path / "out"), **kwargs)
+    return converter
+
+
+class Document:
+    """Stand-in for MarkdownDocument without a file on disk"""
+
+    def __init__(self, content, path):
+        self.content = content
+        self.path = path
+
+
+def echo_dispatch(marker):
+    """A _dispatch_chunks replacement that returns each chunk's text unchanged"""
+    async def dispatch(system_prompt, user_prompts, return_exceptions=False, priority="conversion"):
+        return [prompt.split(marker, 1)[1] for prompt in user_prompts]
+    return dispatch
+
+
+# --- LLM dispatch against a local OpenAI-compatible server
+
+@pytest.fixture
+def llm_converter(tmp_path):
+    pytest.importorskip("openai")
+    pytest.importorskip("httpx")
+
+    def build(server, **kwargs):
+        return make_converter(tmp_path, base_url=server.base_url, llm_http2=False, **kwargs)
+    return build
+
+
+def test_dispatch_returns_replies_in_order_within_concurrency(llm_converter):
+    with StubLLMServer(latency=0.05) as server:
+        converter = llm_converter(server, llm_concurrency=3)
+        try:
+            prompts = [f"chunk {i}" for i in range(12)]
+            replies = converter._run_async(converter._dispatch_chunks("system", prompts))
+        finally:
+            converter.close()
+    assert replies == prompts
+    assert server.max_in_flight <= 3
+
+
+def test_dispatch_retries_rate_limited_requests(llm_converter):
+    with StubLLMServer(latency=0.0, error_rate=0.5) as server:
+        converter = llm_converter(server, llm_concurrency=4, llm_max_retries=30)
+        try:
+            prompts = [f"chunk {i}" for i in range(10)]
+            replies = converter._run_async(converter._dispatch_chunks("system", prompts))
+        finally:
+            converter.close()
+    assert replies == prompts
+    assert server.requests > len(prompts)
+
+
+def test_dispatch_keeps_failed_slots_with_return_exceptions(llm_converter):
+    with StubLLMServer(latency=0.0, error_rate=1.0) as server:
+        converter = llm_converter(server, llm_max_retries=0)
+        try:
+            replies = converter._run_async(converter._dispatch_chunks("system", ["a", "b"], return_exceptions=True))
+        finally:
+            converter.close()
+    assert all(isinstance(reply, Exception) for reply in replies)
+
+
+def test_run_async_gives_up_on_a_wedged_loop(tmp_path):
+    converter = make_converter(tmp_path)
+    try:
+        with pytest.raises(TimeoutError):
+            converter._run_async(asyncio.sleep(5), timeout=0.1)
+    finally:
+        converter.close()
+
+
+# --- Remote image fetching against a local HTTP server
+
+def test_fetcher_stores_identical_images_once(tmp_path):
+    pytest.importorskip("requests")
+    converter = make_converter(tmp_path, image_fetch_workers=4)
+    try:
+        with StubImageServer(latency=0.0, image_size=1000) as server:
+            urls = [f"{server.base_url}/img/1.png", f"{server.base_url}/dup/1.png", f"{server.base_url}/dup/2.png"]
+            fetched = converter._get_image_fetcher().fetch_all(urls)
+    finally:
+        converter.close()
+    assert fetched[urls[1]] == fetched[urls[2]]
+    assert fetched[urls[0]] != fetched[urls[1]]
+    assert len(os.listdir(converter.image_store.store_dir)) == 2
+
+
+def test_fetcher_retries_a_url_that_failed(tmp_path):
+    pytest.importorskip("requests")
+    converter = make_converter(tmp_path)
+    try:
+        with StubImageServer(latency=0.0, image_size=1000) as server:
+            url = f"{server.base_url}/flaky/3.png"
+            fetcher = converter._get_image_fetcher()
+            assert fetcher.fetch(url) is None
+            assert fetcher.fetch(url)
+    finally:
+        converter.close()
+
+
+# --- MarkdownChunker
+
+LONG_TABLE = "| a | b |\n| --- | --- |\n" + "\n".join(f"| row {i} | value {i} |" for i in range(300))
+LONG_PARAGRAPH = " ".join(f"word{i}" for i in range(1500))
+LONG_CODE = "```python\n" + "\n".join(f"x{i} = {i}" for i in range(400)) + "\n```"
+DOCUMENT = f"# Title\n\nIntro.\n\n{LONG_TABLE}\n\n{LONG_PARAGRAPH}\n\n{LONG_CODE}\n\nEnd."
+
+
+def test_chunker_respects_budget_and_covers_text():
+    chunker = d.MarkdownChunker(200)
+    spans = chunker.spans(DOCUMENT)
+    assert all(chunker.count(chunker.request_text(DOCUMENT, span)) <= 200 for span in spans)
+    # Slices plus the text between them rebuild the document exactly
+    rebuilt, last = [], 0
+    for start, end, _, _ in spans:
+        rebuilt.append(DOCUMENT[last:end])
+        last = end
+    assert "".join(rebuilt) + DOCUMENT[last:] == DOCUMENT
+
+
+def test_chunker_repeats_table_header_in_requests_only():
+    chunker = d.MarkdownChunker(200)
+    spans = chunker.spans(DOCUMENT)
+    requests = [chunker.request_text(DOCUMENT, span) for span in spans]
+    assert sum(request.count("| a | b |") for request in requests) > 1
+    for span, request in zip(spans, requests):
+        start, end, prefix, suffix = span
+        assert chunker.strip_repeated(request, prefix, suffix) == DOCUMENT[start:end]
+
+
+def test_chunker_rejects_reply_without_repeated_header():
+    chunker = d.MarkdownChunker(200)
+    span = next(span for span in chunker.spans(DOCUMENT) if span[2].startswith("| a | b |"))
+    assert chunker.strip_repeated("| row 9 | value 9 |", span[2], span[3]) is None
+
+
+def test_chunker_carries_trailing_heading():
+    chunker = d.MarkdownChunker(40)
+    text = "para one " * 12 + "\n\n## Heading\n\n" + "para two " * 12
+    for chunk in chunker.chunk(text):
+        assert not chunk.rstrip().endswith("## Heading")
+
+
+def test_llm_conversion_output_has_one_table_header(tmp_path):
+    converter = make_converter(tmp_path, llm_chunk_tokens=200)
+    converter._dispatch_chunks = echo_dispatch("Content to convert (preserve all text exactly):\n\n")
+    try:
+        converted = asyncio.run(converter._convert_with_llm_async(DOCUMENT, "html"))
+    finally:
+        converter.close()
+    assert converted == DOCUMENT
+    assert converted.count("| a | b |") == 1
+
+
+# --- MarkdownLinter and lint-gated enhancement
+
+def test_linter_flags_common_problems(tmp_path):
+    linter = d.MarkdownLinter(str(tmp_path))
+    assert linter.check("| a | b |\n| --- | --- |\n| 1 | 2 | 3 |")
+    assert linter.check("#Heading")
+    assert linter.check("```\ncode")
+    assert linter.check("![x](images/missing.png)")
+    assert linter.check("# Title\n\nText.\n\n## Section") == []
+
+
+def test_linter_accepts_escaped_pipes():
+    linter = d.MarkdownLinter(".")
+    assert linter.check("| a | b |\n| --- | --- |\n| x \\| y | z |") == []
+
+
+def test_enhancement_splices_only_failing_chunks(tmp_path):
+    converter = make_converter(tmp_path, llm_chunk_tokens=200)
+    marker = "Markdown content:\n            \n\n"
+    converter._dispatch_chunks = echo_dispatch(marker)
+    sent = []
+
+    async def fixing_dispatch(system_prompt, user_prompts, return_exceptions=False, priority="conversion"):
+        sent.extend(user_prompts)
+        return [prompt.split(marker, 1)[1].replace("#Broken", "# Broken") for prompt in user_prompts]
+    converter._dispatch_chunks = fixing_dispatch
+    converter._run_async = asyncio.run
+
+    content = DOCUMENT.replace("\n\nEnd.", "\n\n#Broken\n\nEnd.")
+    document = Document(content, str(tmp_path / "doc.md"))
+    try:
+        converter._enhance_with_llm(document)
+    finally:
+        converter.close()
+    assert len(sent) == 1
+    assert document.content == content.replace("#Broken", "# Broken")
+
+
+def test_enhancement_with_no_chunk_budget_leaves_document_alone(tmp_path, capsys):
+    converter = make_converter(tmp_path, enhance_max_chunks=0)
+    sent = []
+
+    async def dispatch(system_prompt, user_prompts, return_exceptions=False, priority="conversion"):
+        sent.extend(user_prompts)
+        return user_prompts
+    converter._dispatch_chunks = dispatch
+    document = Document("#Broken\n\nText.", str(tmp_path / "doc.md"))
+    try:
+        converter._enhance_with_llm(document)
+    finally:
+        converter.close()
+    assert sent == []
+    assert document.content == "#Broken\n\nText."
+    assert "Error" not in capsys.readouterr().out
+
+
+def test_deferred_enhancement_stays_pending_until_enhance_file(tmp_path):
+    source = tmp_path / "doc.md"
+    source.write_text("# Title\n\n#Broken\n\nText.\n")
+    converter = make_converter(tmp_path, defer_enhancement=True, markitdown_backend="none")
+    marker = "Markdown content:\n            \n\n"
+    sent = []
+
+    async def fixing_dispatch(system_prompt, user_prompts, return_exceptions=False, priority="conversion"):
+        sent.extend(user_prompts)
+        return [prompt.split(marker, 1)[1].replace("#Broken", "# Broken") for prompt in user_prompts]
+    converter._dispatch_chunks = fixing_dispatch
+    converter._run_async = asyncio.run
+    try:
+        output_path = converter.convert_file(str(source))
+        assert sent == []
+        assert not converter.is_up_to_date(str(source))
+        converter.enhance_file(str(source))
+        assert converter.is_up_to_date(str(source))
+    finally:
+        converter.close()
+    assert len(sent) == 1
+    with open(output_path, encoding='utf-8') as f:
+        assert "# Broken" in f.read()
+
+
+# --- Base64 image extraction and the image store
+
+def test_base64_scanner_decodes_in_pieces_and_names_by_content(tmp_path, monkeypatch):
+    monkeypatch.setattr(d, "BASE64_DECODE_CHUNK", 7)
+    converter = make_converter(tmp_path)
+    converter.images_dir = str(tmp_path / "images")
+    os.makedirs(converter.images_dir, exist_ok=True)
+    image = b"PNGDATA" * 50
+    data = base64.b64encode(image).decode()
+    wrapped = "\n".join(data[i:i + 20] for i in range(0, len(data), 20))
+    document = Document(f"![a](data:image/png;base64,{wrapped}) and ![b](data:image/png;base64,{data})", None)
+    try:
+        converter._extract_base64_images(document)
+    finally:
+        converter.close()
+    filename = document.content.split("images/")[1].split(")")[0]
+    assert hashlib.sha256(image).hexdigest()[:16] in filename
+    assert document.content == f"![a](images/{filename}) and ![b](images/{filename})"
+    with open(os.path.join(converter.images_dir, filename), 'rb') as f:
+        assert f.read() == image
+
+
+def test_base64_scanner_keeps_malformed_references(tmp_path):
+    converter = make_converter(tmp_path)
+    document = Document("![x](data:image/png;base64,AAAA", None)
+    try:
+        converter._extract_base64_images(document)
+    finally:
+        converter.close()
+    assert document.content == "![x](data:image/png;base64,AAAA"
+
+
+def test_base64_images_are_stored_once_and_linked_per_document(tmp_path):
+    converter = make_converter(tmp_path)
+    data = base64.b64encode(b"PNGDATA" * 500).decode()
+    contents = []
+    try:
+        for name in ("a", "b"):
+            converter.images_dir = str(tmp_path / "out" / name / "images")
+            document = Document(f"before ![logo](data:image/png;base64,{data}) after", None)
+            converter._extract_base64_images(document)
+            contents.append(document.content)
+    finally:
+        converter.close()
+    assert contents[0] == contents[1]
+    filename = contents[0].split("images/")[1].split(")")[0]
+    assert contents[0] == f"before ![logo](images/{filename}) after"
+    assert os.listdir(converter.image_store.store_dir) == [filename]
+    for name in ("a", "b"):
+        with open(tmp_path / "out" / name / "images" / filename, 'rb') as f:
+            assert f.read() == b"PNGDATA" * 500
+
+
+# --- DOCX conversion
+
+def test_page_cache_evicts_least_recently_used_files(tmp_path):
+    for age, name in enumerate(("new.json", "ocr/middle.txt", "old.json")):
+        path = tmp_path / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_text("x" * 100)
+        os.utime(path, (1000 - age, 1000 - age))
+    (tmp_path / "ignored.tmp").write_text("x" * 100)
+    assert d.evict_lru(str(tmp_path), 250, d.PAGE_CACHE_SUFFIXES) == 200
+    assert not (tmp_path / "old.json").exists()
+    assert (tmp_path / "new.json").exists() and (tmp_path / "ocr" / "middle.txt").exists()
+
+
+def test_image_store_prune_keeps_linked_and_recent_images(tmp_path):
+    store = d.ImageStore(str(tmp_path / "store"))
+    linked = store.add_bytes(b"linked", "png")
+    orphan = store.add_bytes(b"orphan", "png")
+    recent = store.add_bytes(b"recent", "png")
+    store.link(linked, str(tmp_path / "doc" / "images"))
+    for name in (linked, orphan):
+        os.utime(os.path.join(store.store_dir, name), (0, 0))
+    assert store.prune() == 1
+    assert sorted(os.listdir(store.store_dir)) == sorted([linked, recent])
+
+
+def tiny_png(shade):
+    """A valid 1x1 grey PNG, different for each shade"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(bytes([0, shade]))) + chunk(b"IEND", b""))
+
+
+def test_docx_images_are_kept_wherever_they_are_anchored(tmp_path):
+    docx = pytest.importorskip("docx")
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls
+
+    document = docx.Document()
+    document.add_heading("Report", level=1)
+    document.add_paragraph("Intro.").add_run().add_picture(io.BytesIO(tiny_png(1)))
+    table = document.add_table(rows=2, cols=2)
+    table.cell(0, 0).text = "Name"
+    table.cell(1, 0).paragraphs[0].add_run().add_picture(io.BytesIO(tiny_png(2)))
+    # A legacy VML picture, as older Word versions wrote them
+    rel_id, _ = document.part.get_or_add_image(io.BytesIO(tiny_png(3)))
+    document.add_paragraph("Legacy.")._p.append(parse_xml(
+        f'<w:r {nsdecls("w", "r")} xmlns:v="urn:schemas-microsoft-com:vml"><w:pict><v:shape>'
+        f'<v:imagedata r:id="{rel_id}"/></v:shape></w:pict></w:r>'))
+    # A picture inside a content control, which the body walk does not enter
+    anchored = document.add_paragraph()
+    anchored.add_run().add_picture(io.BytesIO(tiny_png(4)))
+    sdt = parse_xml(f'<w:sdt {nsdecls("w")}><w:sdtContent/></w:sdt>')
+    anchored._p.addprevious(sdt)
+    sdt[0].append(anchored._p)
+    source = tmp_path / "report.docx"
+    document.save(str(source))
+
+    converter = make_converter(tmp_path)
+    converter.images_dir = str(tmp_path / "images")
+    output_path = tmp_path / "report.md"
+    try:
+        converter._convert_docx(str(source), str(output_path))
+    finally:
+        converter.close()
+    markdown = output_path.read_text()
+    images = [line for line in markdown.split("\n\n") if line.startswith("![Image]")]
+    assert len(images) == 4
+    assert markdown.startswith("# Report\n\nIntro.\n\n![Image]")
+    assert markdown.index("| Name |") < markdown.index(images[1]) < markdown.index("Legacy.") < markdown.index(images[2])
+    assert markdown.endswith(images[3])
+
+
+# --- Excel conversion
+
+@pytest.mark.parametrize("data_rows, trailing_empty, max_rows, sample_every, note", [
+    (5, 0, 5, 1, False),  # Exactly the limit
+    (6, 0, 5, 1, True),
+    (5, 3, 5, 1, False),  # Only empty rows past the limit
+    (1, 0, None, 2, False),  # Sampling skipped nothing
+    (4, 0, None, 2, True),
+])
+def test_excel_notes_only_rows_really_left_out(tmp_path, data_rows, trailing_empty, max_rows, sample_every, note):
+    openpyxl = pytest.importorskip("openpyxl")
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(["Name", "Value"])
+    for i in range(data_rows):
+        sheet.append([f"row {i}", i])
+    for _ in range(trailing_empty):
+        sheet.append([None, None])
+    source = tmp_path / "book.xlsx"
+    workbook.save(str(source))
+
+    converter = make_converter(tmp_path, excel_max_rows=max_rows, excel_sample_every=sample_every)
+    output_path = tmp_path / "book.md"
+    try:
+        converter._convert_excel(str(source), str(output_path))
+    finally:
+        converter.close()
+    markdown = output_path.read_text()
+    assert ("sampled data rows" in markdown) == note
+    assert markdown.count("| row ") == min(data_rows, max_rows or data_rows, -(-data_rows // sample_every))
+
+
+# --- LLMRateLimiter
+
+def test_rate_limiter_reserves_capacity_for_conversion(tmp_path):
+    limiter = d.LLMRateLimiter(str(tmp_path / "rate.json"), requests_per_minute=60)
+    # Enhancement may take everything above the 20% reserve, and no more
+    assert [limiter._take(10, "enhancement") for _ in range(48)] == [0.0] * 48
+    assert limiter._take(10, "enhancement") > 0
+    assert limiter._take(10, "conversion") == 0.0
+
+
+def test_rate_limiter_counts_waits_per_priority(tmp_path):
+    limiter = d.LLMRateLimiter(str(tmp_path / "rate.json"), requests_per_minute=60)
+    asyncio.run(limiter.acquire(10, "enhancement"))
+    asyncio.run(limiter.acquire(10, "conversion"))
+    assert limiter.delays["enhancement"][0] == 1
+    assert limiter.delays["conversion"][0] == 1
+
+
+def test_rate_limiter_state_is_shared_through_its_file(tmp_path):
+    path = str(tmp_path / "rate.json")
+    first = d.LLMRateLimiter(path, tokens_per_minute=60)
+    second = d.LLMRateLimiter(path, tokens_per_minute=60)
+    assert first._take(60, "conversion") == 0.0
+    assert second._take(30, "conversion") > 0
+
+
+def test_rate_limiter_pause_holds_every_priority(tmp_path):
+    limiter = d.LLMRateLimiter(str(tmp_path / "rate.json"), requests_per_minute=600)
+    limiter.pause(30)
+    assert limiter._take(1, "conversion") > 20
+
+
+# --- PdfLayoutAnalyzer
+
+def layout_line(text, x0, y0, width=200, size=10):
+    return {"spans": [{"text": text, "size": size, "flags": 0, "font": "Times"}],
+            "bbox": (x0, y0, x0 + width, y0 + 10), "dir": (1.0, 0.0)}
+
+
+def test_layout_detects_a_table_and_headings():
+    rows = [["Name", "Qty", "Price"], ["Apple", "3", "1.20"], ["Pear", "10", "0.80"]]
+    blocks = [{"type": 0, "lines": [layout_line("Fruit prices", 50, 50, size=20)]}]
+    blocks += [{"type": 0, "lines": [layout_line(text, x, 100 + 14 * r, width=60)]}
+               for r, row in enumerate(rows) for text, x in zip(row, (50, 200, 350))]
+    markdown, _, confidence = d.PdfLayoutAnalyzer().analyze({"blocks": blocks})
+    assert markdown.startswith("# Fruit prices")
+    assert "| Name | Qty | Price |\n| --- | --- | --- |\n| Apple | 3 | 1.20 |" in markdown
+    assert confidence == 1.0
+
+
+def prose_lines(count, column):
+    return [f"{column} column line {i} with some ordinary words in it" for i in range(count)]
+
+
+def test_layout_reads_two_column_prose_as_columns():
+    left, right = prose_lines(12, "left"), prose_lines(12, "right")
+    page = {"blocks": [
+        {"type": 0, "lines": [layout_line(text, 50, 100 + 14 * i) for i, text in enumerate(left)]},
+        {"type": 0, "lines": [layout_line(text, 320, 100 + 14 * i) for i, text in enumerate(right)]},
+    ]}
+    markdown, _, confidence = d.PdfLayoutAnalyzer().analyze(page)
+    assert "|" not in markdown
+    assert markdown.index(left[-1]) < markdown.index(right[0])
+    assert confidence < d.LAYOUT_CONFIDENCE_THRESHOLD
+
+
+# --- Batch input collection
+
+def test_collect_input_files_skips_output_directory(tmp_path):
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "a.md").write_text("# A")
+    out = tmp_path / "docs" / "out"
+    (out / "a.md-1234").mkdir(parents=True)
+    (out / "a.md-1234" / "a.md").write_text("# A")
+    found = d.collect_input_files([str(tmp_path / "docs")], exclude_dir=str(out))
+    assert found == [str(tmp_path / "docs" / "a.md")]
+    found = d.collect_input_files([str(tmp_path / "docs" / "**" / "*.md")], exclude_dir=str(out))
+    assert found == [str(tmp_path / "docs" / "a.md")]
+
+
+def test_convert_batch_starts_largest_first_and_reports_in_input_order(tmp_path, monkeypatch):
+    paths = []
+    for name, size in (("small.md", 10), ("large.md", 1000), ("medium.md", 100)):
+        (tmp_path / name).write_text("x" * size)
+        paths.append(str(tmp_path / name))
+    started = []
+
+    def convert(path, force=False):
+        started.append(path)
+        return {"input": path, "output": path, "status": "converted", "seconds": 0.0, "error": None}
+    monkeypatch.setattr(d, "_init_batch_worker", lambda converter_kwargs: None)
+    monkeypatch.setattr(d, "_convert_in_worker", convert)
+    results = d.convert_batch(paths, {}, workers=1)
+    assert started == [paths[1], paths[2], paths[0]]
+    assert [result["input"] for result in results] == paths
+
+
+def test_convert_batch_reports_a_missing_input_instead_of_aborting(tmp_path, monkeypatch):
+    present = tmp_path / "present.md"
+    present.write_text("# Present")
+    paths = [str(tmp_path / "missing.md"), str(present)]
+    monkeypatch.setattr(d, "_init_batch_worker", lambda converter_kwargs: None)
+    monkeypatch.setattr(d, "_convert_in_worker", lambda path, force=False: {
+        "input": path, "output": path, "status": "converted" if os.path.exists(path) else "failed",
+        "seconds": 0.0, "error": None})
+    results = d.convert_batch(paths, {}, workers=1)
+    assert [result["status"] for result in results] == ["failed", "converted"]
+
+
+def test_output_paths_are_unique_per_source(tmp_path):
+    converter = make_converter(tmp_path)
+    try:
+        paths = {converter.output_path_for(path) for path in ("a/report.pdf", "a/report.docx", "b/report.pdf")}
+    finally:
+        converter.close()
+    assert len({os.path.dirname(path) for path in paths}) == 3
+
+
+def test_profiles_are_unique_per_source(tmp_path):
+    converter = make_converter(tmp_path, profile_dir=str(tmp_path / "profiles"), markitdown_backend="none")
+    try:
+        for folder in ("a", "b"):
+            (tmp_path / folder).mkdir()
+            (tmp_path / folder / "notes.md").write_text("# Notes\n\nText.\n")
+            converter.convert_file(str(tmp_path / folder / "notes.md"))
+    finally:
+        converter.close()
+    assert len(os.listdir(tmp_path / "profiles")) == 2